@@ -0,0 +1,4 @@
+"""
+Performance benchmarks for pngdoctor, run with
+``python -m benchmarks.run``.
+"""
@@ -0,0 +1,328 @@
+"""
+Run the pngdoctor benchmarks.
+
+Usage::
+
+    python -m benchmarks.run [--quick] [--only NAME...] [--memory]
+                             [--save FILE] [--compare FILE]
+
+Each benchmark processes the whole synthetic corpus, best of
+``--repeat`` runs, and reports the throughput in MB/s of its input and
+in files/s. ``--save`` writes the results as JSON, and ``--compare``
+prints the change against such a file, flagging benchmarks slower than
+``--threshold``. ``--memory`` also reports the peak Python memory of a
+full parse of each corpus file, and the parsing stage that reached it.
+"""
+import argparse
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import zlib
+
+from pngdoctor.chunk_order_parser import ChunkOrderParser
+from pngdoctor.image_data_parser import (
+    ImageDataStreamParser, _AdaptiveFiveBasicSubimageUnfilterer,
+    _Deflate32KDecompressor, _calculate_subimage_scanlines
+)
+from pngdoctor.instrumentation import Instrumentation, tracing_memory
+from pngdoctor.lexer import ChunkTokenStream
+from pngdoctor.models import ChunkHeadToken
+from pngdoctor.parser import PNGParser, ParseMode
+from pngdoctor.version import __version__
+
+from benchmarks.synthetic import (
+    ALL_FILTER_TYPES, ColorType, FilterType, ImageSpec, InterlaceMethod,
+    generate_image_data, generate_png
+)
+
+
+def corpus_specs(quick=False):
+    """
+    Return the :class:`synthetic.ImageSpec` list of the corpus, varying
+    size, color type, bit depth, interlacing, filter types, IDAT
+    chunking, and ancillary chunk load.
+    """
+    size = 64 if quick else 192
+    return [
+        ImageSpec(width=size, height=size),
+        ImageSpec(width=size * 2, height=size // 2,
+                  color_type=ColorType.rgb_alpha),
+        ImageSpec(width=size, height=size, color_type=ColorType.rgb,
+                  bit_depth=16, filter_types=(FilterType.paeth,)),
+        ImageSpec(width=size, height=size, color_type=ColorType.grayscale,
+                  bit_depth=1, filter_types=(FilterType.none,)),
+        ImageSpec(width=size, height=size, color_type=ColorType.indexed,
+                  bit_depth=4, filter_types=(FilterType.sub, FilterType.up)),
+        ImageSpec(width=size, height=size,
+                  color_type=ColorType.grayscale_alpha,
+                  interlace_method=InterlaceMethod.adam7),
+        ImageSpec(width=size, height=size, idat_size=512, noise_bits=8),
+        ImageSpec(width=size // 4, height=size // 4, text_chunks=64,
+                  text_size=512),
+        ImageSpec(width=size // 8, height=size // 8),
+    ]
+
+
+def unfilter_specs(quick=False):
+    """
+    Return one spec for each filter type, using only that type.
+    """
+    size = 64 if quick else 192
+    return [
+        ImageSpec(width=size, height=size, filter_types=(filter_type,))
+        for filter_type in ALL_FILTER_TYPES
+    ]
+
+
+class Benchmark:
+    """
+    A benchmark over some inputs.
+
+    :ivar run: Called with each input, and timed
+    :ivar inputs: The inputs
+    :ivar total_bytes:
+        The size of all inputs, summed from ``input_size`` called with
+        each input
+    """
+    def __init__(self, name, run, inputs, input_size=len):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.total_bytes = sum(input_size(item) for item in inputs)
+
+    def measure(self, repeat):
+        """
+        Return the best wall clock time of ``repeat`` runs over all the
+        inputs, in seconds.
+        """
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for item in self.inputs:
+                self.run(item)
+            best = min(best, time.perf_counter() - start)
+        return best
+
+
+def _lex(data):
+    for _ in ChunkTokenStream(io.BytesIO(data)):
+        pass
+
+
+def _chunk_codes(data):
+    return [
+        token.code for token in ChunkTokenStream(io.BytesIO(data))
+        if isinstance(token, ChunkHeadToken)
+    ]
+
+
+def _check_order(codes):
+    parser = ChunkOrderParser()
+    for code in codes:
+        parser.validate(code)
+    parser.validate_end()
+
+
+def _decompress(compressed):
+    decompressor = _Deflate32KDecompressor()
+    max_length = ImageDataStreamParser.MAX_DECOMPRESS_LENGTH
+    decompressor.decompress(compressed, max_length)
+    while decompressor.has_unconsumed_input:
+        decompressor.decompress(b'', max_length)
+    decompressor.verify_end()
+
+
+def _scanlines(spec):
+    """
+    Return the filtered scanlines of a non-interlaced spec, with their
+    filter type bytes.
+    """
+    data = generate_image_data(spec)
+    [(length, count)] = _calculate_subimage_scanlines(
+        spec.width, spec.height, spec.color_type, spec.bit_depth,
+        spec.interlace_method)
+    return (spec, [
+        data[row * length:(row + 1) * length] for row in range(count)
+    ])
+
+
+def _unfilter(spec_and_scanlines):
+    spec, scanlines = spec_and_scanlines
+    unfilterer = _AdaptiveFiveBasicSubimageUnfilterer(
+        spec.color_type, spec.bit_depth)
+    for scanline in scanlines:
+        unfilterer.unfilter_scanline(scanline)
+
+
+def _parse(mode):
+    def parse(data):
+        PNGParser(io.BytesIO(data), mode=mode).parse()
+    return parse
+
+
+def build_benchmarks(quick=False):
+    files = [generate_png(spec) for spec in corpus_specs(quick)]
+    compressed = [
+        zlib.compress(generate_image_data(spec), spec.compression_level)
+        for spec in corpus_specs(quick)
+    ]
+    benchmarks = [
+        Benchmark('lexer', _lex, files),
+        Benchmark('order_parser', _check_order,
+                  [_chunk_codes(data) for data in files],
+                  input_size=lambda codes: 4 * len(codes)),
+        Benchmark('decompress', _decompress, compressed),
+    ]
+    for spec in unfilter_specs(quick):
+        filter_type = spec.filter_types[0]
+        benchmarks.append(Benchmark(
+            'unfilter_' + filter_type.name, _unfilter, [_scanlines(spec)],
+            input_size=lambda item: sum(map(len, item[1]))))
+    benchmarks.append(
+        Benchmark('parse_metadata', _parse(ParseMode.metadata), files))
+    benchmarks.append(Benchmark('parse_full', _parse(ParseMode.full), files))
+    return benchmarks
+
+
+def measure_memory(specs):
+    """
+    Return a dict of spec names to the peak Python memory in bytes of a
+    full parse of the spec's file, and the stage that reached it.
+    """
+    peaks = {}
+    for spec in specs:
+        data = generate_png(spec)
+        instrumentation = Instrumentation(trace_memory=True)
+        with tracing_memory():
+            PNGParser(
+                io.BytesIO(data), instrumentation=instrumentation
+            ).parse()
+            instrumentation.check_memory('parse')
+        peaks[spec.name] = {
+            'peak': instrumentation.peak_memory,
+            'stage': instrumentation.peak_memory_stage,
+        }
+    return peaks
+
+
+def format_memory(peaks):
+    """
+    Return the report lines for the result of :func:`measure_memory`.
+    """
+    width = max(len(name) for name in peaks)
+    lines = ['{0:<{width}} {1:>12}  {2}'.format(
+        'file', 'peak bytes', 'stage', width=width)]
+    for name, peak in peaks.items():
+        lines.append('{0:<{width}} {1:>12}  {2}'.format(
+            name, peak['peak'], peak['stage'], width=width))
+    return lines
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(benchmarks, repeat):
+    """
+    Run the benchmarks and return the results document.
+    """
+    results = {}
+    for benchmark in benchmarks:
+        seconds = benchmark.measure(repeat)
+        results[benchmark.name] = {
+            'seconds': seconds,
+            'bytes': benchmark.total_bytes,
+            'files': len(benchmark.inputs),
+            'mb_per_s': benchmark.total_bytes / seconds / 1e6,
+            'files_per_s': len(benchmark.inputs) / seconds,
+        }
+    return {
+        'pngdoctor_version': __version__,
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def format_results(document, baseline=None, threshold=0.1):
+    """
+    Return the report lines for a results document, with the change
+    against the ``baseline`` document if given. Benchmarks whose
+    throughput dropped by more than ``threshold`` are flagged.
+    """
+    lines = ['{0:<20} {1:>10} {2:>10}{3}'.format(
+        'benchmark', 'MB/s', 'files/s', '     change' if baseline else '')]
+    regressions = []
+    for name, result in document['results'].items():
+        line = '{0:<20} {1:>10.2f} {2:>10.1f}'.format(
+            name, result['mb_per_s'], result['files_per_s'])
+        old = (baseline or {}).get('results', {}).get(name)
+        if old is not None:
+            change = result['mb_per_s'] / old['mb_per_s'] - 1
+            line += ' {0:>+10.1%}'.format(change)
+            if change < -threshold:
+                line += '  REGRESSION'
+                regressions.append(name)
+        lines.append(line)
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run')
+    parser.add_argument(
+        '--quick', action='store_true', help="Use smaller images")
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help="Runs per benchmark, the best is kept (default: 5)")
+    parser.add_argument(
+        '--only', nargs='+', metavar='NAME', help="Only run these benchmarks")
+    parser.add_argument(
+        '--memory', action='store_true',
+        help="Also report the peak memory of parsing each corpus file")
+    parser.add_argument(
+        '--save', metavar='FILE', help="Write the results as JSON")
+    parser.add_argument(
+        '--compare', metavar='FILE',
+        help="Compare with results saved earlier")
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help="Throughput drop flagged as a regression (default: 0.1)")
+    args = parser.parse_args(argv)
+
+    benchmarks = build_benchmarks(args.quick)
+    if args.only:
+        benchmarks = [
+            benchmark for benchmark in benchmarks
+            if benchmark.name in args.only
+        ]
+    document = run_benchmarks(benchmarks, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    lines, regressions = format_results(document, baseline, args.threshold)
+    print('\n'.join(lines))
+    if args.memory:
+        document['memory'] = measure_memory(corpus_specs(args.quick))
+        print()
+        print('\n'.join(format_memory(document['memory'])))
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(document, results_file, indent=2, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""
+Deterministic generator of synthetic PNG files for the benchmarks.
+
+The same :class:`ImageSpec` always produces the same bytes, so results
+from different commits are measured on identical input.
+"""
+import random
+import struct
+import zlib
+
+import attr
+
+from pngdoctor import fieldvalues
+from pngdoctor.image_data_parser import (
+    _calculate_subimage_scanlines, _calculate_bits_per_pixel, paeth_predictor
+)
+from pngdoctor.lexer import PNG_SIGNATURE
+
+
+ColorType = fieldvalues.ColorType
+FilterType = fieldvalues.AdaptiveFilterType
+InterlaceMethod = fieldvalues.InterlaceMethod
+
+ALL_FILTER_TYPES = tuple(FilterType)
+
+
+@attr.attributes(frozen=True)
+class ImageSpec:
+    """
+    The parameters of a synthetic PNG image.
+
+    :ivar filter_types:
+        The filter types to choose from for each scanline, at random
+    :ivar noise_bits:
+        How many low bits of each sample byte are random, the rest is
+        a smooth gradient. Higher values compress worse.
+    :ivar idat_size: The data length of each IDAT chunk but the last
+    :ivar text_chunks: The number of tEXt chunks
+    :ivar text_size: The text length of each tEXt chunk
+    """
+    width = attr.attr(default=256)  # type: int
+    height = attr.attr(default=256)  # type: int
+    color_type = attr.attr(default=ColorType.rgb)
+    bit_depth = attr.attr(default=8)  # type: int
+    interlace_method = attr.attr(default=InterlaceMethod.none)
+    filter_types = attr.attr(default=ALL_FILTER_TYPES)
+    noise_bits = attr.attr(default=3)  # type: int
+    compression_level = attr.attr(default=6)  # type: int
+    idat_size = attr.attr(default=8192)  # type: int
+    text_chunks = attr.attr(default=0)  # type: int
+    text_size = attr.attr(default=64)  # type: int
+    seed = attr.attr(default=0)  # type: int
+
+    @property
+    def name(self):
+        """
+        A short description, unique for the specs used together.
+        """
+        return '{w}x{h}-{color}{depth}{interlace}-f{filters}-{chunks}'.format(
+            w=self.width,
+            h=self.height,
+            color=self.color_type.name,
+            depth=self.bit_depth,
+            interlace='-adam7' if self.interlace_method.value else '',
+            filters=''.join(str(f.value) for f in self.filter_types),
+            chunks='idat{0}-text{1}'.format(self.idat_size, self.text_chunks),
+        )
+
+
+def generate_png(spec):
+    """
+    Return the bytes of a complete PNG file described by ``spec``.
+    """
+    rng = random.Random(spec.seed)
+    chunks = [_chunk(b'IHDR', struct.pack(
+        '>IIBBBBB',
+        spec.width,
+        spec.height,
+        spec.bit_depth,
+        spec.color_type.value,
+        0,
+        0,
+        spec.interlace_method.value,
+    ))]
+    chunks.append(_chunk(b'gAMA', struct.pack('>I', 45455)))
+    if spec.color_type is ColorType.indexed:
+        entries = 2 ** spec.bit_depth
+        chunks.append(_chunk(b'PLTE', _random_bytes(rng, 3 * entries)))
+    chunks.append(_chunk(b'pHYs', struct.pack('>IIB', 2835, 2835, 1)))
+    # Half of the text before the image data, half after
+    texts = [_text_chunk(rng, index, spec.text_size)
+             for index in range(spec.text_chunks)]
+    chunks.extend(texts[:len(texts) // 2])
+    compressed = zlib.compress(
+        generate_image_data(spec, rng), spec.compression_level)
+    for start in range(0, len(compressed), spec.idat_size):
+        chunks.append(
+            _chunk(b'IDAT', compressed[start:start + spec.idat_size]))
+    chunks.extend(texts[len(texts) // 2:])
+    chunks.append(_chunk(b'IEND', b''))
+    return PNG_SIGNATURE + b''.join(chunks)
+
+
+def generate_image_data(spec, rng=None):
+    """
+    Return the decompressed image data stream for ``spec``: the
+    filtered scanlines of every subimage, with their filter type bytes.
+    """
+    if rng is None:
+        rng = random.Random(spec.seed)
+    bytes_per_pixel = max(
+        1, _calculate_bits_per_pixel(spec.color_type, spec.bit_depth) // 8)
+    noise_table = bytes(
+        value >> (8 - spec.noise_bits) for value in range(256))
+    stream = bytearray()
+    for length, count in _calculate_subimage_scanlines(
+            spec.width, spec.height, spec.color_type, spec.bit_depth,
+            spec.interlace_method):
+        previous = bytes(length - 1)
+        for row in range(count):
+            noise = _random_bytes(rng, length - 1).translate(noise_table)
+            raw = bytes(
+                ((column + row) * 3 + value) & 0xFF
+                for column, value in enumerate(noise)
+            )
+            filter_type = rng.choice(spec.filter_types)
+            stream.append(filter_type.value)
+            stream += filter_scanline(
+                filter_type, raw, previous, bytes_per_pixel)
+            previous = raw
+    return bytes(stream)
+
+
+def filter_scanline(filter_type, raw, previous, bytes_per_pixel):
+    """
+    Apply the adaptive filter type to the scanline bytes ``raw``, given
+    the unfiltered bytes of the scanline above, ``previous``.
+    """
+    if filter_type is FilterType.none:
+        return raw
+    filtered = bytearray(len(raw))
+    for pos, value in enumerate(raw):
+        left_pos = pos - bytes_per_pixel
+        left = raw[left_pos] if left_pos >= 0 else 0
+        above = previous[pos]
+        upper_left = previous[left_pos] if left_pos >= 0 else 0
+        if filter_type is FilterType.sub:
+            predicted = left
+        elif filter_type is FilterType.up:
+            predicted = above
+        elif filter_type is FilterType.average:
+            predicted = (left + above) // 2
+        else:
+            predicted = paeth_predictor(left, above, upper_left)
+        filtered[pos] = (value - predicted) & 0xFF
+    return bytes(filtered)
+
+
+def _random_bytes(rng, length):
+    if not length:
+        return b''
+    return rng.getrandbits(8 * length).to_bytes(length, 'big')
+
+
+def _chunk(code, data):
+    crc = zlib.crc32(data, zlib.crc32(code))
+    return struct.pack('>I4s', len(data), code) + data + struct.pack(
+        '>I', crc)
+
+
+def _text_chunk(rng, index, size):
+    keyword = 'Comment{0}'.format(index).encode('latin-1')
+    text = bytes(rng.randrange(32, 127) for _ in range(size))
+    return _chunk(b'tEXt', keyword + b'\0' + text)
+
+
+def valid_bit_depths(color_type):
+    """
+    Return the bit depths allowed with ``color_type``.
+    """
+    return {
+        ColorType.grayscale: (1, 2, 4, 8, 16),
+        ColorType.rgb: (8, 16),
+        ColorType.indexed: (1, 2, 4, 8),
+        ColorType.grayscale_alpha: (8, 16),
+        ColorType.rgb_alpha: (8, 16),
+    }[color_type]
@@ -0,0 +1,85 @@
+# pylint: disable=no-self-use
+import io
+
+import pytest
+
+from pngdoctor.parser import PNGParser
+
+from benchmarks.run import (
+    build_benchmarks, corpus_specs, format_memory, format_results,
+    measure_memory, run_benchmarks
+)
+from benchmarks.synthetic import (
+    ALL_FILTER_TYPES, ColorType, ImageSpec, InterlaceMethod,
+    generate_image_data, generate_png, valid_bit_depths
+)
+
+
+SPECS = [
+    ImageSpec(
+        width=13,
+        height=11,
+        color_type=color_type,
+        bit_depth=bit_depth,
+        interlace_method=interlace_method,
+        idat_size=32,
+        text_chunks=2,
+    )
+    for color_type in ColorType
+    for bit_depth in valid_bit_depths(color_type)
+    for interlace_method in InterlaceMethod
+]
+
+
+class TestGeneratePNG:
+    @pytest.mark.parametrize('spec', SPECS, ids=lambda spec: spec.name)
+    def test_parses(self, spec):
+        data = generate_png(spec)
+        result = PNGParser(io.BytesIO(data)).parse()
+        assert result.image_header.width == spec.width
+        assert result.image_header.color_type is spec.color_type
+        assert len(result.textual_data) == spec.text_chunks
+
+    def test_deterministic(self):
+        spec = ImageSpec(width=16, height=16)
+        assert generate_png(spec) == generate_png(spec)
+        assert generate_png(spec) != generate_png(
+            ImageSpec(width=16, height=16, seed=1))
+
+    def test_all_filter_types_used(self):
+        spec = ImageSpec(width=8, height=64)
+        data = generate_image_data(spec)
+        # 8 RGB pixels plus the filter type byte per scanline
+        filter_types = {data[row * 25] for row in range(spec.height)}
+        assert filter_types == {
+            filter_type.value for filter_type in ALL_FILTER_TYPES
+        }
+
+
+def test_run_and_compare():
+    benchmarks = build_benchmarks(quick=True)
+    document = run_benchmarks(
+        [benchmark for benchmark in benchmarks
+         if benchmark.name in ('lexer', 'unfilter_paeth')],
+        repeat=1,
+    )
+    assert set(document['results']) == {'lexer', 'unfilter_paeth'}
+    assert document['results']['lexer']['mb_per_s'] > 0
+    slower = {
+        'results': {
+            name: dict(result, mb_per_s=result['mb_per_s'] * 2)
+            for name, result in document['results'].items()
+        }
+    }
+    _, regressions = format_results(document, slower)
+    assert sorted(regressions) == ['lexer', 'unfilter_paeth']
+
+
+def test_measure_memory():
+    specs = corpus_specs(quick=True)[:2]
+    peaks = measure_memory(specs)
+    assert set(peaks) == {spec.name for spec in specs}
+    for peak in peaks.values():
+        assert peak['peak'] > 0
+        assert peak['stage'] is not None
+    assert len(format_memory(peaks)) == 3
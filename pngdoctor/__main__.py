@@ -1,2 +1,4 @@
+import sys
+
 from pngdoctor.main import main
-main()
+sys.exit(main())
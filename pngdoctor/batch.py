@@ -0,0 +1,686 @@
+"""
+Validation of many PNG files, optionally spread across a pool of
+worker processes.
+"""
+import collections
+import contextlib
+import hashlib
+import io
+import os
+import time
+import typing
+
+import attr
+
+from pngdoctor import fieldvalues
+from pngdoctor import models
+from pngdoctor.exceptions import DecodeError
+from pngdoctor.parser import PNGParser, ParseMode
+
+
+PNG_FILE_EXTENSIONS = frozenset(['.png'])
+
+
+def iter_png_paths(paths, onerror=None):
+    """
+    Yield the paths of PNG files found in ``paths``.
+
+    Directories are walked recursively with :func:`os.scandir`,
+    yielding files with a PNG extension. Symbolic links to directories
+    are not followed. Other paths are yielded as they are, whatever
+    their extension.
+
+    :param onerror:
+        Called with the :exc:`OSError` if a directory cannot be
+        scanned. If ``None``, the error is raised.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from _walk_png_paths(path, onerror)
+        else:
+            yield path
+
+
+def _walk_png_paths(directory, onerror):
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        try:
+            entries = list(os.scandir(current))
+        except OSError as exc:
+            if onerror is None:
+                raise
+            onerror(exc)
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif (
+                    os.path.splitext(entry.name)[1].lower() in
+                    PNG_FILE_EXTENSIONS and
+                    entry.is_file()
+                ):
+                yield entry.path
+        # Reversed so subdirectories are walked in scandir order
+        pending.extend(reversed(subdirectories))
+
+
+@attr.attributes
+class CheckOptions:
+    """
+    How each file is validated.
+
+    :ivar mode: The :class:`parser.ParseMode` to use
+    :ivar verify_image_data_crc: See :class:`parser.PNGParser`
+    :ivar instrument:
+        Whether to measure the time spent in each parsing stage, see
+        :attr:`FileCheckResult.stage_timings`
+    :ivar trace_memory:
+        Whether to trace the peak Python memory used for the file, see
+        :attr:`FileCheckResult.peak_memory`
+    :ivar collect_diagnostics:
+        Whether to go on after recoverable problems and report them
+        all, see :attr:`FileCheckResult.diagnostics`
+    """
+    mode = attr.attr(default=ParseMode.full)
+    verify_image_data_crc = attr.attr(default=True)  # type: bool
+    instrument = attr.attr(default=False)  # type: bool
+    trace_memory = attr.attr(default=False)  # type: bool
+    collect_diagnostics = attr.attr(default=False)  # type: bool
+
+
+@attr.attributes
+class FileCheckResult:
+    """
+    The outcome of validating a single file.
+
+    :ivar path: The file path
+    :ivar error_type:
+        The name of the exception class if validation failed, for
+        example ``'BadCRC'``, otherwise ``None``
+    :ivar error_message: The exception message, or ``None``
+    :ivar error_offset:
+        If validation failed, the byte offset of the last chunk that
+        was started, or ``None`` if the failure came before any chunk.
+        If it failed only with diagnostics, the offset of the first.
+    :ivar bytes_read: The number of bytes read from the file
+    :ivar image_header:
+        The :class:`models.ImageHeader`, or ``None`` if it wasn't
+        parsed
+    :ivar chunks:
+        A list of (type code, byte offset, data length) tuples for each
+        chunk that was started, with the type code as a string
+    :ivar elapsed: Wall clock seconds spent on the file
+    :ivar stage_timings:
+        A dict of :class:`instrumentation.Instrumentation` stage names
+        to wall clock seconds spent on the file, if
+        :attr:`CheckOptions.instrument` was set, otherwise ``None``
+    :ivar peak_memory:
+        The peak Python memory allocated while validating the file, in
+        bytes, if :attr:`CheckOptions.trace_memory` was set, otherwise
+        ``None``
+    :ivar peak_memory_stage:
+        The :class:`instrumentation.Instrumentation` stage in which
+        :attr:`peak_memory` was reached, or ``None``
+    :ivar diagnostics:
+        If :attr:`CheckOptions.collect_diagnostics` was set, a list of
+        dicts for the recoverable problems found, with the keys
+        ``code`` (a :class:`models.DiagnosticCode` name), ``offset``,
+        ``chunk`` (the type code as a string, or ``None``), ``type``
+        and ``message``, otherwise ``None``. The first problem is also
+        reported as the error if validation didn't fail otherwise.
+    :ivar cached:
+        Whether the result came from a :class:`cache.ResultCache`
+        instead of validating the file
+    :ivar content_sha256:
+        The hex SHA-256 digest of the file, if it was requested and the
+        file could be read, otherwise ``None``
+    :ivar duplicate_of:
+        If the file wasn't validated because it has the same content as
+        another, the path of that file, otherwise ``None``
+    """
+    path = attr.attr()  # type: str
+    error_type = attr.attr(default=None)  # type: typing.Optional[str]
+    error_message = attr.attr(default=None)  # type: typing.Optional[str]
+    error_offset = attr.attr(default=None)  # type: typing.Optional[int]
+    bytes_read = attr.attr(default=0)  # type: int
+    image_header = attr.attr(default=None)
+    chunks = attr.attr(default=attr.Factory(list))
+    elapsed = attr.attr(default=0.0)  # type: float
+    stage_timings = attr.attr(default=None)
+    peak_memory = attr.attr(default=None)  # type: typing.Optional[int]
+    peak_memory_stage = attr.attr(default=None)  # type: typing.Optional[str]
+    diagnostics = attr.attr(default=None)
+    cached = attr.attr(default=False)  # type: bool
+    content_sha256 = attr.attr(default=None)  # type: typing.Optional[str]
+    duplicate_of = attr.attr(default=None)  # type: typing.Optional[str]
+
+    @property
+    def ok(self):
+        return self.error_type is None
+
+    def to_record(self):
+        """
+        Return the result as a dict of JSON-compatible values.
+        """
+        header = self.image_header
+        if header is not None:
+            header = {
+                'width': header.width,
+                'height': header.height,
+                'bit_depth': header.bit_depth,
+                'color_type': header.color_type.name,
+                'compression_method': header.compression_method.name,
+                'filter_method': header.filter_method.name,
+                'interlace_method': header.interlace_method.name,
+            }
+        if self.ok:
+            error = None
+        else:
+            error = {
+                'type': self.error_type,
+                'message': self.error_message,
+                'offset': self.error_offset,
+            }
+        memory = None
+        if self.peak_memory is not None:
+            memory = {
+                'peak': self.peak_memory,
+                'stage': self.peak_memory_stage,
+            }
+        return {
+            'path': self.path,
+            'status': 'ok' if self.ok else 'error',
+            'error': error,
+            'bytes_read': self.bytes_read,
+            'image_header': header,
+            'chunks': self.chunks,
+            'timings': dict(self.stage_timings or {}, total=self.elapsed),
+            'memory': memory,
+            'diagnostics': self.diagnostics,
+            'cached': self.cached,
+            'content_sha256': self.content_sha256,
+            'duplicate_of': self.duplicate_of,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Create a result from a dict returned by :meth:`to_record`.
+        """
+        header = record['image_header']
+        if header is not None:
+            header = models.ImageHeader(
+                width=header['width'],
+                height=header['height'],
+                bit_depth=header['bit_depth'],
+                color_type=fieldvalues.ColorType[header['color_type']],
+                compression_method=fieldvalues.CompressionMethod[
+                    header['compression_method']],
+                filter_method=fieldvalues.FilterMethod[
+                    header['filter_method']],
+                interlace_method=fieldvalues.InterlaceMethod[
+                    header['interlace_method']],
+            )
+        error = record['error'] or {}
+        stage_timings = dict(record['timings'])
+        elapsed = stage_timings.pop('total')
+        memory = record.get('memory') or {}
+        return cls(
+            path=record.get('path'),
+            error_type=error.get('type'),
+            error_message=error.get('message'),
+            error_offset=error.get('offset'),
+            bytes_read=record['bytes_read'],
+            image_header=header,
+            chunks=[tuple(chunk) for chunk in record['chunks']],
+            elapsed=elapsed,
+            stage_timings=stage_timings or None,
+            peak_memory=memory.get('peak'),
+            peak_memory_stage=memory.get('stage'),
+            diagnostics=record.get('diagnostics'),
+            cached=record.get('cached', False),
+            content_sha256=record.get('content_sha256'),
+            duplicate_of=record.get('duplicate_of'),
+        )
+
+
+def check_file(path, options, hash_content=False):
+    """
+    Validate one file, returning a :class:`FileCheckResult`.
+
+    Decode errors and errors opening or reading the file are reported
+    in the result rather than raised.
+
+    If ``hash_content`` is true, the SHA-256 digest of the whole file
+    is calculated from the same reads as the validation, and stored in
+    the result.
+    """
+    return _check_stream(
+        lambda: open(path, 'rb'), path, options, hash_content)
+
+
+def check_bytes(data, options, path=None):
+    """
+    Validate the PNG file contents ``data``, returning a
+    :class:`FileCheckResult` with the given ``path``.
+    """
+    return _check_stream(lambda: io.BytesIO(data), path, options, False)
+
+
+def _check_stream(open_stream, path, options, hash_content):
+    start = time.perf_counter()
+    result = FileCheckResult(path)
+    content_hash = hashlib.sha256() if hash_content else None
+    instrumentation = None
+    with contextlib.ExitStack() as stack:
+        if options.instrument or options.trace_memory:
+            from pngdoctor import instrumentation as instrumentation_module
+            instrumentation = instrumentation_module.Instrumentation(
+                trace_memory=options.trace_memory)
+            if options.trace_memory:
+                stack.enter_context(instrumentation_module.tracing_memory())
+        parser = _parse_stream(
+            open_stream, result, options, content_hash, instrumentation)
+        if options.trace_memory:
+            instrumentation.check_memory('parse')
+            result.peak_memory = instrumentation.peak_memory
+            result.peak_memory_stage = instrumentation.peak_memory_stage
+    if parser is not None and parser.result is not None:
+        result.bytes_read = parser.bytes_read
+        result.image_header = parser.result.image_header
+        result.chunks = [
+            (head.code.decode('ascii'), head.position, head.length)
+            for head in parser.result.chunks
+        ]
+        if not result.ok and result.chunks:
+            result.error_offset = result.chunks[-1][1]
+        if options.collect_diagnostics:
+            _record_diagnostics(result, parser.result.diagnostics)
+    result.elapsed = time.perf_counter() - start
+    if options.instrument:
+        result.stage_timings = {
+            stage: totals.wall
+            for stage, totals in instrumentation.stages.items()
+        }
+    return result
+
+
+def _record_diagnostics(result, diagnostics):
+    result.diagnostics = [
+        {
+            'code': diagnostic.code.name,
+            'offset': diagnostic.position,
+            'chunk': (
+                None if diagnostic.chunk_code is None
+                else diagnostic.chunk_code.decode('ascii')
+            ),
+            'type': diagnostic.error_type,
+            'message': diagnostic.message,
+        }
+        for diagnostic in diagnostics
+    ]
+    if result.ok and diagnostics:
+        first = diagnostics[0]
+        result.error_type = first.error_type
+        result.error_message = first.message
+        result.error_offset = first.position
+
+
+def _parse_stream(open_stream, result, options, content_hash,
+                  instrumentation):
+    """
+    Parse the stream into ``result``, recording any error, and return
+    the parser, or ``None`` if the stream couldn't be opened.
+    """
+    parser = None
+    try:
+        with open_stream() as pngfile:
+            parser = PNGParser(
+                pngfile,
+                mode=options.mode,
+                verify_image_data_crc=options.verify_image_data_crc,
+                content_hash=content_hash,
+                instrumentation=instrumentation,
+                collect_diagnostics=options.collect_diagnostics,
+            )
+            try:
+                parser.parse()
+            finally:
+                if content_hash is not None:
+                    # Whatever the parser didn't get to
+                    _update_hash_from_file(content_hash, pngfile)
+                    result.content_sha256 = content_hash.hexdigest()
+    except (DecodeError, OSError) as exc:
+        result.error_type = type(exc).__name__
+        result.error_message = str(exc)
+        if isinstance(exc, OSError):
+            result.content_sha256 = None
+    return parser
+
+
+_HASH_READ_SIZE = 2**16
+
+
+def _update_hash_from_file(content_hash, fileobj):
+    for block in iter(lambda: fileobj.read(_HASH_READ_SIZE), b''):
+        content_hash.update(block)
+
+
+def _file_digest(path):
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as fileobj:
+        _update_hash_from_file(content_hash, fileobj)
+    return content_hash.hexdigest()
+
+
+# The work a worker can be given, as (kind, path) tuples. Check tasks
+# produce a FileCheckResult, hash tasks a (path, hex digest) tuple with
+# a None digest if the file can't be read.
+_TASK_CHECK = 'check'
+_TASK_CHECK_AND_HASH = 'check_and_hash'
+_TASK_HASH = 'hash'
+
+
+def _run_task(task, options):
+    kind, path = task
+    if kind == _TASK_HASH:
+        try:
+            return path, _file_digest(path)
+        except OSError:
+            return path, None
+    return check_file(
+        path, options, hash_content=kind == _TASK_CHECK_AND_HASH)
+
+
+# Set in each worker process by _initialize_worker
+_worker_options = None  # type: CheckOptions
+
+
+def _initialize_worker(options):
+    global _worker_options  # pylint: disable=global-statement
+    _worker_options = options
+
+
+def _run_task_in_worker(task):
+    return _run_task(task, _worker_options)
+
+
+def _run_tasks(tasks, options, jobs, max_pending_per_job, lookup=None):
+    """
+    Run each task of the iterable, in a pool of ``jobs`` worker
+    processes if there is more than one, and yield the outcomes in
+    completion order. See :func:`_bounded_imap_unordered` for
+    ``lookup``.
+    """
+    if jobs == 1:
+        for task in tasks:
+            outcome = None if lookup is None else lookup(task)
+            yield _run_task(task, options) if outcome is None else outcome
+        return
+
+    # Imported here, single process runs don't need it
+    import multiprocessing
+    pool = multiprocessing.Pool(
+        processes=jobs,
+        initializer=_initialize_worker,
+        initargs=(options,),
+    )
+    try:
+        yield from _bounded_imap_unordered(
+            pool, _run_task_in_worker, tasks, jobs * max_pending_per_job,
+            lookup=lookup)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def check_files(paths, options, jobs=1, max_pending_per_job=16, cache=None):
+    """
+    Validate each file in the iterable of paths, and yield a
+    :class:`FileCheckResult` for each as soon as it finishes.
+
+    With more than one job, files are validated in a pool of ``jobs``
+    worker processes, each initialized once, and results are yielded
+    in completion order. At most ``jobs * max_pending_per_job`` paths
+    are taken from the iterable ahead of the results, so the iterable
+    may be arbitrarily long.
+
+    :param cache:
+        A :class:`cache.ResultCache`. Files with a cached result are
+        not validated again, and new results are stored in it. The
+        cache is only used from the calling process.
+    """
+    tasks = ((_TASK_CHECK, path) for path in paths)
+    if cache is None:
+        yield from _run_tasks(tasks, options, jobs, max_pending_per_job)
+        return
+
+    lookup, store = _cache_callbacks(cache, options)
+    for result in _run_tasks(
+            tasks, options, jobs, max_pending_per_job,
+            lookup=lambda task: lookup(task[1])):
+        if not result.cached:
+            store(result)
+        yield result
+
+
+def check_files_deduplicated(paths, options, jobs=1, max_pending_per_job=16,
+                             cache=None, partial_hash_size=4096):
+    """
+    Like :func:`check_files`, but validate each distinct file content
+    only once, and report its result for every path with that content.
+
+    All paths are taken from the iterable first. Files are grouped by
+    size, then by a hash of their first and last ``partial_hash_size``
+    bytes. Files alone in their group are validated as usual. In each
+    remaining group, one file is validated while hashing its whole
+    content from the same reads, and the others are only hashed. The
+    others with the same content get a copy of its result, with
+    :attr:`FileCheckResult.duplicate_of` set to the validated path.
+    """
+    lookup = store = None
+    if cache is not None:
+        lookup, store = _cache_callbacks(cache, options)
+
+    def finish(result):
+        if store is not None:
+            store(result)
+        return result
+
+    by_size = collections.defaultdict(list)
+    unique = []
+    for path in paths:
+        if lookup is not None:
+            result = lookup(path)
+            if result is not None:
+                yield result
+                continue
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            # check_file reports the error
+            unique.append(path)
+            continue
+        by_size[size].append(path)
+
+    groups = []
+    for size, same_size in by_size.items():
+        if len(same_size) == 1:
+            unique.extend(same_size)
+            continue
+        by_partial_digest = collections.defaultdict(list)
+        for path in same_size:
+            try:
+                digest = _partial_file_digest(path, size, partial_hash_size)
+            except OSError:
+                unique.append(path)
+                continue
+            by_partial_digest[digest].append(path)
+        for candidates in by_partial_digest.values():
+            if len(candidates) == 1:
+                unique.extend(candidates)
+            else:
+                groups.append(_DuplicateCandidates(candidates))
+    del by_size
+
+    group_of = {}
+    tasks = [(_TASK_CHECK, path) for path in unique]
+    for group in groups:
+        tasks.append((_TASK_CHECK_AND_HASH, group.paths[0]))
+        tasks.extend((_TASK_HASH, path) for path in group.paths[1:])
+        group_of.update((path, group) for path in group.paths)
+    del unique, groups
+
+    # Paths with the same content as each other, but not the validated
+    # file of their group
+    leftovers = []
+    for outcome in _run_tasks(tasks, options, jobs, max_pending_per_job):
+        if isinstance(outcome, FileCheckResult):
+            group = group_of.get(outcome.path)
+            if group is None:
+                yield finish(outcome)
+                continue
+            group.validated = outcome
+        else:
+            group = group_of[outcome[0]]
+            group.digests.append(outcome)
+        if group.complete:
+            for result in group.resolve(leftovers):
+                yield finish(result)
+
+    copies_of = {}
+    for same_content in leftovers:
+        copies_of.setdefault(same_content[0], []).extend(same_content[1:])
+    tasks = [(_TASK_CHECK, path) for path in copies_of]
+    for result in _run_tasks(tasks, options, jobs, max_pending_per_job):
+        yield finish(result)
+        for path in copies_of[result.path]:
+            yield finish(_duplicate_result(result, path))
+
+
+class _DuplicateCandidates:
+    """
+    Files that may have the same content, and the outcomes so far.
+
+    :ivar paths: The file paths, the first is validated
+    :ivar validated: The :class:`FileCheckResult` of the first path
+    :ivar digests: (path, hex digest) tuples of the other paths
+    """
+    def __init__(self, paths):
+        self.paths = paths
+        self.validated = None
+        self.digests = []
+
+    @property
+    def complete(self):
+        return (
+            self.validated is not None and
+            len(self.digests) == len(self.paths) - 1
+        )
+
+    def resolve(self, leftovers):
+        """
+        Yield the results of the validated path and its duplicates.
+        Append lists of the remaining paths with the same content to
+        ``leftovers``.
+        """
+        validated = self.validated
+        yield validated
+        mismatched = collections.defaultdict(list)
+        for path, digest in self.digests:
+            if digest is None:
+                # Unreadable, check_file reports the error
+                leftovers.append([path])
+            elif digest == validated.content_sha256:
+                yield _duplicate_result(validated, path)
+            else:
+                mismatched[digest].append(path)
+        leftovers.extend(mismatched.values())
+
+
+def _duplicate_result(result, path):
+    return attr.evolve(result, path=path, duplicate_of=result.path)
+
+
+def _partial_file_digest(path, size, partial_size):
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as fileobj:
+        content_hash.update(fileobj.read(partial_size))
+        if size > partial_size:
+            fileobj.seek(max(partial_size, size - partial_size))
+            content_hash.update(fileobj.read(partial_size))
+    return content_hash.digest()
+
+
+def _cache_callbacks(cache, options):
+    """
+    Return a (lookup, store) pair of functions for the cache. Lookup
+    takes a path and returns the cached result or ``None``, remembering
+    the key of a miss, and store takes the result of that miss.
+    """
+    missed_keys = {}
+
+    def lookup(path):
+        try:
+            key = cache.key(path, options)
+        except OSError:
+            # Not cached, and check_file reports the error
+            return None
+        result = cache.get(key, path)
+        if result is None:
+            missed_keys[path] = key
+        return result
+
+    def store(result):
+        key = missed_keys.pop(result.path, None)
+        if key is not None:
+            cache.put(key, result)
+
+    return lookup, store
+
+
+def _bounded_imap_unordered(pool, func, iterable, max_pending, lookup=None):
+    """
+    Like :meth:`multiprocessing.pool.Pool.imap_unordered`, but only
+    consumes the iterable as results come back, instead of submitting
+    all of it at once.
+
+    :param lookup:
+        Called in this process with each item before it is submitted.
+        If it returns anything but ``None``, that is yielded as the
+        result instead.
+    """
+    import queue
+    results = queue.Queue()
+
+    def on_error(exc):
+        results.put(exc)
+
+    pending = 0
+    for item in iterable:
+        if lookup is not None:
+            result = lookup(item)
+            if result is not None:
+                yield result
+                continue
+        pool.apply_async(
+            func, (item,), callback=results.put, error_callback=on_error)
+        pending += 1
+        while True:
+            try:
+                result = results.get(block=pending >= max_pending)
+            except queue.Empty:
+                break
+            pending -= 1
+            yield _reraise_if_exception(result)
+    while pending:
+        pending -= 1
+        yield _reraise_if_exception(results.get())
+
+
+def _reraise_if_exception(result):
+    if isinstance(result, BaseException):
+        raise result
+    return result
@@ -0,0 +1,209 @@
+"""
+A persistent cache of batch validation results, so unchanged files are
+not validated again on later runs.
+"""
+import enum
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from pngdoctor.version import __version__
+
+
+class CacheKeyMode(enum.Enum):
+    """
+    How :class:`ResultCache` identifies an unchanged file.
+
+    -   ``stat``: By device, inode, size and modification time. Cheap,
+        but only valid on the host that wrote the cache.
+    -   ``content``: By size and SHA-256 digest of the file contents.
+        Copies of a file match wherever they are, but every file is
+        read in full to hash it, and a file without a cached result is
+        then read a second time to validate it.
+    """
+    stat = 0
+    content = 1
+
+
+# Bump when the table layout, the key format or the stored record
+# format changes
+_SCHEMA_VERSION = 3
+
+_HASH_READ_SIZE = 2**16
+
+
+class ResultCache:
+    """
+    A :class:`batch.FileCheckResult` cache stored in an SQLite database.
+
+    Results are keyed by the file identity, see :class:`CacheKeyMode`,
+    and by the :class:`batch.CheckOptions` they were produced with,
+    including whether stages are timed and memory traced, so that a
+    cached result has the figures asked for, as measured by the run
+    that stored it. The whole cache is dropped when it was written by
+    a different version of pngdoctor.
+
+    Lookups and stores are committed in batches of ``commit_interval``,
+    and when the cache is closed the least recently used entries beyond
+    ``max_entries`` are evicted. Use the cache as a context manager, or
+    call :meth:`close`, or pending changes are lost.
+    """
+    def __init__(self, path, key_mode=CacheKeyMode.stat,
+                 max_entries=1000000, commit_interval=1000):
+        self._key_mode = key_mode
+        self._max_entries = max_entries
+        self._commit_interval = commit_interval
+        self._pending_touches = []
+        self._pending_stores = []
+        self._connection = sqlite3.connect(path)
+        self._initialize()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _initialize(self):
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta "
+                "(name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, record TEXT NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_last_used "
+                "ON results (last_used)"
+            )
+            stamp = '{version}/{schema}'.format(
+                version=__version__, schema=_SCHEMA_VERSION)
+            row = self._connection.execute(
+                "SELECT value FROM meta WHERE name = 'version'").fetchone()
+            if row is None or row[0] != stamp:
+                self._connection.execute("DELETE FROM results")
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO meta (name, value) "
+                    "VALUES ('version', ?)",
+                    (stamp,)
+                )
+
+    def key(self, path, options):
+        """
+        Return the cache key of the file at ``path`` when validated
+        with the :class:`batch.CheckOptions` ``options``.
+
+        Raises :exc:`OSError` if the file cannot be read.
+        """
+        if self._key_mode is CacheKeyMode.stat:
+            stat = os.stat(path)
+            identity = 'stat:{dev}:{ino}:{size}:{mtime}'.format(
+                dev=stat.st_dev,
+                ino=stat.st_ino,
+                size=stat.st_size,
+                mtime=stat.st_mtime_ns,
+            )
+        else:
+            digest = hashlib.sha256()
+            size = 0
+            with open(path, 'rb') as pngfile:
+                for block in iter(
+                        lambda: pngfile.read(_HASH_READ_SIZE), b''):
+                    digest.update(block)
+                    size += len(block)
+            identity = 'sha256:{size}:{digest}'.format(
+                size=size, digest=digest.hexdigest())
+        return (
+            '{mode}:{crc:d}:{diagnostics:d}:{instrument:d}:{memory:d}'
+            '|{identity}'
+        ).format(
+            mode=options.mode.name,
+            crc=options.verify_image_data_crc,
+            diagnostics=options.collect_diagnostics,
+            instrument=options.instrument,
+            memory=options.trace_memory,
+            identity=identity,
+        )
+
+    def get(self, key, path):
+        """
+        Return the cached :class:`batch.FileCheckResult` for ``key``,
+        with its path set to ``path``, or ``None`` on a miss.
+        """
+        from pngdoctor.batch import FileCheckResult
+        row = self._connection.execute(
+            "SELECT record FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._pending_touches.append((time.time(), key))
+        self._commit_if_due()
+        result = FileCheckResult.from_record(json.loads(row[0]))
+        result.path = path
+        result.cached = True
+        return result
+
+    def put(self, key, result):
+        """
+        Store the :class:`batch.FileCheckResult` ``result`` under
+        ``key``.
+        """
+        record = result.to_record()
+        del record['path']
+        record['duplicate_of'] = None
+        self._pending_stores.append(
+            (key, json.dumps(record, separators=(',', ':')), time.time()))
+        self._commit_if_due()
+
+    def _commit_if_due(self):
+        pending = len(self._pending_touches) + len(self._pending_stores)
+        if pending >= self._commit_interval:
+            self.commit()
+
+    def commit(self):
+        """
+        Write the pending lookups and stores to the database.
+        """
+        with self._connection:
+            self._connection.executemany(
+                "UPDATE results SET last_used = ? WHERE key = ?",
+                self._pending_touches
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results (key, record, last_used) "
+                "VALUES (?, ?, ?)",
+                self._pending_stores
+            )
+        self._pending_touches = []
+        self._pending_stores = []
+
+    def evict(self):
+        """
+        Delete the least recently used entries beyond ``max_entries``.
+        """
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM results WHERE key IN ("
+                "SELECT key FROM results ORDER BY last_used DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self._max_entries,)
+            )
+
+    def __len__(self):
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        """
+        Commit, evict, and close the database.
+        """
+        if self._connection is None:
+            return
+        self.commit()
+        self.evict()
+        self._connection.close()
+        self._connection = None
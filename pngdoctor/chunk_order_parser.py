@@ -3,7 +3,9 @@ import collections.abc
 import enum
 import logging
 
-from pngdoctor.exceptions import PNGSyntaxError
+from pngdoctor.exceptions import (
+    DuplicateChunk, MisplacedChunk, PNGSyntaxError
+)
 from pngdoctor import chunktypes
 
 
@@ -47,19 +49,13 @@ _ALLOWED_ANYWHERE = _code_frozenset({
     chunktypes.TEXTUAL_DATA,
     chunktypes.COMPRESSED_TEXTUAL_DATA,
 })
-_allsets = [
-    _CRITICAL_CHUNK_CODES,
-    _BEFORE_PALETTE,
-    _AFTER_PALETTE_BEFORE_DATA,
-    _BEFORE_DATA,
+_KNOWN_CHUNKS = (
+    _CRITICAL_CHUNK_CODES |
+    _BEFORE_PALETTE |
+    _AFTER_PALETTE_BEFORE_DATA |
+    _BEFORE_DATA |
     _ALLOWED_ANYWHERE
-]
-_KNOWN_CHUNKS = frozenset().union(*_allsets)
-# Ensure no repeats
-assert len(_KNOWN_CHUNKS) == sum(map(len, _allsets))
-# Ensure everything is covered
-assert _KNOWN_CHUNKS == chunktypes.CODE_TO_CHUNK_TYPE.keys()
-del _allsets
+)
 
 
 @enum.unique
@@ -157,25 +153,26 @@ class ChunkOrderParser:
         Ensure that the chunk type code is valid for the current
         parser state, and change the state as necessary.
 
+        Raise :exc:`exceptions.DuplicateChunk` or
+        :exc:`exceptions.MisplacedChunk` if it isn't, leaving the state
+        unchanged so that validation can continue with the next chunk.
+
         :param chunk_code: The PNG chunk code (four bytes)
         """
-        msg = 'In state {state}, validating code {code}'.format(
-            state=self._state, code=chunk_code
-        )
-        logging.debug(msg)
+        logger.debug(
+            'In state %s, validating code %s', self._state, chunk_code)
         self._counts.check(chunk_code)
         available_transitions = self._transitions[self._state]
         if chunk_code not in available_transitions:
-            raise PNGSyntaxError(
+            self._counts.discard(chunk_code)
+            raise MisplacedChunk(
                 'Chunk {code} is not allowed here'.format(code=chunk_code)
             )
         next_state = available_transitions[chunk_code]
         if next_state is self._state:
-            msg = 'Staying in state {state}'.format(state=self._state)
-            logging.debug(msg)
+            logger.debug('Staying in state %s', self._state)
         else:
-            msg = 'Changing state to {next}'.format(next=next_state)
-            logging.debug(msg)
+            logger.debug('Changing state to %s', next_state)
         self._state = next_state
 
     def validate_end(self):
@@ -205,9 +202,15 @@ class _ChunkCountValidator:
         )
         if seen_and_multiple_disallowed:
             fmt = 'More than one {code} chunk seen, but at most one allowed'
-            raise PNGSyntaxError(fmt.format(code=chunk_code.decode('ascii')))
+            raise DuplicateChunk(fmt.format(code=chunk_code.decode('ascii')))
         self._nseen[chunk_code] += 1
 
+    def discard(self, chunk_code):
+        """
+        Forget one chunk counted by :meth:`check`.
+        """
+        self._nseen[chunk_code] -= 1
+
 
 class _ChunkOrderStateTransitionMap(collections.abc.Mapping):
     """
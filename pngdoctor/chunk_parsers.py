@@ -1,25 +1,15 @@
 import abc
+import array
+import codecs
 import itertools
-import logging
 import struct
+import sys
 from types import MappingProxyType
 
 from pngdoctor import fieldvalues
 from pngdoctor import models
 from pngdoctor import chunktypes
 from pngdoctor.exceptions import PNGSyntaxError
-from pngdoctor.image_data_parser import ImageDataStreamParser
-
-
-logger = logging.getLogger(__name__)
-
-
-class _ParseAntecedent:
-    """
-    The ongoing results of the parse.
-    """
-    # TODO: Figure out this API
-
 
 
 PNG_MAX_HEIGHT = PNG_MAX_WIDTH = 2**31 - 1
@@ -36,8 +26,8 @@ class _AbstractLimitedLengthChunkParser(metaclass=abc.ABCMeta):
     bytes).
 
     Implementers will have their ``__init__`` method called with
-    two arguments: the chunk's data token and an instance of
-    :class:`_ParseAntecedent` containing the parse results from the
+    two arguments: the chunk's data (bytes) and an instance of
+    :class:`models.ParseResult` containing the parse results from the
     previous chunks.
 
     """
@@ -54,6 +44,14 @@ class _AbstractLimitedLengthChunkParser(metaclass=abc.ABCMeta):
         The chunk type, an instance of `ChunkType`
         """
 
+    @abc.abstractproperty
+    def result_attribute(self):
+        """
+        The name of the :class:`models.ParseResult` attribute that
+        receives the parsed chunk model, or ``None`` if the chunk
+        produces no model.
+        """
+
     @abc.abstractproperty
     def max_data_size(self):
         """
@@ -74,14 +72,31 @@ class _AbstractLimitedLengthChunkParser(metaclass=abc.ABCMeta):
         :exception:`exceptions.PNGSyntaxError` if the value is not
         a valid member value.
         """
-        if value not in enumeration.__members__.values():
+        try:
+            return enumeration(value)
+        except ValueError:
             fmt = "Invalid {description} {value!r} for {code} chunk"
             raise PNGSyntaxError(fmt.format(
                 description=description,
                 value=value,
                 code=self.chunk_type.code.decode('ascii')
             ))
-        return enumeration(value)
+
+    def _validate_data_length(self, expected):
+        """
+        Raise :exception:`exceptions.PNGSyntaxError` if the chunk data
+        is not exactly ``expected`` bytes long.
+        """
+        if len(self.data_token) != expected:
+            fmt = (
+                "Invalid length for {code} chunk data, got {actual}, "
+                "expected {expected}."
+            )
+            raise PNGSyntaxError(fmt.format(
+                code=self.chunk_type.code.decode('ascii'),
+                actual=len(self.data_token),
+                expected=expected,
+            ))
 
 
 class _AbstractIterativeChunkParser(metaclass=abc.ABCMeta):
@@ -90,9 +105,15 @@ class _AbstractIterativeChunkParser(metaclass=abc.ABCMeta):
     data length or larger that :data:`decoder.PNG_CHUNK_MAX_DATA_READ`.
 
     Implementers will have their ``__init__`` method called with
-    one argument: an instance of :class:`_ParseAntecedent` containing
-    the parse results from the previous chunks.
+    one argument: an instance of :class:`models.ParseResult`
+    containing the parse results from the previous chunks. The parser
+    options named in :attr:`option_names` are passed as keyword
+    arguments as well.
     """
+    # Names of the parser options (see :class:`parser.PNGParser`) the
+    # implementation accepts as keyword arguments.
+    option_names = ()
+
     def __init__(self, parse_antecedent):
         self.antecedent = parse_antecedent
 
@@ -102,6 +123,14 @@ class _AbstractIterativeChunkParser(metaclass=abc.ABCMeta):
         The chunk type, an instance of `ChunkType`
         """
 
+    @abc.abstractproperty
+    def result_attribute(self):
+        """
+        The name of the :class:`models.ParseResult` attribute that
+        receives the parsed chunk model, or ``None`` if the chunk
+        produces no model.
+        """
+
     @abc.abstractmethod
     def parse_partial(self, data):
         """
@@ -116,7 +145,7 @@ class _AbstractIterativeChunkParser(metaclass=abc.ABCMeta):
         """
         Verify that the parse up until now represents a complete chunk.
 
-        Return the updated :class:`_ParseAntecedent` instance, or raise
+        Return the chunk model, or raise
         :exception:`exceptions.PNGSyntaxError` if the end was
         unexpected.
         """
@@ -125,8 +154,32 @@ class _AbstractIterativeChunkParser(metaclass=abc.ABCMeta):
 class _ChunkParserRegistry:
     def __init__(self):
         self._store = {}
+        self._dispatch_table = None
+
+    @property
+    def dispatch_table(self):
+        """
+        A read-only mapping of chunk type codes to parser classes.
+
+        The table is built on first access, after which the registry
+        is frozen and no more parsers may be registered.
+        """
+        if self._dispatch_table is None:
+            self._dispatch_table = MappingProxyType(dict(self._store))
+        return self._dispatch_table
+
+    def lookup(self, code):
+        """
+        Return the parser class registered for the chunk type code, or
+        ``None`` if there isn't one.
+        """
+        return self.dispatch_table.get(code)
 
     def register(self, chunk_parser_class):
+        if self._dispatch_table is not None:
+            raise RuntimeError(
+                "Cannot register parsers after the dispatch table is built"
+            )
         code = chunk_parser_class.chunk_type.code
         if code in self._store:
             raise RuntimeError(
@@ -148,6 +201,7 @@ class _ImageHeaderChunkParser(_AbstractLimitedLengthChunkParser):
     _FIELD_STRUCT = struct.Struct('>IIBBBBB')
 
     chunk_type = chunktypes.IMAGE_HEADER
+    result_attribute = 'image_header'
     max_data_size = _FIELD_STRUCT.size  # 13 bytes
 
     _ALLOWED_BIT_DEPTHS = frozenset([1, 2, 4, 8, 16])
@@ -236,6 +290,7 @@ class _ImageHeaderChunkParser(_AbstractLimitedLengthChunkParser):
 @chunk_parsers.register
 class _PaletteChunkParser(_AbstractLimitedLengthChunkParser):
     chunk_type = chunktypes.PALETTE
+    result_attribute = 'palette'
     max_data_size = 3 * 256  # 3 bytes per palette entry, max 256 entries
 
     _PROHIBITED_WITH_COLOR_TYPE = (
@@ -289,19 +344,53 @@ class _PaletteChunkParser(_AbstractLimitedLengthChunkParser):
         return rgb_tuples
 
 
-#@chunk_parsers.register
+@chunk_parsers.register
 class _ImageDataChunkParser(_AbstractIterativeChunkParser):
+    """
+    Parser for the image data stream, which may be split across
+    several consecutive IDAT chunks.
+
+    A single instance must be used for every IDAT chunk in the stream.
+    :meth:`verify_end` does nothing since the data stream does not
+    end with the chunk, call :meth:`verify_stream_end` after the last
+    IDAT chunk instead.
+
+    If ``inflate`` is false, the image data is not decompressed at all,
+    only the palette requirement is validated. Otherwise the
+    ``instrumentation``, if any, is passed on to the
+    :class:`image_data_parser.ImageDataStreamParser`.
+    """
     chunk_type = chunktypes.IMAGE_DATA
-    def __init__(self, antecedent):
+    result_attribute = None
+    option_names = ('inflate', 'instrumentation')
+
+    def __init__(self, antecedent, inflate=True, instrumentation=None):
         super().__init__(antecedent)
-        self._parser = ImageDataStreamParser.from_image_header(
-            self.antecedent.image_header)
+        self._validate_palette_exists_if_necessary()
+        if inflate:
+            # Imported here so the decoder is only loaded when used
+            from pngdoctor.image_data_parser import ImageDataStreamParser
+            self._parser = ImageDataStreamParser.from_image_header(
+                self.antecedent.image_header,
+                instrumentation=instrumentation,
+            )
+        else:
+            self._parser = None
 
     def parse_partial(self, data):
-        raise NotImplementedError('not done yet')
+        if self._parser is not None:
+            for _ in self._parser.iter_scanlines(data):
+                pass
 
     def verify_end(self):
-        raise NotImplementedError('not done yet')
+        pass
+
+    def verify_stream_end(self):
+        """
+        Verify that the image data stream was complete.
+        """
+        if self._parser is not None:
+            self._parser.verify_end()
 
     def _validate_palette_exists_if_necessary(self):
         if (
@@ -312,9 +401,10 @@ class _ImageDataChunkParser(_AbstractIterativeChunkParser):
             raise PNGSyntaxError("Indexed color type but PLTE chunk not found")
 
 
-#@chunk_parsers.register
+@chunk_parsers.register
 class _ImageTrailerChunkParser(_AbstractLimitedLengthChunkParser):
     chunk_type = chunktypes.IMAGE_TRAILER
+    result_attribute = None
     max_data_size = 0
 
     def parse(self):
@@ -324,183 +414,712 @@ class _ImageTrailerChunkParser(_AbstractLimitedLengthChunkParser):
 
 # 4.2. Ancillary chunks
 
+# Printable Latin-1, without non-breaking space
+TEXTUAL_KEYWORD_ALLOWED_BYTES = frozenset(
+    itertools.chain(range(32, 127), range(161, 256)))
+
+
+def _validate_keyword(keyword, code):
+    """
+    Validate a textual chunk keyword (bytes) against the rules in
+    section 4.2.3 of the PNG 1.2 spec, and return it decoded.
+    """
+    if not 0 < len(keyword) < 80:
+        raise PNGSyntaxError("Invalid length for {0} keyword.".format(code))
+    if not TEXTUAL_KEYWORD_ALLOWED_BYTES.issuperset(keyword):
+        raise PNGSyntaxError(
+            "Forbidden character found in {0} keyword.".format(code)
+        )
+    if keyword.startswith(b' ') or keyword.endswith(b' '):
+        raise PNGSyntaxError(
+            "Forbidden leading or trailing space found in {0} keyword.".format(
+                code)
+        )
+    # No consecutive spaces
+    if b'  ' in keyword:
+        raise PNGSyntaxError(
+            "Forbidden consecutive spaces found in {0} keyword.".format(code)
+        )
+    return keyword.decode('latin-1')
+
+
+class _AbstractKeywordHeaderChunkParser(_AbstractIterativeChunkParser):
+    """
+    Abstract parser class for chunks starting with a header made of a
+    keyword, a null separator, and a single field byte (iCCP, zTXt,
+    and sPLT).
+
+    The header is validated as soon as it has arrived, by
+    :meth:`_validate_header_keyword` and :meth:`parse_header_byte`.
+    The data following it is passed to :meth:`parse_body_partial`.
+    """
+    def __init__(self, parse_antecedent):
+        super().__init__(parse_antecedent)
+        self._header = bytearray()
+        self.keyword = None
+        self.header_value = None
+
+    @abc.abstractmethod
+    def parse_header_byte(self, value):
+        """
+        Validate the byte following the keyword's null separator, and
+        return its interpreted value.
+        """
+
+    @abc.abstractmethod
+    def parse_body_partial(self, data):
+        """
+        Process some data bytes following the header.
+        """
+
+    @abc.abstractmethod
+    def verify_body_end(self):
+        """
+        Verify the body is complete and return the chunk model.
+        """
+
+    def parse_partial(self, data):
+        if self._header is not None:
+            data = self._parse_header_partial(data)
+        if data:
+            self.parse_body_partial(data)
+
+    def verify_end(self):
+        if self._header is not None:
+            raise PNGSyntaxError("{0} chunk ended inside the header".format(
+                self.chunk_type.code.decode('ascii')))
+        return self.verify_body_end()
+
+    def _validate_header_keyword(self, keyword):
+        return _validate_keyword(keyword, self.chunk_type.code.decode('ascii'))
+
+    def _parse_header_partial(self, data):
+        """
+        Add data to the header, and validate it once complete.
+
+        Return the data following the header, if any.
+        """
+        self._header += data
+        separator = self._header.find(b'\x00')
+        if separator == -1:
+            if len(self._header) > 79:
+                raise PNGSyntaxError("Invalid length for {0} keyword.".format(
+                    self.chunk_type.code.decode('ascii')))
+            return b''
+        if separator + 1 == len(self._header):
+            # The header byte hasn't arrived yet
+            return b''
+        self.keyword = self._validate_header_keyword(
+            bytes(self._header[:separator]))
+        self.header_value = self.parse_header_byte(
+            self._header[separator + 1])
+        rest = bytes(self._header[separator + 2:])
+        self._header = None
+        return rest
+
+
+class _AbstractCompressedPayloadChunkParser(
+        _AbstractKeywordHeaderChunkParser):
+    """
+    Abstract parser class for chunks made of a keyword, a null
+    separator, a compression method byte, and compressed data (iCCP
+    and zTXt).
+
+    The compressed data is only retained, the chunk model inflates it
+    on access.
+    """
+    def __init__(self, parse_antecedent):
+        super().__init__(parse_antecedent)
+        self._compressed = bytearray()
+
+    @abc.abstractmethod
+    def create_model(self, keyword, compression_method, compressed):
+        """
+        Return the chunk model for the validated header fields and
+        the compressed data (bytes).
+        """
+
+    def parse_header_byte(self, value):
+        try:
+            return fieldvalues.CompressionMethod(value)
+        except ValueError:
+            fmt = "Invalid compression method {value!r} for {code} chunk"
+            raise PNGSyntaxError(fmt.format(
+                value=value, code=self.chunk_type.code.decode('ascii')))
+
+    def parse_body_partial(self, data):
+        self._compressed += data
+
+    def verify_body_end(self):
+        return self.create_model(
+            self.keyword, self.header_value, bytes(self._compressed))
+
+
+def _unpack_uint16_array(data):
+    """
+    Interpret the data as a sequence of big-endian 2-byte unsigned
+    integers, and return them in an ``array('H')``.
+    """
+    values = array.array('H', data)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
 # 4.2.1. Transparency information
 
-#@chunk_parsers.register
+def _unpack_sample_tuple(data):
+    """
+    Interpret the data as a sequence of 2-byte unsigned samples, as
+    used in tRNS and bKGD for non-indexed color types.
+    """
+    return struct.unpack('>{0}H'.format(len(data) // 2), data)
+
+
+# Number of bytes in tRNS and bKGD for non-indexed color types
+_COLOR_TYPE_SAMPLE_DATA_SIZES = MappingProxyType({
+    fieldvalues.ColorType.grayscale: 2,
+    fieldvalues.ColorType.grayscale_alpha: 2,
+    fieldvalues.ColorType.rgb: 6,
+    fieldvalues.ColorType.rgb_alpha: 6,
+})
+
+
+@chunk_parsers.register
 class _TransparencyChunkParser(_AbstractLimitedLengthChunkParser):
     chunk_type = chunktypes.TRANSPARENCY
+    result_attribute = 'transparency'
     max_data_size = 256  # with color type 3, 1 byte for each palette index
-    #TODO
+
+    _PROHIBITED_WITH_COLOR_TYPE = (
+        fieldvalues.ColorType.grayscale_alpha, fieldvalues.ColorType.rgb_alpha
+    )
+
     def parse(self):
-        pass
+        color_type = self.antecedent.image_header.color_type
+        if color_type in self._PROHIBITED_WITH_COLOR_TYPE:
+            fmt = 'tRNS chunk not permitted with color type {color_type}'
+            raise PNGSyntaxError(fmt.format(color_type=color_type))
+        if color_type is fieldvalues.ColorType.indexed:
+            palette = self.antecedent.palette
+            if palette is None:
+                raise PNGSyntaxError("tRNS chunk must come after PLTE")
+            if len(self.data_token) > len(palette.entries):
+                raise PNGSyntaxError(
+                    "tRNS chunk has more entries than the palette"
+                )
+            return models.Transparency(alphas=bytes(self.data_token))
+        self._validate_data_length(_COLOR_TYPE_SAMPLE_DATA_SIZES[color_type])
+        return models.Transparency(
+            color=_unpack_sample_tuple(self.data_token))
 
 
 # 4.2.2. Color space information
 
-#@chunk_parsers.register
+@chunk_parsers.register
 class _ImageGammaChunkParser(_AbstractLimitedLengthChunkParser):
     chunk_type = chunktypes.IMAGE_GAMMA
+    result_attribute = 'image_gamma'
     max_data_size = 4
-    #TODO
+
     def parse(self):
-        pass
+        self._validate_data_length(self.max_data_size)
+        [gamma] = struct.unpack('>I', self.data_token)
+        return models.ImageGamma(gamma)
 
 
-#@chunk_parsers.register
+@chunk_parsers.register
 class _PrimaryChromaticitiesChunkParser(_AbstractLimitedLengthChunkParser):
     chunk_type = chunktypes.PRIMARY_CHROMATICITIES
+    result_attribute = 'primary_chromaticities'
     max_data_size = 32
-    #TODO
+
     def parse(self):
-        pass
+        self._validate_data_length(self.max_data_size)
+        return models.PrimaryChromaticities(
+            *struct.unpack('>8I', self.data_token))
 
 
-#@chunk_parsers.register
+@chunk_parsers.register
 class _StandardRGBColorSpaceChunkParser(_AbstractLimitedLengthChunkParser):
     chunk_type = chunktypes.STANDARD_RGB_COLOR_SPACE
+    result_attribute = 'standard_rgb_color_space'
     max_data_size = 1
-    #TODO
+
     def parse(self):
-        pass
+        self._validate_data_length(self.max_data_size)
+        rendering_intent = self._parse_value_to_enum_member(
+            fieldvalues.RenderingIntent,
+            'rendering intent',
+            self.data_token[0],
+        )
+        return models.StandardRGBColorSpace(rendering_intent)
 
 
-#@chunk_parsers.register
-class _EmbeddedICCProfileChunkParser(_AbstractIterativeChunkParser):
+@chunk_parsers.register
+class _EmbeddedICCProfileChunkParser(_AbstractCompressedPayloadChunkParser):
     chunk_type = chunktypes.EMBEDDED_ICC_PROFILE
-    #TODO
-    def parse_partial(self, data):
-        raise NotImplementedError('not done yet')
-
-    def verify_end(self):
-        raise NotImplementedError('not done yet')
+    result_attribute = 'embedded_icc_profile'
 
+    def create_model(self, keyword, compression_method, compressed):
+        return models.EmbeddedICCProfile(
+            keyword, compression_method, compressed)
 
 
 # 4.2.3. Textual information
 
-# Printable Latin-1, without non-breaking space
-TEXTUAL_KEYWORD_ALLOWED_BYTES = frozenset(
-    itertools.chain(range(32, 127), range(161, 256)))
+class _TextBodyAccumulator:
+    """
+    Collects the text field of a textual chunk as it arrives.
 
+    Once more than ``max_stored_size`` bytes have arrived, the stored
+    data is discarded and only the length and SHA-256 digest of the
+    text field are kept. If ``max_stored_size`` is ``None``, the data
+    is always stored.
 
-# TODO: Update this and register it once the ABC has been defined
-#@chunk_parsers.register
-class _TextualDataParser(_AbstractIterativeChunkParser):
-    chunk_type = chunktypes.TEXTUAL_DATA
+    If ``encoding`` is given, the data is validated incrementally
+    with that codec. If ``null_allowed`` is false, null bytes are
+    rejected.
+
+    :ivar length: The number of bytes received so far
+    """
+    def __init__(self, max_stored_size, encoding=None, null_allowed=True):
+        self.length = 0
+        self._max_stored_size = max_stored_size
+        self._null_allowed = null_allowed
+        self._data = bytearray()
+        self._sha256 = None
+        if encoding is None:
+            self._decoder = None
+        else:
+            self._decoder = codecs.getincrementaldecoder(encoding)()
+
+    def update(self, data):
+        if not self._null_allowed and b'\x00' in data:
+            raise PNGSyntaxError("Forbidden null byte found in text.")
+        self.length += len(data)
+        self._decode(data, final=False)
+        if self._sha256 is not None:
+            self._sha256.update(data)
+            return
+        self._data += data
+        if (
+                self._max_stored_size is not None and
+                len(self._data) > self._max_stored_size
+            ):
+            import hashlib
+            self._sha256 = hashlib.sha256(self._data)
+            self._data = None
+
+    def finish(self):
+        """
+        Return a tuple of the stored data (or ``None``) and the hex
+        SHA-256 digest (or ``None`` if the data was stored).
+        """
+        self._decode(b'', final=True)
+        if self._sha256 is not None:
+            return None, self._sha256.hexdigest()
+        return bytes(self._data), None
+
+    def _decode(self, data, final):
+        if self._decoder is None:
+            return
+        try:
+            self._decoder.decode(data, final)
+        except UnicodeDecodeError as exc:
+            raise PNGSyntaxError("Invalid text encoding: {0}".format(exc))
+
+
+class _AbstractTextualChunkParser(_AbstractIterativeChunkParser):
+    """
+    Abstract parser class for the tEXt and iTXt chunks, implemented
+    as a state machine that validates each field as soon as it is
+    complete.
+
+    The chunk data is a series of header fields, described by
+    :attr:`header_fields`, followed by the text field which runs to
+    the end of the chunk. Only the field currently being read is
+    buffered, so fields may be split anywhere across data parts.
+
+    When each header field completes, the ``_complete_<name>`` method
+    is called with the field's bytes. After the last header field,
+    :meth:`create_text_body` provides the accumulator for the text.
+    """
+    option_names = ('max_stored_text_size',)
+
+    def __init__(self, parse_antecedent, max_stored_text_size=None):
+        super().__init__(parse_antecedent)
+        self.max_stored_text_size = max_stored_text_size
+        self._field_index = 0
+        self._field = bytearray()
+        self._text_body = None
+
+    @abc.abstractproperty
+    def header_fields(self):
+        """
+        A sequence of (name, size) tuples, one for each header field.
+        A size of ``None`` means the field is null-terminated,
+        otherwise the field is exactly that many bytes.
+        """
+
+    @abc.abstractmethod
+    def create_text_body(self):
+        """
+        Return the :class:`_TextBodyAccumulator` for the text field.
+        """
+
+    @abc.abstractmethod
+    def create_model(self, text, text_length, text_sha256):
+        """
+        Return the chunk model given the stored text field bytes (or
+        ``None``), the text field length, and its digest (or ``None``).
+        """
 
     def parse_partial(self, data):
-        # This method is broken, but the current code demonstrates the basic
-        # validation needed for the keyword.
-        # TODO: Deal with the data in parts, probably with a simple state
-        # machine. The first chunk of data we get should have the keyword,
-        # since it can only be 79 bytes long.
-        # TODO: add validation for rules in Textual Information, section 4.2.3
-        # of the PNG 1.2 spec.
-        components = data.split(b'\x00')
-        if len(components) > 2:
-            raise PNGSyntaxError(
-                "Too many null bytes found in tEXt data."
-            )
-        if len(components) < 2:
-            raise PNGSyntaxError("No null byte found in tEXt data.")
-        keyword, text = components
-        if not 0 < len(keyword) < 80:
-            raise PNGSyntaxError("Invalid length for tEXt keyword.")
-        if keyword.startswith(b' ') or keyword.endswith(b' '):
-            raise PNGSyntaxError(
-                "Forbidden leading or trailing space found in tEXt keyword."
-            )
-        # No consecutive spaces
-        if b'  ' in keyword:
-            raise PNGSyntaxError(
-                "Forbidden consecutive spaces found in tEXt keyword."
-            )
-        keyword = keyword.decode('latin-1')
-        text = text.decode('latin-1')
+        position = 0
+        while self._text_body is None and position < len(data):
+            position = self._parse_header_field(data, position)
+        if position < len(data):
+            self._text_body.update(data[position:] if position else data)
 
     def verify_end(self):
-        raise NotImplementedError('not done yet')
+        if self._text_body is None:
+            fmt = "{code} chunk ended while reading the {name} field"
+            raise PNGSyntaxError(fmt.format(
+                code=self.chunk_type.code.decode('ascii'),
+                name=self.header_fields[self._field_index][0],
+            ))
+        text, text_sha256 = self._text_body.finish()
+        return self.create_model(text, self._text_body.length, text_sha256)
 
+    def _parse_header_field(self, data, position):
+        """
+        Consume data for the current header field starting at
+        ``position``, and return the position after the consumed data.
+        """
+        name, size = self.header_fields[self._field_index]
+        if size is None:
+            end = data.find(b'\x00', position)
+            if end == -1:
+                self._field += data[position:]
+                self._check_field_length(name)
+                return len(data)
+            next_position = end + 1
+        else:
+            end = next_position = min(
+                len(data), position + size - len(self._field))
+        self._field += data[position:end]
+        self._check_field_length(name)
+        if size is not None and len(self._field) < size:
+            return next_position
+        getattr(self, '_complete_' + name)(bytes(self._field))
+        self._field = bytearray()
+        self._field_index += 1
+        if self._field_index == len(self.header_fields):
+            self._text_body = self.create_text_body()
+        return next_position
+
+    def _check_field_length(self, name):
+        # Keywords are the only fields with a maximum length
+        if name == 'keyword' and len(self._field) > 79:
+            raise PNGSyntaxError("Invalid length for {0} keyword.".format(
+                self.chunk_type.code.decode('ascii')))
 
 
-#@chunk_parsers.register
-class _CompressedTextualDataChunkParser(_AbstractIterativeChunkParser):
-    chunk_type = chunktypes.COMPRESSED_TEXTUAL_DATA
-    #TODO
-    def parse_partial(self, data):
-        raise NotImplementedError('not done yet')
+@chunk_parsers.register
+class _TextualDataParser(_AbstractTextualChunkParser):
+    chunk_type = chunktypes.TEXTUAL_DATA
+    result_attribute = 'textual_data'
+    header_fields = (('keyword', None),)
+
+    def __init__(self, parse_antecedent, max_stored_text_size=None):
+        super().__init__(parse_antecedent, max_stored_text_size)
+        self._keyword = None
+
+    def create_text_body(self):
+        return _TextBodyAccumulator(
+            self.max_stored_text_size, null_allowed=False)
+
+    def create_model(self, text, text_length, text_sha256):
+        if text is not None:
+            text = text.decode('latin-1')
+        return models.TextualData(
+            self._keyword, text, text_length, text_sha256)
+
+    def _complete_keyword(self, value):
+        self._keyword = _validate_keyword(value, 'tEXt')
 
     def verify_end(self):
-        raise NotImplementedError('not done yet')
+        if self._text_body is None:
+            raise PNGSyntaxError("No null byte found in tEXt data.")
+        return super().verify_end()
+
+
+@chunk_parsers.register
+class _CompressedTextualDataChunkParser(
+        _AbstractCompressedPayloadChunkParser):
+    chunk_type = chunktypes.COMPRESSED_TEXTUAL_DATA
+    result_attribute = 'compressed_textual_data'
 
+    def create_model(self, keyword, compression_method, compressed):
+        return models.CompressedTextualData(
+            keyword, compression_method, compressed)
 
 
-#@chunk_parsers.register
-class _InternationalTextualDataChunkParser(_AbstractIterativeChunkParser):
+# Language tags are ASCII letters and digits, separated by hyphens
+_LANGUAGE_TAG_ALLOWED_BYTES = frozenset(
+    b'-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz')
+
+
+@chunk_parsers.register
+class _InternationalTextualDataChunkParser(_AbstractTextualChunkParser):
     chunk_type = chunktypes.INTERNATIONAL_TEXTUAL_DATA
-    #TODO
-    def parse_partial(self, data):
-        raise NotImplementedError('not done yet')
+    result_attribute = 'international_textual_data'
+    header_fields = (
+        ('keyword', None),
+        # Compression flag and compression method
+        ('compression', 2),
+        ('language_tag', None),
+        ('translated_keyword', None),
+    )
 
-    def verify_end(self):
-        raise NotImplementedError('not done yet')
+    def __init__(self, parse_antecedent, max_stored_text_size=None):
+        super().__init__(parse_antecedent, max_stored_text_size)
+        self._keyword = None
+        self._compression_method = None
+        self._language_tag = None
+        self._translated_keyword = None
+
+    def create_text_body(self):
+        if self._compression_method is None:
+            return _TextBodyAccumulator(self.max_stored_text_size, 'utf-8')
+        # Compressed text is validated when it is inflated
+        return _TextBodyAccumulator(self.max_stored_text_size)
+
+    def create_model(self, text, text_length, text_sha256):
+        return models.InternationalTextualData(
+            self._keyword,
+            self._compression_method,
+            self._language_tag,
+            self._translated_keyword,
+            text,
+            text_length,
+            text_sha256,
+        )
 
+    def _complete_keyword(self, value):
+        self._keyword = _validate_keyword(value, 'iTXt')
+
+    def _complete_compression(self, value):
+        compression_flag, compression_method = value
+        if compression_flag not in (0, 1):
+            raise PNGSyntaxError(
+                "Invalid compression flag {0!r} for iTXt chunk".format(
+                    compression_flag)
+            )
+        if compression_flag == 0:
+            return
+        try:
+            self._compression_method = fieldvalues.CompressionMethod(
+                compression_method)
+        except ValueError:
+            raise PNGSyntaxError(
+                "Invalid compression method {0!r} for iTXt chunk".format(
+                    compression_method)
+            )
+
+    def _complete_language_tag(self, value):
+        if not _LANGUAGE_TAG_ALLOWED_BYTES.issuperset(value):
+            raise PNGSyntaxError("Invalid iTXt language tag.")
+        self._language_tag = value.decode('ascii')
+
+    def _complete_translated_keyword(self, value):
+        try:
+            self._translated_keyword = value.decode('utf-8')
+        except UnicodeDecodeError:
+            raise PNGSyntaxError("Invalid iTXt translated keyword encoding.")
 
 
 # 4.3.4. Miscellaneous information
 
-#@chunk_parsers.register
+@chunk_parsers.register
 class _BackgroundColorChunkParser(_AbstractLimitedLengthChunkParser):
     chunk_type = chunktypes.BACKGROUND_COLOR
+    result_attribute = 'background_color'
     max_data_size = 6  # with color types 2 and 6
-    #TODO
+
     def parse(self):
-        pass
+        color_type = self.antecedent.image_header.color_type
+        if color_type is fieldvalues.ColorType.indexed:
+            self._validate_data_length(1)
+            palette = self.antecedent.palette
+            if palette is None:
+                raise PNGSyntaxError("bKGD chunk must come after PLTE")
+            palette_index = self.data_token[0]
+            if palette_index >= len(palette.entries):
+                raise PNGSyntaxError(
+                    "bKGD palette index {0} out of range".format(
+                        palette_index)
+                )
+            return models.BackgroundColor(palette_index=palette_index)
+        self._validate_data_length(_COLOR_TYPE_SAMPLE_DATA_SIZES[color_type])
+        return models.BackgroundColor(
+            color=_unpack_sample_tuple(self.data_token))
 
 
-#@chunk_parsers.register
+@chunk_parsers.register
 class _PhysicalPixelDimensionsChunkParser(_AbstractLimitedLengthChunkParser):
     chunk_type = chunktypes.PHYSICAL_PIXEL_DIMENSIONS
+    result_attribute = 'physical_pixel_dimensions'
     max_data_size = 9
-    #TODO
+
     def parse(self):
-        pass
+        self._validate_data_length(self.max_data_size)
+        per_unit_x, per_unit_y, unit = struct.unpack('>IIB', self.data_token)
+        unit = self._parse_value_to_enum_member(
+            fieldvalues.PhysicalUnit, 'unit specifier', unit)
+        return models.PhysicalPixelDimensions(per_unit_x, per_unit_y, unit)
 
 
-#@chunk_parsers.register
+@chunk_parsers.register
 class _SignificantBitsChunkParser(_AbstractLimitedLengthChunkParser):
     chunk_type = chunktypes.SIGNIFICANT_BITS
+    result_attribute = 'significant_bits'
     max_data_size = 4
-    #TODO
+
+    _COLOR_TYPE_DATA_SIZES = MappingProxyType({
+        fieldvalues.ColorType.grayscale: 1,
+        fieldvalues.ColorType.rgb: 3,
+        fieldvalues.ColorType.indexed: 3,
+        fieldvalues.ColorType.grayscale_alpha: 2,
+        fieldvalues.ColorType.rgb_alpha: 4,
+    })
+
     def parse(self):
-        pass
+        header = self.antecedent.image_header
+        self._validate_data_length(
+            self._COLOR_TYPE_DATA_SIZES[header.color_type])
+        if header.color_type is fieldvalues.ColorType.indexed:
+            sample_depth = 8
+        else:
+            sample_depth = header.bit_depth
+        bits = tuple(self.data_token)
+        if not all(0 < value <= sample_depth for value in bits):
+            fmt = "sBIT values {bits} invalid for sample depth {depth}"
+            raise PNGSyntaxError(fmt.format(bits=bits, depth=sample_depth))
+        return models.SignificantBits(bits)
 
 
-#@chunk_parsers.register
-class _SuggestedPaletteChunkParser(_AbstractIterativeChunkParser):
+@chunk_parsers.register
+class _SuggestedPaletteChunkParser(_AbstractKeywordHeaderChunkParser):
+    """
+    Parser for sPLT, which can hold thousands of entries.
+
+    The entries are decoded in bulk into one array per column rather
+    than one object per entry. Entries may be split across data parts.
+    """
     chunk_type = chunktypes.SUGGESTED_PALETTE
-    #TODO
-    def parse_partial(self, data):
-        raise NotImplementedError('not done yet')
+    result_attribute = 'suggested_palettes'
 
-    def verify_end(self):
-        raise NotImplementedError('not done yet')
+    # Entry sizes for each sample depth: red, green, blue and alpha
+    # samples of the sample depth, then a 2 byte frequency
+    _ENTRY_SIZES = MappingProxyType({8: 6, 16: 10})
 
+    def __init__(self, parse_antecedent):
+        super().__init__(parse_antecedent)
+        self._partial_entry = b''
+        self._samples = None
+        self._frequencies = array.array('H')
 
+    def parse_header_byte(self, value):
+        if value not in self._ENTRY_SIZES:
+            raise PNGSyntaxError(
+                "Invalid sPLT sample depth {0!r}".format(value)
+            )
+        typecode = 'B' if value == 8 else 'H'
+        self._samples = tuple(array.array(typecode) for _ in range(4))
+        return value
+
+    def _validate_header_keyword(self, keyword):
+        name = super()._validate_header_keyword(keyword)
+        for palette in self.antecedent.suggested_palettes:
+            if palette.name == name:
+                raise PNGSyntaxError(
+                    "Duplicate sPLT palette name {0!r}".format(name)
+                )
+        return name
+
+    def parse_body_partial(self, data):
+        entry_size = self._ENTRY_SIZES[self.header_value]
+        if self._partial_entry:
+            data = self._partial_entry + data
+        complete_length = len(data) - len(data) % entry_size
+        self._partial_entry = data[complete_length:]
+        if complete_length:
+            self._add_entries(data[:complete_length])
+
+    def verify_body_end(self):
+        if self._partial_entry:
+            raise PNGSyntaxError(
+                "sPLT data length is not a multiple of the entry size"
+            )
+        red, green, blue, alpha = self._samples
+        return models.SuggestedPalette(
+            self.keyword, self.header_value,
+            red, green, blue, alpha, self._frequencies,
+        )
 
-#@chunk_parsers.register
+    def _add_entries(self, data):
+        if self.header_value == 8:
+            for column, offset in zip(self._samples, range(4)):
+                column.frombytes(data[offset::6])
+            # Interleave the high and low frequency bytes
+            frequencies = bytearray(len(data) // 3)
+            frequencies[0::2] = data[4::6]
+            frequencies[1::2] = data[5::6]
+            self._frequencies.extend(_unpack_uint16_array(frequencies))
+        else:
+            values = _unpack_uint16_array(data)
+            for column, offset in zip(self._samples, range(4)):
+                column.extend(values[offset::5])
+            self._frequencies.extend(values[4::5])
+
+
+@chunk_parsers.register
 class _PaletteHistogramChunkParser(_AbstractLimitedLengthChunkParser):
     chunk_type = chunktypes.PALETTE_HISTOGRAM
+    result_attribute = 'palette_histogram'
     max_data_size = 512
-    #TODO
+
     def parse(self):
-        pass
+        palette = self.antecedent.palette
+        if palette is None:
+            raise PNGSyntaxError("hIST chunk must come after PLTE")
+        self._validate_data_length(2 * len(palette.entries))
+        return models.PaletteHistogram(_unpack_uint16_array(self.data_token))
 
 
-#@chunk_parsers.register
+@chunk_parsers.register
 class _ImageLastModificationTimeChunkParser(_AbstractLimitedLengthChunkParser):
     chunk_type = chunktypes.IMAGE_LAST_MODIFICATION_TIME
+    result_attribute = 'image_last_modification_time'
     max_data_size = 7
-    #TODO
+
+    # Inclusive ranges for month, day, hour, minute, second (the last
+    # allows for leap seconds)
+    _FIELD_RANGES = (
+        ('month', 1, 12),
+        ('day', 1, 31),
+        ('hour', 0, 23),
+        ('minute', 0, 59),
+        ('second', 0, 60),
+    )
+
     def parse(self):
-        pass
+        self._validate_data_length(self.max_data_size)
+        fields = struct.unpack('>HBBBBB', self.data_token)
+        for (name, low, high), value in zip(self._FIELD_RANGES, fields[1:]):
+            if not low <= value <= high:
+                fmt = "Invalid tIME {name} {value}"
+                raise PNGSyntaxError(fmt.format(name=name, value=value))
+        return models.ImageLastModificationTime(*fields)
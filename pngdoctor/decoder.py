@@ -0,0 +1,1167 @@
+"""
+Decoding the pixels of PNG images.
+
+Decoded pixels have their samples in stream order, one byte per sample
+at bit depths up to 8 and two big-endian bytes per sample at bit depth
+16. Sample values are not scaled and palette indexes are not looked up.
+"""
+import array
+import bisect
+import functools
+import itertools
+import math
+import struct
+import sys
+import zlib
+
+import attr
+
+from pngdoctor import chunktypes
+from pngdoctor import deflate
+from pngdoctor import exceptions
+from pngdoctor import fieldvalues
+from pngdoctor import models
+from pngdoctor.image_data_parser import (
+    ImageDataStreamParser, _ADAM7_PASS_GEOMETRY, _SAMPLES_PER_PIXEL,
+    _AdaptiveFiveBasicSubimageUnfilterer, _Deflate32KDecompressor,
+    _calculate_subimage_scanlines
+)
+from pngdoctor.parser import PNGParser, ParseMode
+
+
+def _unpack_table(bit_depth):
+    """
+    Return a list mapping each byte value to the bytes of the samples
+    packed in it at ``bit_depth`` (1, 2 or 4), one byte per sample.
+    """
+    mask = 2**bit_depth - 1
+    shifts = range(8 - bit_depth, -1, -bit_depth)
+    return [
+        bytes((value >> shift) & mask for shift in shifts)
+        for value in range(256)
+    ]
+
+
+_UNPACK_TABLES = {
+    bit_depth: _unpack_table(bit_depth) for bit_depth in (1, 2, 4)
+}
+
+
+class _ColumnExtractor:
+    """
+    Extracts the pixels in a range of columns from unfiltered
+    scanlines, and unpacks their samples.
+
+    Only the bytes holding those pixels are unpacked.
+    """
+    def __init__(self, color_type, bit_depth, start, stop):
+        """
+        :param start: The first column extracted
+        :param stop: The column after the last one extracted
+        """
+        bits_per_pixel = _SAMPLES_PER_PIXEL[color_type] * bit_depth
+        self._slice = slice(
+            start * bits_per_pixel // 8,
+            -(-stop * bits_per_pixel // 8),
+        )
+        if bit_depth < 8:
+            # Sub-byte depths only exist with a single sample per pixel
+            self._table = _UNPACK_TABLES[bit_depth]
+            first = start * bit_depth % 8 // bit_depth
+            self._unpacked_slice = slice(first, first + stop - start)
+        else:
+            self._table = None
+
+    def extract(self, scanline):
+        """
+        Return the unpacked samples of the columns in ``scanline``.
+        """
+        packed = scanline[self._slice]
+        if self._table is None:
+            return bytes(packed)
+        return b''.join(map(self._table.__getitem__, packed))[
+            self._unpacked_slice]
+
+
+def _subimage_geometry(image_header):
+    """
+    Return a list of (first column, column step, first row, row step,
+    width, height) tuples for each subimage that contains any pixels,
+    in stream order.
+    """
+    width, height = image_header.width, image_header.height
+    if image_header.interlace_method is fieldvalues.InterlaceMethod.none:
+        return [(0, 1, 0, 1, width, height)]
+    geometry = []
+    for first_column, column_step, first_row, row_step in (
+            _ADAM7_PASS_GEOMETRY):
+        subimage_width = len(range(first_column, width, column_step))
+        subimage_height = len(range(first_row, height, row_step))
+        if subimage_width and subimage_height:
+            geometry.append((
+                first_column, column_step, first_row, row_step,
+                subimage_width, subimage_height,
+            ))
+    return geometry
+
+
+def _index_range(first, step, count, start, stop):
+    """
+    Return the range of indexes ``i`` of the ``count`` positions
+    ``first + i * step`` that are within ``start`` to ``stop``.
+    """
+    return range(
+        min(count, max(0, -(-(start - first) // step))),
+        min(count, max(0, -(-(stop - first) // step))),
+    )
+
+
+class _ImageData:
+    """
+    The image header and the unfiltered scanlines of a PNG stream.
+
+    The chunks before the image data are parsed on creation. The image
+    data is only read and inflated as the scanlines are iterated over,
+    and the rest of the stream by :meth:`finish`.
+
+    :ivar header: The :class:`models.ImageHeader`
+    :ivar subimages: The :func:`_subimage_geometry` of the image
+    """
+    def __init__(self, stream):
+        self._parser = PNGParser(stream, mode=ParseMode.image_data)
+        self._data = self._parser.iter_image_data()
+        self._first = next(self._data, b'')
+        self.header = self._parser.result.image_header
+        self.subimages = _subimage_geometry(self.header)
+        self._image_data_parser = ImageDataStreamParser.from_image_header(
+            self.header)
+
+    def iter_scanlines(self):
+        """
+        Yield a tuple of (subimage index, row number within the
+        subimage, unfiltered scanline bytes) for each scanline, like
+        :meth:`image_data_parser.ImageDataStreamParser.iter_scanlines`.
+
+        The data is read and inflated only as far as the scanlines are
+        consumed.
+        """
+        parser = self._image_data_parser
+        for data in itertools.chain([self._first], self._data):
+            yield from parser.iter_scanlines(data)
+            if parser.finished:
+                return
+
+    def finish(self):
+        """
+        Read and validate the rest of the stream, after every scanline
+        was produced.
+        """
+        for data in self._data:
+            for _ in self._image_data_parser.iter_scanlines(data):
+                pass
+        self._image_data_parser.verify_end()
+
+    def close(self):
+        """
+        Stop parsing, leaving the rest of the stream unread.
+        """
+        self._data.close()
+
+
+def _check_box(box, image_header):
+    left, top, right, bottom = box
+    if not (0 <= left < right <= image_header.width and
+            0 <= top < bottom <= image_header.height):
+        raise ValueError(
+            "Box {0} is not a non-empty part of the {1}x{2} image".format(
+                box, image_header.width, image_header.height))
+    return left, top, right, bottom
+
+
+def _pixel_size(image_header):
+    """
+    Return the number of bytes of a decoded pixel.
+    """
+    return _SAMPLES_PER_PIXEL[image_header.color_type] * (
+        2 if image_header.bit_depth == 16 else 1)
+
+
+class _SubimagePlacement:
+    """
+    Copies the decoded pixels of a subimage that are inside a box to
+    their place in an output buffer.
+
+    :ivar rows: The range of subimage rows inside the box
+    """
+    def __init__(self, image_header, geometry, box, stride):
+        """
+        :param geometry: The :func:`_subimage_geometry` of the subimage
+        :param box: The (left, top, right, bottom) box
+        :param stride:
+            The distance in bytes between the starts of two rows of the
+            box in the output buffer
+        """
+        (first_column, column_step, first_row, row_step, width,
+         height) = geometry
+        left, top, right, bottom = box
+        columns = _index_range(first_column, column_step, width, left, right)
+        self.rows = _index_range(first_row, row_step, height, top, bottom)
+        if not columns:
+            self.rows = range(0)
+        self._extractor = _ColumnExtractor(
+            image_header.color_type, image_header.bit_depth,
+            columns.start, columns.stop)
+        self._pixel_size = _pixel_size(image_header)
+        self._column_offset = (
+            first_column + columns.start * column_step - left
+        ) * self._pixel_size
+        self._step = column_step * self._pixel_size
+        self._span = (len(columns) - 1) * self._step + 1
+        self._first_row_offset = (first_row - top) * stride
+        self._row_stride = row_step * stride
+
+    def place(self, row, scanline, output):
+        """
+        Copy the pixels of the subimage ``row`` in the box from its
+        unfiltered ``scanline`` to the byte memoryview ``output``.
+        """
+        pixels = self._extractor.extract(scanline)
+        start = (
+            self._first_row_offset + row * self._row_stride +
+            self._column_offset
+        )
+        pixel_size = self._pixel_size
+        if self._step == pixel_size:
+            output[start:start + len(pixels)] = pixels
+            return
+        stop = start + self._span
+        for sample in range(pixel_size):
+            output[start + sample:stop + sample:self._step] = (
+                pixels[sample::pixel_size])
+
+
+def decode_region(stream, box=None):
+    """
+    Decode the pixels of the PNG image in the binary ``stream`` that
+    are inside ``box``, a (left, top, right, bottom) tuple of pixel
+    coordinates, with right and bottom excluded. Without a box, every
+    pixel is decoded.
+
+    Return a list with the decoded pixels of each row of the box, as
+    bytes. Only the bytes of the columns inside the box are unpacked.
+    The image data is inflated only up to the last row needed, which
+    for interlaced images is in the last Adam7 pass that has pixels
+    in the box, and the rest of the stream is then left unread. If
+    the whole image data is needed, the rest of the stream is parsed
+    and validated as well.
+
+    Raise :exc:`ValueError` if the box isn't inside the image, and
+    :exc:`exceptions.DecodeError` if the stream is invalid.
+    """
+    image = _ImageData(stream)
+    try:
+        header = image.header
+        if box is None:
+            box = (0, 0, header.width, header.height)
+        return _decode_region(image, box)
+    finally:
+        image.close()
+
+
+def decode_into(stream, buffer, stride=None, box=None):
+    """
+    Decode the pixels of the PNG image in the binary ``stream`` that
+    are inside ``box`` straight into ``buffer``, and return the
+    :class:`models.ImageHeader` of the image.
+
+    ``buffer`` is any C-contiguous writable object supporting the
+    buffer protocol, such as a :class:`bytearray`, a :class:`mmap.mmap`
+    or a NumPy array, whose bytes receive the decoded pixels of each
+    row of the box in turn, ``stride`` bytes apart (by default the
+    size of a decoded row of the box). The bytes between rows are left
+    as they are. The box and the reading of the stream are as for
+    :func:`decode_region`.
+
+    Raise :exc:`TypeError` if ``buffer`` isn't writable or contiguous,
+    :exc:`ValueError` if the box isn't inside the image or the rows
+    don't fit in ``buffer``, and :exc:`exceptions.DecodeError` if the
+    stream is invalid.
+    """
+    with memoryview(buffer) as view:
+        if view.readonly:
+            raise TypeError("Cannot decode into a read-only buffer")
+        # Released on exit, so that a mmap can be closed afterwards
+        with view.cast('B') as output:
+            image = _ImageData(stream)
+            try:
+                header = image.header
+                if box is None:
+                    box = (0, 0, header.width, header.height)
+                _decode_into_view(image, box, output, stride)
+                return header
+            finally:
+                image.close()
+
+
+def decode_image(stream, box=None):
+    """
+    Decode the pixels of the PNG image in the binary ``stream`` that
+    are inside ``box`` as :func:`decode_region` does, and return them
+    as a :class:`models.DecodedImage` with a single bytearray buffer.
+    """
+    image = _ImageData(stream)
+    try:
+        header = image.header
+        if box is None:
+            box = (0, 0, header.width, header.height)
+        return _decode_image(image, box)
+    finally:
+        image.close()
+
+
+def decode_rows(stream, start, stop=None):
+    """
+    Decode the rows ``start`` up to ``stop`` (excluded, or the end of
+    the image if ``None``) of the PNG image in ``stream``, as
+    :func:`decode_region` does.
+    """
+    image = _ImageData(stream)
+    try:
+        header = image.header
+        if stop is None:
+            stop = header.height
+        return _decode_region(image, (0, start, header.width, stop))
+    finally:
+        image.close()
+
+
+def _decode_region(image, box):
+    decoded = _decode_image(image, box)
+    return [bytes(decoded.row(index)) for index in range(decoded.height)]
+
+
+def _decode_image(image, box):
+    header = image.header
+    left, top, right, bottom = _check_box(box, header)
+    row_size = (right - left) * _pixel_size(header)
+    pixels = bytearray(row_size * (bottom - top))
+    _decode_into(image, box, memoryview(pixels), row_size)
+    return models.DecodedImage(
+        pixels, right - left, bottom - top,
+        _SAMPLES_PER_PIXEL[header.color_type], header.bit_depth, row_size)
+
+
+def _decode_into(image, box, output, stride, subimage_count=None):
+    """
+    Decode the pixels of ``image`` inside ``box`` into the byte
+    memoryview ``output``, with ``stride`` bytes between the starts of
+    two rows. Only the first ``subimage_count`` subimages are decoded,
+    or all of them if ``None``.
+    """
+    placements = {}
+    for index, geometry in enumerate(image.subimages[:subimage_count]):
+        placement = _SubimagePlacement(image.header, geometry, box, stride)
+        if placement.rows:
+            placements[index] = placement
+    last = max(placements)
+    last_row = placements[last].rows[-1]
+    # Reading stops after the last row needed, unless that is the last
+    # row of the image data, which is then read to its end
+    whole = last == len(image.subimages) - 1 and (
+        last_row == image.subimages[last][5] - 1)
+
+    for index, row, scanline in image.iter_scanlines():
+        placement = placements.get(index)
+        if placement is not None and row in placement.rows:
+            placement.place(row, scanline, output)
+            if index == last and row == last_row and not whole:
+                return
+    if whole:
+        image.finish()
+
+
+def _decode_into_view(image, box, output, stride):
+    left, top, right, bottom = _check_box(box, image.header)
+    row_size = (right - left) * _pixel_size(image.header)
+    if stride is None:
+        stride = row_size
+    if stride < row_size:
+        raise ValueError(
+            "Stride {0} is less than the {1} bytes of a row".format(
+                stride, row_size))
+    size = (bottom - top - 1) * stride + row_size
+    if len(output) < size:
+        raise ValueError(
+            "Buffer of {0} bytes is too small for the {1} bytes "
+            "needed".format(len(output), size))
+    _decode_into(image, box, output, stride)
+
+
+def decode_preview(stream, passes=1):
+    """
+    Decode a coarse preview of the Adam7 interlaced PNG image in the
+    binary ``stream`` from its first ``passes`` passes (1 to 7).
+
+    The pixels of those passes lie on a grid, 8 by 8 pixels apart
+    after the first pass and 1 by 1 after all seven. Every pixel of
+    the preview is a copy of the grid pixel at the top left corner of
+    its grid cell. Return a list with the decoded pixels of each row,
+    as bytes, like :func:`decode_region`. The image data is inflated
+    only up to the end of the last pass used, and the rest of the
+    stream is then left unread unless that is the end of the image
+    data.
+
+    Raise :exc:`ValueError` if the image isn't interlaced or
+    ``passes`` is out of range, and :exc:`exceptions.DecodeError` if
+    the stream is invalid.
+    """
+    if not 1 <= passes <= len(_ADAM7_PASS_GEOMETRY):
+        raise ValueError("There are {0} Adam7 passes, not {1}".format(
+            len(_ADAM7_PASS_GEOMETRY), passes))
+    image = _ImageData(stream)
+    try:
+        header = image.header
+        if header.interlace_method is not fieldvalues.InterlaceMethod.adam7:
+            raise ValueError("Only interlaced images have a preview")
+        return _decode_preview(image, _ADAM7_PASS_GEOMETRY[:passes])
+    finally:
+        image.close()
+
+
+def _decode_preview(image, passes):
+    header = image.header
+    pixel_size = _pixel_size(header)
+    row_size = header.width * pixel_size
+    pixels = bytearray(row_size * header.height)
+    output = memoryview(pixels)
+    subimage_count = len([
+        geometry for geometry in image.subimages if geometry[:4] in passes
+    ])
+    _decode_into(
+        image, (0, 0, header.width, header.height), output, row_size,
+        subimage_count)
+
+    # The spacing of the grid of the pixels decoded
+    column_step = functools.reduce(
+        math.gcd, [value for geometry in passes for value in geometry[:2]])
+    row_step = functools.reduce(
+        math.gcd, [value for geometry in passes for value in geometry[2:]])
+    cell_size = column_step * pixel_size
+    rows = []
+    for start in range(0, len(pixels), row_size * row_step):
+        row = output[start:start + row_size]
+        for column in range(1, min(column_step, header.width)):
+            # Copy each grid pixel to the column of the cell
+            offset = column * pixel_size
+            count = len(range(offset, row_size, cell_size))
+            for sample in range(pixel_size):
+                row[offset + sample::cell_size] = (
+                    row[sample::cell_size][:count])
+        rows.extend([bytes(row)] * min(
+            row_step, header.height - len(rows)))
+    return rows
+
+
+class _Decimator:
+    """
+    Extracts every Nth pixel from unfiltered scanlines, starting with
+    the first one, and unpacks only their samples.
+    """
+    def __init__(self, image_header, factor):
+        bit_depth = image_header.bit_depth
+        self._pixel_size = _pixel_size(image_header)
+        self._step = factor * self._pixel_size
+        if bit_depth < 8:
+            # Sub-byte depths only exist with a single sample per pixel
+            self._mask = 2**bit_depth - 1
+            self._positions = [
+                (bit // 8, 8 - bit_depth - bit % 8)
+                for bit in range(
+                    0, image_header.width * bit_depth, factor * bit_depth)
+            ]
+        else:
+            self._positions = None
+            self._length = len(range(0, image_header.width, factor)) * (
+                self._pixel_size)
+
+    def extract(self, scanline):
+        """
+        Return the unpacked samples of the pixels of ``scanline`` that
+        are kept.
+        """
+        if self._positions is not None:
+            mask = self._mask
+            return bytes(
+                (scanline[index] >> shift) & mask
+                for index, shift in self._positions
+            )
+        pixels = bytearray(self._length)
+        pixel_size = self._pixel_size
+        for sample in range(pixel_size):
+            pixels[sample::pixel_size] = scanline[sample::self._step]
+        return pixels
+
+
+class _BoxAverager:
+    """
+    Adds up the samples of the pixels of unfiltered scanlines in boxes
+    of N by N pixels, and averages them.
+    """
+    def __init__(self, image_header, factor):
+        self._extractor = _ColumnExtractor(
+            image_header.color_type, image_header.bit_depth, 0,
+            image_header.width)
+        self._wide = image_header.bit_depth == 16
+        self._channels = _SAMPLES_PER_PIXEL[image_header.color_type]
+        self._width = image_header.width
+        self._factor = factor
+        self._sums = [0] * (
+            len(range(0, self._width, factor)) * self._channels)
+        self._rows = 0
+
+    def add(self, scanline):
+        """
+        Add the samples of the unfiltered ``scanline`` to the boxes.
+        """
+        samples = self._extractor.extract(scanline)
+        if self._wide:
+            samples = _big_endian_samples(samples)
+        channels = self._channels
+        step = self._factor * channels
+        sums = self._sums
+        for index, start in enumerate(range(0, len(samples), step)):
+            for sample in range(channels):
+                sums[index * channels + sample] += sum(
+                    samples[start + sample:start + step:channels])
+        self._rows += 1
+
+    def average(self):
+        """
+        Return the samples of the average pixel of each box, encoded
+        like decoded pixels, and start new boxes.
+        """
+        channels = self._channels
+        factor = self._factor
+        averages = []
+        for index, total in enumerate(self._sums):
+            column = index // channels * factor
+            count = self._rows * (min(column + factor, self._width) - column)
+            averages.append((total + count // 2) // count)
+        self._sums = [0] * len(self._sums)
+        self._rows = 0
+        if self._wide:
+            return struct.pack('>{0}H'.format(len(averages)), *averages)
+        return bytes(averages)
+
+
+def _big_endian_samples(data):
+    values = array.array('H', data)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def decode_thumbnail(stream, max_side, average=False):
+    """
+    Decode a thumbnail of the non-interlaced PNG image in the binary
+    ``stream``, at most ``max_side`` pixels wide and high.
+
+    The image is scaled down by the smallest whole factor N that fits
+    it in ``max_side``. Every scanline is unfiltered, since the filters
+    of a scanline refer to the one before, but only every Nth pixel of
+    every Nth row is unpacked and kept, starting with the first. If
+    ``average`` is true, each thumbnail pixel is instead the rounded
+    average of the box of N by N pixels it stands for, which is slower
+    and isn't possible for palette indexes. Only the thumbnail and the
+    sums of a row of boxes are held in memory.
+
+    Return a list with the decoded pixels of each row of the
+    thumbnail, as bytes, like :func:`decode_region`. Raise
+    :exc:`ValueError` if ``max_side`` is less than 1 or the image is
+    interlaced (:func:`decode_preview` makes cheap previews of those),
+    and :exc:`exceptions.DecodeError` if the stream is invalid.
+    """
+    if max_side < 1:
+        raise ValueError("Thumbnails must be at least 1 pixel wide")
+    image = _ImageData(stream)
+    try:
+        header = image.header
+        if header.interlace_method is not fieldvalues.InterlaceMethod.none:
+            raise ValueError("Only non-interlaced images have thumbnails")
+        if average and header.color_type is fieldvalues.ColorType.indexed:
+            raise ValueError("Palette indexes can't be averaged")
+        factor = -(-max(header.width, header.height) // max_side)
+        return _decode_thumbnail(image, factor, average)
+    finally:
+        image.close()
+
+
+def _decode_thumbnail(image, factor, average):
+    header = image.header
+    height = len(range(0, header.height, factor))
+    row_size = len(range(0, header.width, factor)) * _pixel_size(header)
+    pixels = bytearray(row_size * height)
+    if average:
+        averager = _BoxAverager(header, factor)
+        for _, row, scanline in image.iter_scanlines():
+            averager.add(scanline)
+            if row % factor == factor - 1 or row == header.height - 1:
+                start = row // factor * row_size
+                pixels[start:start + row_size] = averager.average()
+        image.finish()
+    else:
+        decimator = _Decimator(header, factor)
+        last_row = (height - 1) * factor
+        # As in _decode_into, reading stops after the last row needed
+        # unless the image data is read to its end anyway
+        whole = last_row == header.height - 1
+        for _, row, scanline in image.iter_scanlines():
+            if row % factor:
+                continue
+            start = row // factor * row_size
+            pixels[start:start + row_size] = decimator.extract(scanline)
+            if row == last_row and not whole:
+                break
+        if whole:
+            image.finish()
+    return [
+        bytes(pixels[start:start + row_size])
+        for start in range(0, len(pixels), row_size)
+    ]
+
+
+# Default number of rows between the checkpoints of a RowIndex
+DEFAULT_ROWS_PER_CHECKPOINT = 64
+
+# Number of inflated bytes a deflate block can refer back to
+_WINDOW_SIZE = 2**15
+# Upper bound for the output of a single decompression call
+_MAX_DECOMPRESS_LENGTH = ImageDataStreamParser.MAX_DECOMPRESS_LENGTH
+_READ_SIZE = 2**16
+
+_ROW_INDEX_MAGIC = b'\x89PNGIDX\n'
+_ROW_INDEX_VERSION = 1
+# Magic, version, width, height, bit depth, color type, rows per
+# checkpoint, IDAT chunk count and checkpoint count
+_ROW_INDEX_HEADER = struct.Struct('>8sHIIBBIII')
+# Position and data length
+_ROW_INDEX_CHUNK = struct.Struct('>QI')
+# Row, bit position, output position, and the lengths of the window,
+# prefix and previous row that follow
+_ROW_INDEX_CHECKPOINT = struct.Struct('>IQQIII')
+
+
+@attr.attributes(frozen=True)
+class _Checkpoint:
+    """
+    A point in the image data stream where inflation can resume.
+
+    :ivar row: The scanline the checkpoint is in
+    :ivar bit_position:
+        The position in bits of the deflate block that starts there,
+        from the start of the zlib stream
+    :ivar output_position: The number of inflated bytes before it
+    :ivar window:
+        The inflated bytes before it that the block can refer back to,
+        up to 32 KiB
+    :ivar prefix: The inflated bytes of ``row`` before it
+    :ivar previous:
+        The unfiltered bytes of the scanline before ``row``, or empty
+        for the first row
+    """
+    row = attr.attr()  # type: int
+    bit_position = attr.attr()  # type: int
+    output_position = attr.attr()  # type: int
+    window = attr.attr()  # type: bytes
+    prefix = attr.attr()  # type: bytes
+    previous = attr.attr()  # type: bytes
+
+
+class RowIndex:
+    """
+    Checkpoints in the image data of a non-interlaced PNG image, from
+    which rows can be decoded without inflating the data before them.
+
+    Build an index in one pass over the image with :meth:`build`, then
+    decode rows of the same image with :meth:`decode_rows` as often as
+    needed. Save it to a sidecar file with :meth:`save` and read it
+    back with :meth:`load`.
+
+    The state of a :mod:`zlib` inflater can't be saved, so checkpoints
+    are at deflate block starts, found by
+    :func:`deflate.iter_block_starts`, and hold the 32 KiB of output
+    before them that the block can refer back to. There is one at the
+    last block start before every ``rows_per_checkpoint`` rows. Blocks
+    usually hold tens of KiB of output, so checkpoints closer than that
+    are merged.
+
+    :ivar image_header: The :class:`models.ImageHeader` of the image
+    :ivar rows_per_checkpoint: The spacing the checkpoints were built at
+    :ivar checkpoints: The :class:`_Checkpoint` list, in stream order
+    :ivar _chunks: A (position, data length) tuple for each IDAT chunk
+    """
+    def __init__(self, image_header, rows_per_checkpoint, chunks,
+                 checkpoints):
+        self.image_header = image_header
+        self.rows_per_checkpoint = rows_per_checkpoint
+        self.checkpoints = checkpoints
+        self._chunks = chunks
+        self._chunk_offsets = list(itertools.accumulate(
+            [0] + [length for _, length in chunks[:-1]]))
+        self._checkpoint_rows = [checkpoint.row for checkpoint in checkpoints]
+        [(self._line_length, _)] = _calculate_subimage_scanlines(
+            image_header.width, image_header.height, image_header.color_type,
+            image_header.bit_depth, image_header.interlace_method)
+
+    @classmethod
+    def build(cls, stream, rows_per_checkpoint=DEFAULT_ROWS_PER_CHECKPOINT):
+        """
+        Return the index of the PNG image in the binary ``stream``.
+
+        The whole stream is parsed and validated, and its image data
+        inflated and unfiltered, in a single pass. Only about a deflate
+        block of compressed data and 32 KiB of inflated data are held
+        in memory at a time.
+
+        Raise :exc:`ValueError` for an interlaced image, and
+        :exc:`exceptions.DecodeError` if the stream is invalid.
+        """
+        if rows_per_checkpoint < 1:
+            raise ValueError("There must be at least 1 row per checkpoint")
+        parser = PNGParser(stream, mode=ParseMode.image_data)
+        image_data = parser.iter_image_data()
+        # The chunks before the image data are parsed by then
+        first = next(image_data, b'')
+        header = parser.result.image_header
+        if header.interlace_method is not fieldvalues.InterlaceMethod.none:
+            raise ValueError("Rows of interlaced images can't be indexed")
+        # Validates the other header fields
+        ImageDataStreamParser.from_image_header(header)
+        [(line_length, _)] = _calculate_subimage_scanlines(
+            header.width, header.height, header.color_type,
+            header.bit_depth, header.interlace_method)
+        capture = _CheckpointCapture(header, line_length, rows_per_checkpoint)
+
+        def feed():
+            for data in itertools.chain([first], image_data):
+                for start in range(0, len(data), _READ_SIZE):
+                    piece = data[start:start + _READ_SIZE]
+                    capture.feed(piece)
+                    yield piece
+
+        pieces = feed()
+        # The deflate blocks start after the 2 byte zlib header
+        for bit_position, output in deflate.iter_block_starts(pieces, 16):
+            capture.add_block_start(bit_position, output)
+        # Parses the rest of the stream
+        for _ in pieces:
+            pass
+        capture.finish()
+        chunks = [
+            (head.position, head.length) for head in parser.result.chunks
+            if head.code == chunktypes.IMAGE_DATA.code
+        ]
+        return cls(header, rows_per_checkpoint, chunks, capture.checkpoints)
+
+    def decode_rows(self, stream, start, stop=None):
+        """
+        Decode the rows ``start`` up to ``stop`` (excluded, or the end
+        of the image if ``None``) of the image in the seekable binary
+        ``stream`` the index was built from, like :func:`decode_rows`.
+
+        Inflation resumes from the last checkpoint at or before
+        ``start``, and stops after ``stop``. Only the IDAT chunks read
+        are checked against the index, and their CRC32 checksums aren't
+        verified. Raise :exc:`ValueError` if the stream doesn't match
+        the index.
+        """
+        header = self.image_header
+        if stop is None:
+            stop = header.height
+        if not 0 <= start < stop <= header.height:
+            raise ValueError(
+                "Rows {0} to {1} are not a non-empty part of the {2} "
+                "rows of the image".format(start, stop, header.height))
+        index = bisect.bisect_right(self._checkpoint_rows, start) - 1
+        if index < 0:
+            stream.seek(0)
+            return decode_rows(stream, start, stop)
+        checkpoint = self.checkpoints[index]
+        self._check_image_header(stream)
+
+        unfilterer = _AdaptiveFiveBasicSubimageUnfilterer(
+            header.color_type, header.bit_depth, checkpoint.previous or None)
+        extractor = _ColumnExtractor(
+            header.color_type, header.bit_depth, 0, header.width)
+        line_length = self._line_length
+        pending = bytearray(checkpoint.prefix)
+        row = checkpoint.row
+        rows = []
+        for output in _inflate_raw(
+                self._iter_compressed(stream, checkpoint.bit_position),
+                checkpoint.window):
+            pending += output
+            lines = len(pending) // line_length
+            for line_start in range(0, lines * line_length, line_length):
+                scanline = unfilterer.unfilter_scanline(
+                    bytes(pending[line_start:line_start + line_length]))
+                if row >= start:
+                    rows.append(extractor.extract(scanline))
+                row += 1
+                if row == stop:
+                    return rows
+            del pending[:lines * line_length]
+        raise exceptions.PNGSyntaxError(
+            "Image data ended after {0} rows".format(row))
+
+    def _check_image_header(self, stream):
+        header = self.image_header
+        expected = struct.pack(
+            '>I4sIIBBBBB', 13, chunktypes.IMAGE_HEADER.code, header.width,
+            header.height, header.bit_depth, header.color_type.value,
+            header.compression_method.value, header.filter_method.value,
+            header.interlace_method.value)
+        stream.seek(8)
+        if stream.read(len(expected)) != expected:
+            raise ValueError("The image header doesn't match the row index")
+
+    def _iter_compressed(self, stream, bit_position):
+        """
+        Yield the image data from ``bit_position`` on, as a raw deflate
+        stream that starts at a byte boundary.
+        """
+        byte, shift = divmod(bit_position, 8)
+        index = bisect.bisect_right(self._chunk_offsets, byte) - 1
+        offset = byte - self._chunk_offsets[index]
+        pieces = _read_chunk_data(stream, self._chunks[index:], offset)
+        return _prefix_empty_blocks(pieces, shift)
+
+    def to_bytes(self):
+        """
+        Return the index serialized for :meth:`from_bytes`.
+        """
+        header = self.image_header
+        parts = [_ROW_INDEX_HEADER.pack(
+            _ROW_INDEX_MAGIC, _ROW_INDEX_VERSION, header.width,
+            header.height, header.bit_depth, header.color_type.value,
+            self.rows_per_checkpoint, len(self._chunks),
+            len(self.checkpoints),
+        )]
+        parts.extend(
+            _ROW_INDEX_CHUNK.pack(position, length)
+            for position, length in self._chunks
+        )
+        for checkpoint in self.checkpoints:
+            parts.append(_ROW_INDEX_CHECKPOINT.pack(
+                checkpoint.row, checkpoint.bit_position,
+                checkpoint.output_position, len(checkpoint.window),
+                len(checkpoint.prefix), len(checkpoint.previous),
+            ))
+            parts.extend(
+                [checkpoint.window, checkpoint.prefix, checkpoint.previous])
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Return the index serialized by :meth:`to_bytes`, or raise
+        :exc:`ValueError` if ``data`` isn't one.
+        """
+        data = memoryview(data)
+        try:
+            (magic, version, width, height, bit_depth, color_type,
+             rows_per_checkpoint, chunk_count,
+             checkpoint_count) = _ROW_INDEX_HEADER.unpack_from(data)
+            if magic != _ROW_INDEX_MAGIC or version != _ROW_INDEX_VERSION:
+                raise ValueError("Not a version {0} row index".format(
+                    _ROW_INDEX_VERSION))
+            header = models.ImageHeader(
+                width, height, bit_depth, fieldvalues.ColorType(color_type),
+                fieldvalues.CompressionMethod.deflate32k,
+                fieldvalues.FilterMethod.adaptive_five_basic,
+                fieldvalues.InterlaceMethod.none,
+            )
+            offset = _ROW_INDEX_HEADER.size
+            chunks = []
+            for _ in range(chunk_count):
+                chunks.append(_ROW_INDEX_CHUNK.unpack_from(data, offset))
+                offset += _ROW_INDEX_CHUNK.size
+            checkpoints = []
+            for _ in range(checkpoint_count):
+                fields = _ROW_INDEX_CHECKPOINT.unpack_from(data, offset)
+                offset += _ROW_INDEX_CHECKPOINT.size
+                parts = []
+                for length in fields[3:]:
+                    part = bytes(data[offset:offset + length])
+                    if len(part) != length:
+                        raise ValueError("Row index is truncated")
+                    parts.append(part)
+                    offset += length
+                checkpoints.append(_Checkpoint(*(fields[:3] + tuple(parts))))
+        except struct.error:
+            raise ValueError("Row index is truncated")
+        if offset != len(data):
+            raise ValueError("Row index has trailing data")
+        return cls(header, rows_per_checkpoint, chunks, checkpoints)
+
+    def save(self, path):
+        """
+        Write the index to the sidecar file at ``path``, which is only
+        replaced once it is complete.
+        """
+        # Imported here so that decoding doesn't load the rewriters
+        from pngdoctor.rewrite import _replacing_output
+        data = memoryview(self.to_bytes())
+        with _replacing_output(path) as sidecar:
+            written = 0
+            while written < len(data):
+                written += sidecar.write(data[written:])
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return the index in the sidecar file at ``path``.
+        """
+        with open(path, 'rb') as sidecar:
+            return cls.from_bytes(sidecar.read())
+
+
+class _CheckpointCapture:
+    """
+    Inflates and unfilters the image data as the deflate block starts
+    are found in it, and captures a :class:`_Checkpoint` at the last
+    block start before the data of every Nth row.
+
+    Inflation stays at the last block start found, so that only the
+    compressed data after it, the 32 KiB of inflated data before it
+    and the current row are held.
+
+    :ivar checkpoints: The checkpoints captured
+    """
+    def __init__(self, image_header, line_length, rows_per_checkpoint):
+        self._height = image_header.height
+        self._line_length = line_length
+        self._rows_per_checkpoint = rows_per_checkpoint
+        self._decompressor = _Deflate32KDecompressor()
+        self._unfilterer = _AdaptiveFiveBasicSubimageUnfilterer(
+            image_header.color_type, image_header.bit_depth)
+        self._input = []
+        # The inflated data from the 32 KiB before the current row on
+        self._history = bytearray()
+        self._history_start = 0
+        self._previous = b''
+        self._row = 0
+        self._target_row = rows_per_checkpoint
+        self._block_start = None
+        self.checkpoints = []
+
+    @property
+    def _inflated(self):
+        return self._history_start + len(self._history)
+
+    def feed(self, data):
+        """
+        Add compressed image data, to be inflated once needed.
+        """
+        self._input.append(data)
+
+    def add_block_start(self, bit_position, output_position):
+        """
+        Handle the next (bit position, output position) tuple of
+        :func:`deflate.iter_block_starts`, once the data up to it was
+        fed.
+        """
+        previous = self._block_start
+        self._block_start = bit_position, output_position
+        if previous is None:
+            return
+        # The previous block start is the last one before the target
+        # rows that this one is past
+        selected = False
+        while (self._target_row < self._height and
+               self._target_row * self._line_length < output_position):
+            selected = True
+            self._target_row += self._rows_per_checkpoint
+        self._inflate_to(previous[1])
+        if selected and previous[1]:
+            self._capture(*previous)
+
+    def _capture(self, bit_position, output_position):
+        history = self._history
+        end = output_position - self._history_start
+        row_start = self._row * self._line_length - self._history_start
+        self.checkpoints.append(_Checkpoint(
+            self._row, bit_position, output_position,
+            bytes(history[max(0, end - _WINDOW_SIZE):end]),
+            bytes(history[row_start:end]),
+            self._previous,
+        ))
+
+    def _inflate_to(self, output_position):
+        data = b''.join(self._input)
+        self._input = []
+        while self._inflated < output_position:
+            output = self._decompressor.decompress(
+                data, min(output_position - self._inflated,
+                          _MAX_DECOMPRESS_LENGTH))
+            data = b''
+            if not output:
+                raise exceptions.PNGSyntaxError(
+                    "Image data ended before a deflate block start")
+            self._add_output(output)
+        if data:
+            # Not needed yet
+            self._input.append(data)
+
+    def _add_output(self, output):
+        line_length = self._line_length
+        self._history += output
+        if self._inflated > self._height * line_length:
+            raise exceptions.PNGSyntaxError(
+                "Image data contains more data than the image header allows")
+        while True:
+            row_start = self._row * line_length - self._history_start
+            if len(self._history) < row_start + line_length:
+                break
+            self._previous = self._unfilterer.unfilter_scanline(
+                bytes(self._history[row_start:row_start + line_length]))
+            self._row += 1
+        keep = max(0, min(
+            self._row * line_length, self._inflated - _WINDOW_SIZE))
+        del self._history[:keep - self._history_start]
+        self._history_start = keep
+
+    def finish(self):
+        """
+        Inflate the rest of the image data and validate it.
+        """
+        data = b''.join(self._input)
+        self._input = []
+        while True:
+            output = self._decompressor.decompress(
+                data, _MAX_DECOMPRESS_LENGTH)
+            data = b''
+            self._add_output(output)
+            if (len(output) < _MAX_DECOMPRESS_LENGTH and
+                    not self._decompressor.has_unconsumed_input):
+                break
+        self._decompressor.verify_end()
+        if self._row < self._height:
+            raise exceptions.PNGSyntaxError(
+                "Image data ended after {0} rows".format(self._row))
+
+
+def _read_chunk_data(stream, chunks, offset):
+    """
+    Yield the data of the IDAT ``chunks``, a list of (position, data
+    length) tuples, from ``offset`` in the first one on, checking that
+    each is where it is expected.
+    """
+    for position, length in chunks:
+        stream.seek(position)
+        if stream.read(8) != struct.pack(
+                '>I4s', length, chunktypes.IMAGE_DATA.code):
+            raise ValueError(
+                "IDAT chunk at byte {0} doesn't match the row index".format(
+                    position))
+        stream.seek(position + 8 + offset)
+        remaining = length - offset
+        offset = 0
+        while remaining:
+            data = stream.read(min(remaining, _READ_SIZE))
+            if not data:
+                raise exceptions.UnexpectedEOF(
+                    "Stream ended in IDAT chunk at byte {0}".format(
+                        position))
+            remaining -= len(data)
+            yield data
+
+
+def _deflate_bits(value, count):
+    """
+    Return the ``count`` bits of ``value`` as a string of 0 and 1,
+    least significant bit first as deflate stores numbers.
+    """
+    return format(value, '0{0}b'.format(count))[::-1]
+
+
+# A non-final fixed Huffman block with only the end of block code, 10
+# bits long
+_EMPTY_FIXED_BLOCK = '0' + _deflate_bits(1, 2) + '0000000'
+
+# A non-final dynamic Huffman block with only the end of block code, 93
+# bits long. The code length code has 1 bit for length 1 and 2 bits for
+# length 0 and for the repeated zero lengths (18), and the end of block
+# code has length 1.
+_EMPTY_DYNAMIC_BLOCK = ''.join([
+    '0' + _deflate_bits(2, 2),
+    # 257 literal/length codes, 1 distance code, 18 code length codes
+    _deflate_bits(0, 5) + _deflate_bits(0, 5) + _deflate_bits(18 - 4, 4),
+    # The code length code lengths, for 16, 17, 18, 0, 8, 7, 9, 6, 10,
+    # 5, 11, 4, 12, 3, 13, 2, 14 and 1 in turn
+    ''.join(_deflate_bits(length, 3)
+            for length in [0, 0, 2, 2] + [0] * 13 + [1]),
+    # Lengths 0 for the 256 literals, 1 for end of block, 0 for the
+    # distance code
+    '11' + _deflate_bits(138 - 11, 7) + '11' + _deflate_bits(118 - 11, 7),
+    '0' + '10',
+    # End of block
+    '0',
+])
+
+
+def _empty_blocks(shift):
+    """
+    Return the bits of empty deflate blocks whose length is ``shift``
+    more than a multiple of 8.
+    """
+    bits = _EMPTY_DYNAMIC_BLOCK if shift % 2 else ''
+    while len(bits) % 8 != shift:
+        bits += _EMPTY_FIXED_BLOCK
+    return bits
+
+
+def _prefix_empty_blocks(pieces, shift):
+    """
+    Yield the bytes of ``pieces``, with their first ``shift`` bits
+    replaced by empty deflate blocks.
+
+    The blocks after them keep their position in a byte, which the
+    stored blocks among them need: those are padded to the next byte
+    boundary. Only the first byte of ``pieces`` is changed.
+    """
+    pieces = iter(pieces)
+    if not shift:
+        yield from pieces
+        return
+    first = next(pieces, b'')
+    if not first:
+        return
+    bits = _empty_blocks(shift)
+    value = int(bits[::-1], 2) | (
+        first[0] >> shift << shift << len(bits) - shift)
+    yield value.to_bytes((len(bits) + 7) // 8, 'little') + first[1:]
+    yield from pieces
+
+
+def _inflate_raw(pieces, window):
+    """
+    Yield the inflated output of the raw deflate stream made of
+    ``pieces``, whose blocks may refer back to the output ``window``.
+    """
+    decompressor = zlib.decompressobj(wbits=-15, zdict=window)
+    try:
+        for data in pieces:
+            while True:
+                output = decompressor.decompress(
+                    data, _MAX_DECOMPRESS_LENGTH)
+                data = decompressor.unconsumed_tail
+                if output:
+                    yield output
+                if decompressor.eof:
+                    return
+                if not data and len(output) < _MAX_DECOMPRESS_LENGTH:
+                    break
+    except zlib.error as exc:
+        raise exceptions.PNGSyntaxError(
+            "Invalid compressed image data: {0}".format(exc))
@@ -0,0 +1,327 @@
+"""
+Finding the block boundaries of deflate streams.
+
+:mod:`zlib` inflates much faster than Python could, but it doesn't tell
+where the blocks of a stream start. Inflation can only be resumed from
+a block start, given the 32 KiB of output before it, so
+:func:`iter_block_starts` walks the Huffman codes of each block to find
+them without producing any output.
+"""
+from pngdoctor import exceptions
+
+
+# Number of extra bits and base value of the length symbols 257-285
+_LENGTH_EXTRA_BITS = (
+    0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4,
+    5, 5, 5, 5, 0,
+)
+_LENGTH_BASES = (
+    3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31, 35, 43, 51, 59,
+    67, 83, 99, 115, 131, 163, 195, 227, 258,
+)
+# Number of extra bits of the distance symbols 0-29
+_DISTANCE_EXTRA_BITS = (
+    0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8, 8, 9, 9, 10,
+    10, 11, 11, 12, 12, 13, 13,
+)
+# Order of the code lengths of the code length alphabet in the header of
+# a block with dynamic Huffman codes
+_CODE_LENGTH_ORDER = (
+    16, 17, 18, 0, 8, 7, 9, 6, 10, 5, 11, 4, 12, 3, 13, 2, 14, 1, 15,
+)
+
+_END_OF_BLOCK = 256
+
+
+def _error(message):
+    return exceptions.PNGSyntaxError(
+        "Invalid compressed image data: {0}".format(message))
+
+
+class _HuffmanTable:
+    """
+    A lookup table decoding a canonical Huffman code.
+
+    :ivar bits: The length of the longest code
+    :ivar entries:
+        A list indexed by the next ``bits`` bits of the stream, least
+        significant first, of (symbol, code length) tuples, or ``None``
+        for bits that start no code
+    """
+    def __init__(self, lengths):
+        """
+        :param lengths: The code length of each symbol, 0 if unused
+        """
+        self.bits = max(lengths)
+        if not self.bits:
+            # Allowed for a distance code that is never used
+            self.bits = 1
+        size = 2**self.bits
+        self.entries = [None] * size
+        counts = [0] * (self.bits + 1)
+        for length in lengths:
+            counts[length] += 1
+        counts[0] = 0
+        next_code = [0] * (self.bits + 1)
+        code = 0
+        for length in range(1, self.bits + 1):
+            code = (code + counts[length - 1]) << 1
+            next_code[length] = code
+        for symbol, length in enumerate(lengths):
+            if not length:
+                continue
+            code = next_code[length]
+            next_code[length] += 1
+            if code >= 2**length:
+                raise _error("Oversubscribed Huffman code")
+            # Codes are stored most significant bit first
+            reversed_code = int(
+                '{0:0{1}b}'.format(code, length)[::-1], 2)
+            step = 2**length
+            self.entries[reversed_code::step] = (
+                [(symbol, length)] * (size // step))
+
+
+def _fixed_tables():
+    literal_lengths = [8] * 144 + [9] * 112 + [7] * 24 + [8] * 8
+    return _HuffmanTable(literal_lengths), _HuffmanTable([5] * 30)
+
+
+_FIXED_TABLES = None
+
+
+class _BitReader:
+    """
+    Reads a deflate stream bit by bit, least significant bit first.
+    """
+    def __init__(self, pieces, position):
+        """
+        :param pieces: An iterable of the bytes of the stream, in pieces
+        :param position: The bit position to start reading at
+        """
+        self._pieces = iter(pieces)
+        self._data = b''
+        self._offset = 0
+        # The number of bytes loaded into the buffer or skipped, with
+        # the zeros padding the stream past its end
+        self._byte = 0
+        # The length of the stream, once its last piece was read
+        self._end = None
+        self.buffer = 0
+        self.count = 0
+        self._skip(position // 8)
+        self.read(position % 8)
+
+    @property
+    def position(self):
+        """
+        The bit position of the next bit to read.
+        """
+        return 8 * self._byte - self.count
+
+    def _next_piece(self):
+        """
+        Move on to the next non-empty piece, and return whether there
+        is one.
+        """
+        if self._end is None:
+            for data in self._pieces:
+                if data:
+                    self._data = data
+                    self._offset = 0
+                    return True
+            self._end = self._byte
+        return False
+
+    def fill(self, count):
+        """
+        Ensure at least ``count`` bits are buffered, padding with zeros
+        past the end of the data.
+        """
+        while self.count < count:
+            if self._offset == len(self._data) and not self._next_piece():
+                if self._byte > self._end + 8:
+                    # Far enough past the end that the bits read so far
+                    # are past it too
+                    raise _error("Stream ended in the middle of a block")
+                self._byte += 8
+                self.count += 64
+                continue
+            data = self._data[self._offset:self._offset + 8]
+            self._offset += len(data)
+            self._byte += len(data)
+            self.buffer |= int.from_bytes(data, 'little') << self.count
+            self.count += 8 * len(data)
+
+    def _skip(self, count):
+        """
+        Skip ``count`` bytes that are not buffered.
+        """
+        while count:
+            if self._offset == len(self._data) and not self._next_piece():
+                self._byte += count
+                return
+            skipped = min(count, len(self._data) - self._offset)
+            self._offset += skipped
+            self._byte += skipped
+            count -= skipped
+
+    def read(self, count):
+        self.fill(count)
+        value = self.buffer & (2**count - 1)
+        self.buffer >>= count
+        self.count -= count
+        return value
+
+    def align(self):
+        """
+        Skip to the next byte boundary.
+        """
+        self.read(self.count % 8)
+
+    def skip_bytes(self, count):
+        """
+        Skip ``count`` bytes, once aligned to a byte boundary.
+        """
+        buffered = min(count, self.count // 8)
+        self.read(8 * buffered)
+        self._skip(count - buffered)
+
+    def check_end(self):
+        """
+        Raise :exc:`exceptions.PNGSyntaxError` if the bits read went
+        past the end of the data.
+        """
+        if self._end is not None and self.position > 8 * self._end:
+            raise _error("Stream ended in the middle of a block")
+
+    def decode(self, table):
+        """
+        Read the next symbol coded with the :class:`_HuffmanTable`.
+        """
+        self.fill(table.bits)
+        entry = table.entries[self.buffer & (2**table.bits - 1)]
+        if entry is None:
+            raise _error("Invalid Huffman code")
+        symbol, length = entry
+        self.buffer >>= length
+        self.count -= length
+        return symbol
+
+
+def _read_dynamic_tables(reader):
+    literal_count = reader.read(5) + 257
+    distance_count = reader.read(5) + 1
+    code_length_count = reader.read(4) + 4
+    code_length_lengths = [0] * 19
+    for index in _CODE_LENGTH_ORDER[:code_length_count]:
+        code_length_lengths[index] = reader.read(3)
+    code_length_table = _HuffmanTable(code_length_lengths)
+    lengths = []
+    total = literal_count + distance_count
+    while len(lengths) < total:
+        symbol = reader.decode(code_length_table)
+        if symbol < 16:
+            lengths.append(symbol)
+        elif symbol == 16:
+            if not lengths:
+                raise _error("Repeated code length without a first one")
+            lengths.extend([lengths[-1]] * (3 + reader.read(2)))
+        elif symbol == 17:
+            lengths.extend([0] * (3 + reader.read(3)))
+        else:
+            lengths.extend([0] * (11 + reader.read(7)))
+    if len(lengths) > total:
+        raise _error("Code lengths repeated past the end")
+    if not lengths[_END_OF_BLOCK]:
+        raise _error("No end of block code")
+    return (
+        _HuffmanTable(lengths[:literal_count]),
+        _HuffmanTable(lengths[literal_count:]),
+    )
+
+
+def _skip_compressed_block(reader, literal_table, distance_table):
+    """
+    Read the symbols of a block with Huffman codes up to its end, and
+    return the length of its output.
+    """
+    # The loop is the bottleneck of :func:`iter_block_starts`, so the
+    # symbol decoding of _BitReader.decode is inlined
+    literal_entries = literal_table.entries
+    literal_bits = literal_table.bits
+    literal_mask = 2**literal_bits - 1
+    distance_entries = distance_table.entries
+    distance_bits = distance_table.bits
+    distance_mask = 2**distance_bits - 1
+    fill = reader.fill
+    output = 0
+    while True:
+        if reader.count < 48:
+            fill(48)
+        entry = literal_entries[reader.buffer & literal_mask]
+        if entry is None:
+            raise _error("Invalid Huffman code")
+        symbol, length = entry
+        reader.buffer >>= length
+        reader.count -= length
+        if symbol < _END_OF_BLOCK:
+            output += 1
+            continue
+        if symbol == _END_OF_BLOCK:
+            return output
+        symbol -= 257
+        if symbol >= 29:
+            raise _error("Invalid length symbol")
+        extra = _LENGTH_EXTRA_BITS[symbol]
+        output += _LENGTH_BASES[symbol] + (
+            reader.buffer & (2**extra - 1))
+        reader.buffer >>= extra
+        reader.count -= extra
+        entry = distance_entries[reader.buffer & distance_mask]
+        if entry is None or entry[0] >= 30:
+            raise _error("Invalid distance code")
+        symbol, length = entry
+        extra = _DISTANCE_EXTRA_BITS[symbol]
+        reader.buffer >>= length + extra
+        reader.count -= length + extra
+
+
+def iter_block_starts(pieces, position=0):
+    """
+    Yield a tuple of (bit position, output position) for the start of
+    each block of the raw deflate stream starting at bit ``position``
+    of the data, then one for the end of the final block.
+
+    The data is read from the iterable ``pieces`` of bytes only as far
+    as the blocks found so far, so it can be streamed. The output
+    position is the number of bytes inflated from the blocks before.
+    Raise :exc:`exceptions.PNGSyntaxError` if the stream is invalid or
+    truncated.
+    """
+    global _FIXED_TABLES  # pylint: disable=global-statement
+    reader = _BitReader(pieces, position)
+    output = 0
+    final = False
+    while not final:
+        yield reader.position, output
+        final = reader.read(1)
+        block_type = reader.read(2)
+        if block_type == 0:
+            reader.align()
+            length = reader.read(16)
+            if length != reader.read(16) ^ 0xFFFF:
+                raise _error("Stored block length check failed")
+            reader.skip_bytes(length)
+            output += length
+        elif block_type == 1:
+            if _FIXED_TABLES is None:
+                _FIXED_TABLES = _fixed_tables()
+            output += _skip_compressed_block(reader, *_FIXED_TABLES)
+        elif block_type == 2:
+            output += _skip_compressed_block(
+                reader, *_read_dynamic_tables(reader))
+        else:
+            raise _error("Invalid block type")
+        reader.check_end()
+    yield reader.position, output
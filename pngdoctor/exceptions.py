@@ -26,6 +26,14 @@ class PNGSyntaxError(DecodeError):
     pass
 
 
+class MisplacedChunk(PNGSyntaxError):
+    pass
+
+
+class DuplicateChunk(PNGSyntaxError):
+    pass
+
+
 class PNGTooLarge(DecodeError):
     pass
 
@@ -31,3 +31,15 @@ class AdaptiveFilterType(enum.Enum):
 class InterlaceMethod(enum.Enum):
     none = 0
     adam7 = 1
+
+
+class RenderingIntent(enum.Enum):
+    perceptual = 0
+    relative_colorimetric = 1
+    saturation = 2
+    absolute_colorimetric = 3
+
+
+class PhysicalUnit(enum.Enum):
+    unknown = 0
+    meter = 1
@@ -10,14 +10,40 @@ from pngdoctor import fieldvalues
 class ImageDataStreamParser:
     """
     Parser for IDAT data stream.
+
+    Feed the data from each IDAT chunk to :meth:`iter_scanlines` in
+    stream order, then call :meth:`verify_end` after the last one.
     """
-    def __init__(self, decompressor, locator, subimage_unfilterer_factory):
+    # Upper bound for the output of a single decompression call, which
+    # keeps memory bounded regardless of the compression ratio.
+    MAX_DECOMPRESS_LENGTH = 64 * 2**10  # type: int # 64 KiB
+
+    def __init__(self, decompressor, locator, subimage_unfilterer_factory,
+                 subimage_scanlines, instrumentation=None):
+        """
+        :param subimage_scanlines:
+            A list of (scanline length, scanline count) tuples, one for
+            each non-empty subimage. Scanline lengths include the
+            filter type byte.
+        :param instrumentation:
+            An :class:`instrumentation.Instrumentation` to measure the
+            ``inflate`` stage, and an ``unfilter.<filter type name>``
+            stage for each adaptive filter type
+        """
+        if instrumentation is not None:
+            decompressor, subimage_unfilterer_factory = _instrument(
+                instrumentation, decompressor, subimage_unfilterer_factory)
         self._decompressor = decompressor
         self._locator = locator
         self._subimage_unfilterer_factory = subimage_unfilterer_factory
+        self._subimage_scanlines = subimage_scanlines
+        self._pending = bytearray()
+        self._subimage_index = 0
+        self._row = 0
+        self._unfilterer = None
 
     @classmethod
-    def from_image_header(cls, image_header):
+    def from_image_header(cls, image_header, instrumentation=None):
         if (
                 image_header.compression_method is
                 fieldvalues.CompressionMethod.deflate32k
@@ -60,7 +86,107 @@ class ImageDataStreamParser:
                 image_header.filter_method)
             raise exceptions.UnsupportedField(msg)
 
-        return cls(decompressor, locator, subimage_unfilterer_factory)
+        subimage_scanlines = _calculate_subimage_scanlines(
+            image_header.width,
+            image_header.height,
+            image_header.color_type,
+            image_header.bit_depth,
+            image_header.interlace_method,
+        )
+        return cls(decompressor, locator, subimage_unfilterer_factory,
+                   subimage_scanlines, instrumentation=instrumentation)
+
+    @property
+    def finished(self):
+        """
+        If every scanline of every subimage has been produced.
+        """
+        return self._subimage_index >= len(self._subimage_scanlines)
+
+    def iter_scanlines(self, data):
+        """
+        Decompress and unfilter some of the image data stream.
+
+        Yield a tuple of (subimage index, row number within the
+        subimage, unfiltered scanline bytes) for each scanline that
+        is completed by this data. The filter type byte is not
+        included in the scanline bytes.
+
+        The generator must be exhausted before the next call.
+        """
+        decompressed = self._decompressor.decompress(
+            data, self.MAX_DECOMPRESS_LENGTH)
+        while True:
+            self._pending += decompressed
+            yield from self._drain_scanlines()
+            if (
+                    len(decompressed) < self.MAX_DECOMPRESS_LENGTH and
+                    not self._decompressor.has_unconsumed_input
+                ):
+                return
+            decompressed = self._decompressor.decompress(
+                b'', self.MAX_DECOMPRESS_LENGTH)
+
+    def verify_end(self):
+        """
+        Ensure the image data stream was complete, and contained
+        exactly the scanlines declared by the image header.
+        """
+        self._decompressor.verify_end()
+        if not self.finished or self._pending:
+            fmt = (
+                "Image data ended with {rows} scanlines in subimage {index} "
+                "and {pending} bytes pending"
+            )
+            raise exceptions.PNGSyntaxError(fmt.format(
+                rows=self._row,
+                index=self._subimage_index,
+                pending=len(self._pending),
+            ))
+
+    def _drain_scanlines(self):
+        while not self.finished:
+            length, count = self._subimage_scanlines[self._subimage_index]
+            if len(self._pending) < length:
+                return
+            if self._row == 0:
+                self._unfilterer = self._subimage_unfilterer_factory()
+            scanline = bytes(self._pending[:length])
+            del self._pending[:length]
+            yield (
+                self._subimage_index,
+                self._row,
+                self._unfilterer.unfilter_scanline(scanline),
+            )
+            self._row += 1
+            if self._row == count:
+                self._subimage_index += 1
+                self._row = 0
+        if self._pending:
+            raise exceptions.PNGSyntaxError(
+                "Image data contains more data than the image header allows"
+            )
+
+
+def _instrument(instrumentation, decompressor, subimage_unfilterer_factory):
+    """
+    Return the decompressor and unfilterer factory with their work
+    measured by the instrumentation.
+    """
+    instrumentation.wrap_method(
+        decompressor, 'decompress', 'inflate', count_bytes='result')
+
+    def instrumented_unfilterer_factory():
+        unfilterer = subimage_unfilterer_factory()
+        for filter_type in fieldvalues.AdaptiveFilterType:
+            instrumentation.wrap_method(
+                unfilterer,
+                '_unfilter_with_method_' + filter_type.name,
+                'unfilter.' + filter_type.name,
+                count_bytes='argument',
+            )
+        return unfilterer
+    return decompressor, instrumented_unfilterer_factory
 
 
 class _Deflate32KDecompressor:
@@ -70,14 +196,27 @@ class _Deflate32KDecompressor:
         self.decompressed = 0
 
     def decompress(self, data, max_length):
-        result = self._decompressor.decompress(
-            self._last_unconsumed + data,
-            max_length
-        )
+        try:
+            result = self._decompressor.decompress(
+                self._last_unconsumed + data,
+                max_length
+            )
+        except zlib.error as exc:
+            raise exceptions.PNGSyntaxError(
+                "Invalid compressed image data: {0}".format(exc)
+            )
         self._last_unconsumed = self._decompressor.unconsumed_tail
         self.decompressed += len(result)
         return result
 
+    @property
+    def has_unconsumed_input(self):
+        """
+        If input from earlier calls is waiting to be decompressed
+        because of the ``max_length`` limit.
+        """
+        return bool(self._last_unconsumed)
+
     def verify_end(self):
         if self._last_unconsumed or not self._decompressor.eof:
             raise exceptions.DecompressionNotFinished()
@@ -141,57 +280,70 @@ def _adam7_deinterlace_pixel_coordinates(width, height):
     yield itertools.product(range(0, width, 1), range(1, height, 2))
 
 
+# Each pass is (first column, column step, first row, row step)
+_ADAM7_PASS_GEOMETRY = (
+    (0, 8, 0, 8),
+    (4, 8, 0, 8),
+    (0, 4, 4, 8),
+    (2, 4, 0, 4),
+    (0, 2, 2, 4),
+    (1, 2, 0, 2),
+    (0, 1, 1, 2),
+)
+
+
+_SAMPLES_PER_PIXEL = {
+    fieldvalues.ColorType.grayscale: 1,
+    fieldvalues.ColorType.rgb: 3,
+    fieldvalues.ColorType.indexed: 1,
+    fieldvalues.ColorType.grayscale_alpha: 2,
+    fieldvalues.ColorType.rgb_alpha: 4
+}
+
+
 def _calculate_bits_per_pixel(color_type, bit_depth):
-    samples_per_pixel = {
-        fieldvalues.ColorType.grayscale: 1,
-        fieldvalues.ColorType.rgb: 3,
-        fieldvalues.ColorType.indexed: 3,
-        fieldvalues.ColorType.grayscale_alpha: 2,
-        fieldvalues.ColorType.rgb_alpha: 4
-    }
-    return samples_per_pixel[color_type] * bit_depth
-
-
-def _calculate_scanline_sizes(width, height, color_type, bit_depth,
-                              interlace_method):
+    return _SAMPLES_PER_PIXEL[color_type] * bit_depth
+
+
+def _calculate_subimage_sizes(width, height, interlace_method):
     """
-    Yield the size in bytes of each scanline
+    Return a list of (width, height) tuples in pixels, one for each
+    subimage in stream order. Empty subimages (possible with Adam7
+    on small images) are included.
     """
-    bits_per_pixel = _calculate_bits_per_pixel(color_type, bit_depth)
     if interlace_method is fieldvalues.InterlaceMethod.none:
-        scanline_pixel_data_length = math.ceil(width * bits_per_pixel / 8)
-        # Each scanline is 1 filter-type byte followed by the pixel data
-        yield from itertools.repeat(1 + scanline_pixel_data_length, height)
+        return [(width, height)]
     elif interlace_method is fieldvalues.InterlaceMethod.adam7:
-        # Pass 1
-        yield from itertools.repeat(1 + math.ceil(width / 8),
-                                    math.ceil(height / 8))
-        # Pass 2
-        yield from itertools.repeat(1 + math.ceil(max(width - 4, 0) / 8),
-                                    math.ceil(height / 8))
-        # Pass 3
-        yield from itertools.repeat(1 + math.ceil(max(width - 4, 0) / 8),
-                                    math.ceil(height / 4))
-        # Pass 3
-        yield from itertools.repeat(1 + math.ceil(width / 4),
-                                    math.ceil(max(height - 4, 0) / 4))
-        # Pass 4
-        yield from itertools.repeat(1 + math.ceil(max(width - 2, 0) / 4),
-                                    math.ceil(height / 4))
-        # Pass 5
-        yield from itertools.repeat(1 + math.ceil(width / 2),
-                                    math.ceil(max(height - 2, 0) / 4))
-        # Pass 6
-        yield from itertools.repeat(1 + math.ceil(max(width - 1, 0) / 2),
-                                    math.ceil(height / 2))
-        # Pass 7
-        yield from itertools.repeat(1 + width,
-                                    math.ceil(max(height - 1, 0) / 2))
+        return [
+            (
+                len(range(first_column, width, column_step)),
+                len(range(first_row, height, row_step)),
+            )
+            for first_column, column_step, first_row, row_step
+            in _ADAM7_PASS_GEOMETRY
+        ]
     else:
         msg = "Interlace method {0} is not supported".format(interlace_method)
         raise exceptions.UnsupportedField(msg)
 
 
+def _calculate_subimage_scanlines(width, height, color_type, bit_depth,
+                                  interlace_method):
+    """
+    Return a list of (scanline length, scanline count) tuples for each
+    subimage that contains any pixels. The length includes the filter
+    type byte.
+    """
+    bits_per_pixel = _calculate_bits_per_pixel(color_type, bit_depth)
+    return [
+        # Each scanline is 1 filter-type byte followed by the pixel data
+        (1 + math.ceil(subimage_width * bits_per_pixel / 8), subimage_height)
+        for subimage_width, subimage_height
+        in _calculate_subimage_sizes(width, height, interlace_method)
+        if subimage_width and subimage_height
+    ]
+
+
 class _AdaptiveFiveBasicSubimageUnfilterer:
     """
     Reverses the "Adaptive filtering with five basic filter types"
@@ -200,25 +352,28 @@ class _AdaptiveFiveBasicSubimageUnfilterer:
     For non-interlaced images, the entire image is a single subimage,
     otherwise a new instance must be used for each interlacing pass.
     """
-    def __init__(self, color_type, bit_depth):
+    def __init__(self, color_type, bit_depth, last_scanline_data=None):
+        """
+        :param last_scanline_data:
+            The unfiltered bytes of the scanline before the first one to
+            unfilter, when starting in the middle of the subimage
+        """
         self._color_type = color_type
         self._bit_depth = bit_depth
         self._bytes_per_pixel = math.ceil(_calculate_bits_per_pixel(
             color_type, bit_depth) / 8)
         # Scanline data does not include the filter type byte.
-        self._last_scanline_data = None
+        self._last_scanline_data = last_scanline_data
         self._scanline_data_length = None
 
     def unfilter_scanline(self, scanline):
         """
         Given the bytes of a complete scanline from the decompressed
-        image data, return a list of sample tuples.
-
-        For indexed color, the tuples will contain only one sample
-        value, this is the palette index.
+        image data, return the unfiltered scanline bytes, without the
+        filter type byte.
         """
         if self._last_scanline_data is None:
-            self._last_scanline_data = '\x00' * (len(scanline) - 1)
+            self._last_scanline_data = bytes(len(scanline) - 1)
         else:
             if len(scanline) - 1 != len(self._last_scanline_data):
                 fmt = (
@@ -238,13 +393,12 @@ class _AdaptiveFiveBasicSubimageUnfilterer:
         return unfiltered_scanline
 
     def _get_valid_filter_method(self, value):
-        # pylint: disable=no-member,no-self-use
-        valids = fieldvalues.AdaptiveFilterType.__members__.values()
-        # pylint: enable=no-member
-        if value not in valids:
+        # pylint: disable=no-self-use
+        try:
+            return fieldvalues.AdaptiveFilterType(value)
+        except ValueError:
             fmt = "Invalid filter type {value!r} in image data"
             raise exceptions.PNGSyntaxError(fmt.format(value=value))
-        return fieldvalues.AdaptiveFilterType(value)
 
     def _unfilter_with_method_none(self, scanline_data):
         # pylint: disable=no-self-use
@@ -279,7 +433,7 @@ class _AdaptiveFiveBasicSubimageUnfilterer:
             if offset < 0:
                 raw = 0
             else:
-                raw = decoded_scanline_bytes[pos]
+                raw = decoded_scanline_bytes[offset]
             decoded_scanline_bytes.append(
                 (filtered_byte + (raw + prior) // 2) % 256
             )
@@ -0,0 +1,192 @@
+"""
+Optional per-stage measurements of the parser.
+
+Pass an :class:`Instrumentation` instance to :class:`parser.PNGParser`
+(or to the lower level components directly) to accumulate wall clock
+and CPU time, bytes, and call counts for each processing stage.
+
+Instrumentation works by replacing the measured methods of the
+component instances with timing wrappers when it is attached, so
+components created without it run exactly the same code as before.
+
+With ``trace_memory``, it also records the peak of the Python memory
+traced by :mod:`tracemalloc` and the stage that reached it. Run the
+parser inside :func:`tracing_memory` for that.
+"""
+import collections
+import contextlib
+import functools
+import time
+
+import attr
+
+
+@attr.attributes
+class StageTotals:
+    """
+    The accumulated measurements of one stage.
+
+    :ivar wall: Wall clock seconds
+    :ivar cpu: CPU seconds of this process
+    :ivar calls: Number of measured calls
+    :ivar bytes: Number of bytes processed, if the stage counts them
+    """
+    wall = attr.attr(default=0.0)  # type: float
+    cpu = attr.attr(default=0.0)  # type: float
+    calls = attr.attr(default=0)  # type: int
+    bytes = attr.attr(default=0)  # type: int
+
+
+class Instrumentation:
+    """
+    Accumulates per-stage measurements.
+
+    Stages are named with dots for grouping, for example ``read``,
+    ``crc``, ``order``, ``inflate``, ``unfilter.paeth`` and
+    ``chunk.tEXt``. Times are inclusive: the ``chunk.IDAT`` stage
+    includes the ``inflate`` and ``unfilter.*`` stages run while
+    parsing the IDAT chunks.
+
+    :ivar stages: A dict of stage names to :class:`StageTotals`
+    :ivar counts:
+        A :class:`collections.Counter` of object names, such as token
+        and model class names, to the number created
+    :ivar trace_memory: Whether memory peaks are recorded
+    :ivar peak_memory:
+        With ``trace_memory``, the highest traced memory seen, in bytes
+    :ivar peak_memory_stage:
+        The innermost stage that was running when :attr:`peak_memory`
+        was reached, or ``None``. Peaks outside any measured stage are
+        attributed to the stage passed to :meth:`check_memory`.
+    """
+    # How many bytes the peak must grow by to be attributed to another
+    # stage, so that the small objects an outer stage allocates while an
+    # inner stage's buffers are still alive don't take the credit
+    PEAK_MEMORY_STAGE_SLACK = 4096
+
+    def __init__(self, clock=time.perf_counter, cpu_clock=time.process_time,
+                 trace_memory=False):
+        self._clock = clock
+        self._cpu_clock = cpu_clock
+        self.stages = collections.defaultdict(StageTotals)
+        self.counts = collections.Counter()
+        self.trace_memory = trace_memory
+        self.peak_memory = 0
+        self.peak_memory_stage = None
+        if trace_memory:
+            import tracemalloc
+            self._get_traced_memory = tracemalloc.get_traced_memory
+
+    def wrap(self, stage, func, count_bytes=None):
+        """
+        Return a function that calls ``func`` and adds the time taken to
+        ``stage``.
+
+        :param count_bytes:
+            ``'result'`` to count the length of the return value as the
+            bytes processed, ``'argument'`` to count the length of the
+            first argument, or ``None`` to count no bytes
+        """
+        totals = self.stages[stage]
+        clock = self._clock
+        cpu_clock = self._cpu_clock
+        check_memory = self.check_memory if self.trace_memory else None
+
+        @functools.wraps(func)
+        def measured(*args, **kwargs):
+            start_wall = clock()
+            start_cpu = cpu_clock()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                totals.wall += clock() - start_wall
+                totals.cpu += cpu_clock() - start_cpu
+                totals.calls += 1
+                if check_memory is not None:
+                    # Inner stages return first, so a peak is attributed
+                    # to the innermost stage running when it was reached
+                    check_memory(stage)
+            if count_bytes == 'result':
+                totals.bytes += len(result)
+            elif count_bytes == 'argument':
+                totals.bytes += len(args[0])
+            return result
+        return measured
+
+    def wrap_method(self, instance, name, stage, count_bytes=None):
+        """
+        Replace the method ``name`` of ``instance`` with a
+        :meth:`wrap` of it, and return the instance.
+        """
+        setattr(instance, name, self.wrap(
+            stage, getattr(instance, name), count_bytes=count_bytes))
+        return instance
+
+    def check_memory(self, stage):
+        """
+        Attribute the traced memory peak to ``stage`` if it is higher
+        than :attr:`peak_memory`.
+        """
+        peak = self._get_traced_memory()[1]
+        if peak > self.peak_memory:
+            if (self.peak_memory_stage is None
+                    or peak - self.peak_memory > self.PEAK_MEMORY_STAGE_SLACK):
+                self.peak_memory_stage = stage
+            self.peak_memory = peak
+
+    def count(self, name, number=1):
+        """
+        Add ``number`` to the count of ``name``.
+        """
+        self.counts[name] += number
+
+    def count_items(self, iterable):
+        """
+        Yield the items of ``iterable``, counting each by the name of
+        its type.
+        """
+        counts = self.counts
+        for item in iterable:
+            counts[type(item).__name__] += 1
+            yield item
+
+    def report(self):
+        """
+        Return the measurements as a dict of JSON-compatible values.
+        """
+        report = {
+            'stages': {
+                name: attr.asdict(totals)
+                for name, totals in sorted(self.stages.items())
+            },
+            'counts': dict(self.counts),
+        }
+        if self.trace_memory:
+            report['memory'] = {
+                'peak': self.peak_memory,
+                'stage': self.peak_memory_stage,
+            }
+        return report
+
+
+@contextlib.contextmanager
+def tracing_memory():
+    """
+    Trace Python memory allocations with :mod:`tracemalloc` inside the
+    block, from a cleared trace so that the traced peak is that of the
+    block.
+
+    If tracing was already started, the existing traces are cleared
+    and tracing is left running afterwards.
+    """
+    import tracemalloc
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    else:
+        tracemalloc.clear_traces()
+    try:
+        yield
+    finally:
+        if started:
+            tracemalloc.stop()
@@ -1,3 +1,6 @@
+import io
+import itertools
+import re
 import struct
 import zlib
 import typing
@@ -26,6 +29,70 @@ PNG_MAX_FILE_SIZE = 20 * 2**20  # type: int
 PNG_MAX_CHUNK_LENGTH = 2**31 - 1  # type: int
 
 
+class _AllChunkCodes:
+    def __contains__(self, code):
+        return True
+
+    def __repr__(self):
+        return 'ALL_CHUNK_CODES'
+
+
+# Pass as ``skip_data_codes`` to skip the data of every chunk
+ALL_CHUNK_CODES = _AllChunkCodes()
+
+# A type code with the reserved bit clear, as a quick filter of the
+# places where a chunk may start
+_CHUNK_CODE_PATTERN = re.compile(b'[A-Za-z]{2}[A-Z][A-Za-z]')
+
+# How much to read at a time when scanning for a chunk header
+_SCAN_READ_SIZE = 2**16
+
+
+def is_plausible_chunk_header(header: bytes, position: int) -> bool:
+    """
+    Return whether the 8 bytes ``header`` found at ``position`` look
+    like the start of a chunk: a length within the limits, followed by
+    a valid type code with the reserved bit clear.
+    """
+    [length] = struct.unpack('>I', header[:4])
+    return (
+        length <= PNG_MAX_CHUNK_LENGTH and
+        position + length <= PNG_MAX_FILE_SIZE and
+        models.PNG_CHUNK_TYPE_CODE_ALLOWED_BYTES.issuperset(header[4:]) and
+        not header[6] & models.PNG_CHUNK_TYPE_PROPERTY_BITMASK
+    )
+
+
+def iter_plausible_chunk_headers(blocks, position):
+    """
+    Search the bytes of the iterable ``blocks``, which start at
+    ``position`` in the stream, for the chunk headers that
+    :func:`is_plausible_chunk_header` accepts.
+
+    Yield a (position, rest) tuple for each one, in order, where
+    ``rest`` is a memoryview of the bytes taken from ``blocks`` from
+    the header on.
+
+    Each block is searched for type codes with a regular expression,
+    along with the 7 bytes before it so that headers straddling two
+    blocks are seen, before the whole header is checked.
+    """
+    window = b''
+    for block in blocks:
+        window = window + block
+        # The type code comes after the 4 length bytes
+        match = _CHUNK_CODE_PATTERN.search(window, 4)
+        while match is not None:
+            offset = match.start() - 4
+            if is_plausible_chunk_header(
+                    window[offset:offset + 8], position + offset):
+                yield position + offset, memoryview(window)[offset:]
+            match = _CHUNK_CODE_PATTERN.search(window, match.start() + 1)
+        keep = min(len(window), 7)
+        position += len(window) - keep
+        window = window[len(window) - keep:]
+
+
 class ChunkTokenStream(typing.Iterable[models.ChunkToken]):
     """
     Produces chunk tokens for processing in the higher levels of the
@@ -39,21 +106,91 @@ class ChunkTokenStream(typing.Iterable[models.ChunkToken]):
     -   Valid chunk code
     -   CRC32 checksum
 
+    Chunks whose type codes are in ``skip_data_codes`` are lexed
+    without their data: no :class:`models.ChunkDataPartToken` is
+    produced for them, the data is seeked past (or read and discarded
+    if the stream isn't seekable), and their CRC32 checksum is not
+    calculated, so the end token's ``crc32ok`` is ``None``. Pass
+    :data:`ALL_CHUNK_CODES` to skip the data of every chunk.
+
+    If ``data_token_codes`` is given, data part tokens are only
+    produced for chunks with those type codes. The data of other
+    chunks is still read and checksummed.
+
+    If ``content_hash`` is given, it is a :mod:`hashlib` hash object
+    that is updated with every byte read from the stream. Skipped data
+    is then read rather than seeked past, so it is hashed too.
+
+    If ``instrumentation`` is given, the time spent reading, skipping,
+    and calculating checksums is measured in the ``read``, ``skip``
+    and ``crc`` stages of that :class:`instrumentation.Instrumentation`.
+
+    If ``diagnostics`` is given, it is a list that recoverable problems
+    are appended to as :class:`models.Diagnostic` instances instead of
+    raising. A chunk with a CRC32 mismatch is then produced as usual,
+    with ``crc32ok`` false in its end token. An invalid chunk header is
+    skipped by scanning forward in blocks with
+    :func:`iter_plausible_chunk_headers` for the next plausible one;
+    if the stream ends first, so do the tokens.
+
     :ivar total_bytes_read:
         Total number of bytes consumed from the underlying file object
     :ivar _stream:
         The underlying binary stream containing the PNG data
+    :ivar _skip_data_codes:
+        Chunk type codes for which the data is skipped
+    :ivar _data_token_codes:
+        Chunk type codes for which data part tokens are produced, or
+        ``None`` for all chunks
+    :ivar _content_hash:
+        The hash object updated with the bytes read, or ``None``
+    :ivar _diagnostics:
+        The list of :class:`models.Diagnostic` to append recoverable
+        problems to, or ``None`` to raise them
     :ivar _chunk_state:
         The state of the chunk being worked on currently. Set to
         ``None`` between chunks.
+    :ivar _unread:
+        Bytes read from the stream past a chunk header found by
+        scanning, which are read again before the stream
     """
     total_bytes_read = 0  # type: int
     _stream = None  # type: typing.io.BinaryIO
+    _skip_data_codes = frozenset()  # type: typing.FrozenSet[bytes]
+    _data_token_codes = None  # type: typing.Optional[typing.FrozenSet[bytes]]
+    _content_hash = None
+    _diagnostics = None  # type: typing.Optional[list]
     _chunk_state = None  # type: typing.Union['_ChunkOrderState', None]
+    _unread = b''  # type: bytes
 
-    def __init__(self, stream):
+    def __init__(self, stream, skip_data_codes=frozenset(),
+                 data_token_codes=None, content_hash=None,
+                 instrumentation=None, diagnostics=None):
         self._stream = stream
+        self._content_hash = content_hash
+        self._diagnostics = diagnostics
+        if skip_data_codes is not ALL_CHUNK_CODES:
+            skip_data_codes = frozenset(skip_data_codes)
+        self._skip_data_codes = skip_data_codes
+        if data_token_codes is not None:
+            data_token_codes = frozenset(data_token_codes)
+        self._data_token_codes = data_token_codes
         self.total_bytes_read = 0
+        self._unread = b''
+        self._new_chunk_state = _SingleChunkState
+        if instrumentation is not None:
+            self._instrument(instrumentation)
+
+    def _instrument(self, instrumentation):
+        instrumentation.wrap_method(
+            self, '_read_stream', 'read', count_bytes='result')
+        instrumentation.wrap_method(self, '_skip', 'skip')
+
+        def new_chunk_state(head):
+            return instrumentation.wrap_method(
+                _SingleChunkState(head), 'update', 'crc',
+                count_bytes='argument')
+        self._new_chunk_state = new_chunk_state
 
     def __iter__(self):
         """
@@ -76,16 +213,32 @@ class ChunkTokenStream(typing.Iterable[models.ChunkToken]):
                 return
 
             head = self._get_chunk_head(initial)
+            if head is None:
+                # No chunk header found after an invalid one
+                return
             yield head
-            while self._chunk_state.next_read > 0:
-                yield self._get_chunk_data()
+            if head.code in self._skip_data_codes:
+                yield self._skip_chunk_data_and_end()
+                continue
+            if (
+                    self._data_token_codes is None or
+                    head.code in self._data_token_codes
+                ):
+                while self._chunk_state.next_read > 0:
+                    yield self._get_chunk_data()
+            else:
+                self._discard_chunk_data()
             end = self._get_chunk_end()
             if not end.crc32ok:
                 fmt = 'CRC32 check failed for {code} after {nbytes} bytes read'
-                raise exceptions.BadCRC(fmt.format(
+                error = exceptions.BadCRC(fmt.format(
                     code=head.code,
                     nbytes=self.total_bytes_read,
                 ))
+                if self._diagnostics is None:
+                    raise error
+                self._diagnostics.append(models.Diagnostic.from_error(
+                    models.DiagnosticCode.crc_mismatch, head, error))
             yield end
 
     def _validate_signature(self):
@@ -105,36 +258,94 @@ class ChunkTokenStream(typing.Iterable[models.ChunkToken]):
 
         :param prepend_byte: The first byte of the chunk length field
 
-        :return: The chunk head model
+        :return:
+            The chunk head model, or ``None`` if diagnostics are
+            collected, the header was invalid, and the stream ended
+            before another plausible header
         """
         if self._chunk_state is not None:
             raise exceptions.StreamStateError(
                 "Must finish last chunk before starting another"
             )
-        # One byte has already been read by this chunk, so don't add
-        # another to the count.
-        start_position = self.total_bytes_read
-        [length] = struct.unpack('>I', prepend_byte + self._read(3))
-        if length > PNG_MAX_CHUNK_LENGTH:
-            fmt = (
-                "Chunk claims to be {actual} bytes long, must be "
-                "no longer than {max}."
-            )
-            raise exceptions.PNGSyntaxError(fmt.format(
-                actual=length,
-                max=PNG_MAX_CHUNK_LENGTH
-            ))
-        type_code = self._read(4)
-        if not models.PNG_CHUNK_TYPE_CODE_ALLOWED_BYTES.issuperset(type_code):
-            raise exceptions.PNGSyntaxError(
-                "Invalid type code for chunk at byte {position}".format(
-                    position=start_position,
+        # One byte has already been read by this chunk, so the chunk
+        # started one byte before the current position.
+        start_position = self.total_bytes_read - len(prepend_byte)
+        header = prepend_byte + self._read(3)
+        [length] = struct.unpack('>I', header)
+        try:
+            if length > PNG_MAX_CHUNK_LENGTH:
+                fmt = (
+                    "Chunk claims to be {actual} bytes long, must be "
+                    "no longer than {max}."
                 )
-            )
+                raise exceptions.PNGSyntaxError(fmt.format(
+                    actual=length,
+                    max=PNG_MAX_CHUNK_LENGTH
+                ))
+            type_code = self._read(4)
+            header += type_code
+            if not models.PNG_CHUNK_TYPE_CODE_ALLOWED_BYTES.issuperset(
+                    type_code):
+                raise exceptions.PNGSyntaxError(
+                    "Invalid type code for chunk at byte {position}".format(
+                        position=start_position,
+                    )
+                )
+        except exceptions.PNGSyntaxError as exc:
+            if self._diagnostics is None:
+                raise
+            self._diagnostics.append(models.Diagnostic(
+                code=models.DiagnosticCode.invalid_chunk_header,
+                position=start_position,
+                chunk_code=None,
+                error_type=type(exc).__name__,
+                message=str(exc),
+            ))
+            return self._resynchronize(header, start_position)
         head = models.ChunkHeadToken(length, type_code, start_position)
-        self._chunk_state = _SingleChunkState(head)
+        self._chunk_state = self._new_chunk_state(head)
+        return head
+
+    def _resynchronize(self, window, position):
+        """
+        Scan forward from an invalid chunk header for one that
+        :func:`is_plausible_chunk_header` accepts.
+
+        :param window: The bytes read of the invalid header
+        :param position: Where the invalid header started
+        :return:
+            The head of the chunk found, or ``None`` if the stream
+            ended first
+        """
+        blocks = itertools.chain([window[1:]], self._iter_blocks())
+        for position, rest in iter_plausible_chunk_headers(
+                blocks, position + 1):
+            break
+        else:
+            return None
+        header = bytes(rest[:8])
+        # Read again for the chunk data
+        self._unread = bytes(rest[8:])
+        self.total_bytes_read -= len(self._unread)
+        [length] = struct.unpack('>I', header[:4])
+        head = models.ChunkHeadToken(length, header[4:], position)
+        self._chunk_state = self._new_chunk_state(head)
         return head
 
+    def _iter_blocks(self):
+        """
+        Yield the rest of the stream a block at a time.
+        """
+        while True:
+            # Raises PNGTooLarge once the limit is reached
+            length = min(
+                _SCAN_READ_SIZE,
+                PNG_MAX_FILE_SIZE - self.total_bytes_read) or 1
+            block = self._read_up_to(length)
+            if not block:
+                return
+            yield block
+
     def _get_chunk_data(self) -> models.ChunkDataPartToken:
         """
         Read N bytes of chunk data, where N is the ``next_read``
@@ -149,6 +360,14 @@ class ChunkTokenStream(typing.Iterable[models.ChunkToken]):
         self._chunk_state.update(data)
         return models.ChunkDataPartToken(self._chunk_state.head, data)
 
+    def _discard_chunk_data(self):
+        """
+        Read and checksum the rest of the chunk's data without
+        producing tokens for it.
+        """
+        while self._chunk_state.next_read > 0:
+            self._chunk_state.update(self._read(self._chunk_state.next_read))
+
     def _get_chunk_end(self) -> models.ChunkEndToken:
         """
         Interpret the next 4 bytes in the stream as the chunk's
@@ -166,13 +385,31 @@ class ChunkTokenStream(typing.Iterable[models.ChunkToken]):
         self._chunk_state = None
         return rval
 
-    def _read(self, length: int) -> bytes:
+    def _skip_chunk_data_and_end(self) -> models.ChunkEndToken:
         """
-        Read ``length`` bytes from the stream, update
-        :ivar:`total_bytes_read`, and return the bytes.
+        Skip over the rest of the chunk's data and its CRC32 checksum
+        without calculating it, and wipe the state.
+        """
+        if self._chunk_state is None:
+            raise exceptions.StreamStateError(
+                "Incorrect chunk state for skipping data"
+            )
+        self._skip(self._chunk_state.data_remaining)
+        # Read rather than skip the checksum, so a stream truncated
+        # anywhere in the skipped data still raises UnexpectedEOF.
+        self._read(4)
+        rval = models.ChunkEndToken(self._chunk_state.head, None)
+        self._chunk_state = None
+        return rval
 
-        If the read results in fewer bytes than requested, raise
-        :exc:`exceptions.UnexpectedEOF`.
+    def _skip(self, length: int):
+        """
+        Advance ``length`` bytes in the stream without keeping the
+        data, and update :ivar:`total_bytes_read`.
+
+        Seekable streams are seeked, so the skipped bytes are never
+        read. Seeking past the end of the stream is detected by the
+        next read.
         """
         if length + self.total_bytes_read > PNG_MAX_FILE_SIZE:
             raise exceptions.PNGTooLarge(
@@ -180,10 +417,31 @@ class ChunkTokenStream(typing.Iterable[models.ChunkToken]):
                     size=PNG_MAX_FILE_SIZE,
                 )
             )
-        data = self._stream.read(length)
+        seekable = getattr(self._stream, 'seekable', None)
+        if (
+                self._content_hash is None and
+                seekable is not None and seekable()
+            ):
+            unread = min(length, len(self._unread))
+            self._unread = self._unread[unread:]
+            self._stream.seek(length - unread, io.SEEK_CUR)
+            self.total_bytes_read += length
+            return
+        while length > 0:
+            amount = min(length, _SingleChunkState.PNG_CHUNK_MAX_DATA_READ)
+            self._read(amount)
+            length -= amount
+
+    def _read(self, length: int) -> bytes:
+        """
+        Read ``length`` bytes from the stream, update
+        :ivar:`total_bytes_read`, and return the bytes.
+
+        If the read results in fewer bytes than requested, raise
+        :exc:`exceptions.UnexpectedEOF`.
+        """
+        data = self._read_up_to(length)
         actual = len(data)
-        self.total_bytes_read += actual
-        assert length >= actual, "Read more bytes than requested"
         if length > actual:
             fmt = "Expected to read {length}, got {actual}, total read {total}"
             raise exceptions.UnexpectedEOF(fmt.format(
@@ -193,6 +451,38 @@ class ChunkTokenStream(typing.Iterable[models.ChunkToken]):
             ))
         return data
 
+    def _read_up_to(self, length: int) -> bytes:
+        """
+        Read up to ``length`` bytes, fewer only at the end of the
+        stream, update :ivar:`total_bytes_read`, and return the bytes.
+        """
+        if length + self.total_bytes_read > PNG_MAX_FILE_SIZE:
+            raise exceptions.PNGTooLarge(
+                "Attempted to read past file size limit: {size} bytes".format(
+                    size=PNG_MAX_FILE_SIZE,
+                )
+            )
+        if self._unread:
+            data = self._unread[:length]
+            self._unread = self._unread[length:]
+            if len(data) < length:
+                data += self._read_stream(length - len(data))
+        else:
+            data = self._read_stream(length)
+        self.total_bytes_read += len(data)
+        return data
+
+    def _read_stream(self, length: int) -> bytes:
+        """
+        Read up to ``length`` bytes from the stream itself, and hash
+        them if :ivar:`_content_hash` is set.
+        """
+        data = self._stream.read(length)
+        assert length >= len(data), "Read more bytes than requested"
+        if self._content_hash is not None:
+            self._content_hash.update(data)
+        return data
+
 
 class _SingleChunkState:
     """
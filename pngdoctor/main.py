@@ -1,18 +1,386 @@
+import argparse
+import contextlib
+import json
+import math
+import os
 import sys
 import logging
 
-from pngdoctor.lexer import ChunkTokenStream
-
 logger = logging.getLogger(__name__)
 
 
 def log_chunk_tokens(pngfile):
+    from pngdoctor.lexer import ChunkTokenStream
     tokenizer = ChunkTokenStream(pngfile)
     for token in tokenizer:
         logger.info(repr(token))
 
 
-def main():
+def _run_tokens(args):
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
-    with open(sys.argv[1], 'rb') as pngfile:
+    with open(args.path, 'rb') as pngfile:
         log_chunk_tokens(pngfile)
+    return 0
+
+
+def _run_check(args):
+    from pngdoctor.batch import (
+        CheckOptions, check_files, check_files_deduplicated, iter_png_paths
+    )
+    from pngdoctor.parser import ParseMode
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    options = CheckOptions(
+        mode=ParseMode.metadata if args.metadata else ParseMode.full,
+        verify_image_data_crc=not args.skip_image_data_crc,
+        instrument=args.metrics_file is not None,
+        trace_memory=args.trace_memory,
+        collect_diagnostics=args.diagnostics,
+    )
+    failed = False
+
+    def on_walk_error(exc):
+        nonlocal failed
+        failed = True
+        logger.error("Cannot scan %s: %s", exc.filename, exc.strerror)
+
+    format_result = _RESULT_FORMATTERS[args.format]
+    paths = iter_png_paths(args.paths, onerror=on_walk_error)
+    with contextlib.ExitStack() as stack:
+        cache = None
+        if args.cache is not None:
+            from pngdoctor.cache import CacheKeyMode, ResultCache
+            cache = stack.enter_context(ResultCache(
+                args.cache,
+                key_mode=CacheKeyMode[args.cache_key],
+                max_entries=args.cache_max_entries,
+            ))
+        exporter = None
+        if args.metrics_file is not None:
+            from pngdoctor.metrics import BatchMetrics, TextfileExporter
+            exporter = TextfileExporter(
+                args.metrics_file,
+                BatchMetrics(),
+                interval=args.metrics_interval,
+            )
+            exporter.start()
+            stack.callback(exporter.close)
+        run_checks = check_files_deduplicated if args.dedup else check_files
+        for result in run_checks(
+                paths, options, jobs=args.jobs, cache=cache):
+            failed = failed or not result.ok
+            if exporter is not None:
+                exporter.observe(result)
+            sys.stdout.write(format_result(result) + '\n')
+            sys.stdout.flush()
+    return 1 if failed else 0
+
+
+def _format_result_text(result):
+    if result.ok:
+        line = 'OK {path}'.format(path=result.path)
+    else:
+        line = 'FAIL {path}: {type}: {message}'.format(
+            path=result.path,
+            type=result.error_type,
+            message=result.error_message,
+        )
+    if result.peak_memory is not None:
+        line += ' (peak memory {peak} bytes in {stage})'.format(
+            peak=result.peak_memory, stage=result.peak_memory_stage)
+    lines = [line]
+    for diagnostic in result.diagnostics or ():
+        if diagnostic['offset'] is None:
+            fmt = '  {code}: {message}'
+        else:
+            fmt = '  byte {offset}: {code}: {message}'
+        lines.append(fmt.format(**diagnostic))
+    return '\n'.join(lines)
+
+
+def _format_result_jsonl(result):
+    return json.dumps(result.to_record(), separators=(',', ':'))
+
+
+_RESULT_FORMATTERS = {
+    'text': _format_result_text,
+    'jsonl': _format_result_jsonl,
+}
+
+
+def _run_serve(args):
+    from pngdoctor.server import create_listener, serve
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    listener = create_listener(unix_path=args.unix, port=args.port)
+    exporter = None
+    if args.metrics_file is not None:
+        from pngdoctor.metrics import BatchMetrics, TextfileExporter
+        exporter = TextfileExporter(
+            args.metrics_file,
+            BatchMetrics(),
+            interval=args.metrics_interval,
+        )
+    try:
+        serve(listener, workers=args.workers, timeout=args.timeout,
+              exporter=exporter)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        if args.unix is not None:
+            os.unlink(args.unix)
+    return 0
+
+
+def _run_repair(args):
+    from pngdoctor.exceptions import DecodeError
+    from pngdoctor.rewrite import repair
+
+    try:
+        repairs = repair(args.input, args.output)
+    except (DecodeError, OSError) as exc:
+        sys.stderr.write('Cannot repair {path}: {error}\n'.format(
+            path=args.input, error=exc))
+        return 1
+    for change in repairs:
+        if change.position is None:
+            fmt = '{action}: {message}'
+        else:
+            fmt = 'byte {position}: {action}: {message}'
+        sys.stdout.write(fmt.format(
+            action=change.action.name,
+            position=change.position,
+            message=change.message,
+        ) + '\n')
+    return 0
+
+
+def _run_strip(args):
+    from pngdoctor.exceptions import DecodeError
+    from pngdoctor.rewrite import StripPolicy, strip
+
+    policies = [StripPolicy[name] for name in args.policies]
+    codes = [code.encode('ascii') for code in args.chunks]
+    if not policies and not codes:
+        policies = [StripPolicy.ancillary]
+    try:
+        removed = strip(args.input, args.output, policies, codes)
+    except (DecodeError, OSError, ValueError) as exc:
+        sys.stderr.write('Cannot strip {path}: {error}\n'.format(
+            path=args.input, error=exc))
+        return 1
+    for head in removed:
+        sys.stdout.write('byte {position}: removed {code}\n'.format(
+            position=head.position, code=head.code.decode('ascii')))
+    return 0
+
+
+def _run_rechunk(args):
+    from pngdoctor.exceptions import DecodeError
+    from pngdoctor.rewrite import rechunk
+
+    try:
+        chunks_read, chunks_written = rechunk(
+            args.input, args.output, args.size)
+    except (DecodeError, OSError, ValueError) as exc:
+        sys.stderr.write('Cannot rechunk {path}: {error}\n'.format(
+            path=args.input, error=exc))
+        return 1
+    sys.stdout.write('IDAT chunks: {read} -> {written}\n'.format(
+        read=chunks_read, written=chunks_written))
+    return 0
+
+
+def _run_index(args):
+    from pngdoctor.decoder import RowIndex
+    from pngdoctor.exceptions import DecodeError
+
+    output = args.output
+    if output is None:
+        output = args.input + '.rowindex'
+    try:
+        with open(args.input, 'rb') as pngfile:
+            index = RowIndex.build(pngfile, args.rows)
+        index.save(output)
+    except (DecodeError, OSError, ValueError) as exc:
+        sys.stderr.write('Cannot index {path}: {error}\n'.format(
+            path=args.input, error=exc))
+        return 1
+    sys.stdout.write('{count} checkpoints written to {path}\n'.format(
+        count=len(index.checkpoints), path=output))
+    return 0
+
+
+def _chunk_code(value):
+    from pngdoctor.models import PNG_CHUNK_TYPE_CODE_ALLOWED_BYTES
+    code = value.encode('ascii', 'replace')
+    if (len(code) != 4
+            or not PNG_CHUNK_TYPE_CODE_ALLOWED_BYTES.issuperset(code)):
+        raise argparse.ArgumentTypeError(
+            "must be four ASCII letters, not {0!r}".format(value))
+    return value
+
+
+def _positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+
+def _positive_float(value):
+    number = float(value)
+    if not 0 < number < math.inf:
+        raise argparse.ArgumentTypeError("must be positive and finite")
+    return number
+
+
+def _build_argument_parser():
+    parser = argparse.ArgumentParser(prog='pngdoctor')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    tokens = subparsers.add_parser(
+        'tokens', help="Log the chunk tokens of a PNG file")
+    tokens.add_argument('path')
+    tokens.set_defaults(run=_run_tokens)
+
+    check = subparsers.add_parser(
+        'check', help="Validate PNG files and directory trees")
+    check.add_argument(
+        'paths', nargs='+', metavar='PATH',
+        help="PNG files, or directories to search for PNG files")
+    check.add_argument(
+        '-j', '--jobs', type=_positive_int, default=os.cpu_count() or 1,
+        help="Number of worker processes (default: number of CPUs)")
+    check.add_argument(
+        '--metadata', action='store_true',
+        help="Validate everything except the compressed image data")
+    check.add_argument(
+        '--skip-image-data-crc', action='store_true',
+        help="With --metadata, skip over the IDAT data without reading it")
+    check.add_argument(
+        '--format', choices=sorted(_RESULT_FORMATTERS), default='text',
+        help="Output format: text lines or JSON Lines (default: text)")
+    check.add_argument(
+        '--dedup', action='store_true',
+        help="Validate files with identical content only once. All paths "
+             "are collected before validation starts.")
+    check.add_argument(
+        '--cache', metavar='FILE',
+        help="Reuse and store results in this cache database, so "
+             "unchanged files are not validated again")
+    check.add_argument(
+        '--cache-key', choices=['stat', 'content'], default='stat',
+        help="Identify unchanged files by inode and modification time, "
+             "or by a hash of their content, which reads files without a "
+             "cached result twice (default: stat)")
+    check.add_argument(
+        '--cache-max-entries', type=_positive_int, default=1000000,
+        help="Evict the least recently used results beyond this many "
+             "(default: 1000000)")
+    check.add_argument(
+        '--diagnostics', action='store_true',
+        help="Go on after recoverable problems, such as CRC mismatches "
+             "and misplaced chunks, and report them all")
+    check.add_argument(
+        '--trace-memory', action='store_true',
+        help="Report the peak Python memory used for each file and the "
+             "parsing stage that reached it. Slows validation down.")
+    check.add_argument(
+        '--metrics-file', metavar='FILE',
+        help="Write throughput, error and latency metrics to this file in "
+             "the Prometheus textfile collector format. Enables per-stage "
+             "timing of the parser.")
+    check.add_argument(
+        '--metrics-interval', type=_positive_float, default=15.0,
+        help="Seconds between rewrites of --metrics-file, which is also "
+             "written when the check ends (default: 15)")
+    check.set_defaults(run=_run_check)
+
+    repair = subparsers.add_parser(
+        'repair',
+        help="Write a copy of a PNG file with fixed CRCs, chunk lengths "
+             "and ancillary chunk order")
+    repair.add_argument('input', metavar='IN', help="The damaged PNG file")
+    repair.add_argument(
+        'output', metavar='OUT',
+        help="Where to write the repaired file, replaced only on success")
+    repair.set_defaults(run=_run_repair)
+
+    strip = subparsers.add_parser(
+        'strip',
+        help="Write a copy of a PNG file without some ancillary chunks")
+    strip.add_argument('input', metavar='IN', help="The PNG file")
+    strip.add_argument(
+        'output', metavar='OUT',
+        help="Where to write the stripped file, replaced only on success")
+    strip.add_argument(
+        '--policy', dest='policies', action='append', default=[],
+        choices=['ancillary', 'unsafe_to_copy', 'private'],
+        help="Remove every ancillary chunk, those that are not safe to "
+             "copy, or those that are private. May be repeated.")
+    strip.add_argument(
+        '--chunk', dest='chunks', action='append', default=[],
+        type=_chunk_code, metavar='CODE',
+        help="Remove the ancillary chunks with this type code. May be "
+             "repeated. Without --policy or --chunk, every ancillary "
+             "chunk is removed.")
+    strip.set_defaults(run=_run_strip)
+
+    rechunk = subparsers.add_parser(
+        'rechunk',
+        help="Write a copy of a PNG file with the image data split into "
+             "IDAT chunks of one size")
+    rechunk.add_argument('input', metavar='IN', help="The PNG file")
+    rechunk.add_argument(
+        'output', metavar='OUT',
+        help="Where to write the new file, replaced only on success")
+    rechunk.add_argument(
+        '--size', type=_positive_int, default=2**16, metavar='BYTES',
+        help="Data length of the IDAT chunks (default: 65536)")
+    rechunk.set_defaults(run=_run_rechunk)
+
+    index = subparsers.add_parser(
+        'index',
+        help="Write a sidecar row index of a PNG file, for decoding any "
+             "of its rows without inflating the image data before them")
+    index.add_argument('input', metavar='IN', help="The PNG file")
+    index.add_argument(
+        '-o', '--output', metavar='FILE',
+        help="Where to write the index (default: IN.rowindex)")
+    index.add_argument(
+        '--rows', type=_positive_int, default=64,
+        help="Number of rows between checkpoints (default: 64)")
+    index.set_defaults(run=_run_index)
+
+    serve = subparsers.add_parser(
+        'serve', help="Answer validation requests on a socket")
+    address = serve.add_mutually_exclusive_group(required=True)
+    address.add_argument(
+        '--unix', metavar='PATH', help="Listen on this Unix domain socket")
+    address.add_argument(
+        '--port', type=int, help="Listen on this TCP port on localhost")
+    serve.add_argument(
+        '-w', '--workers', type=_positive_int, default=os.cpu_count() or 1,
+        help="Number of worker processes (default: number of CPUs)")
+    serve.add_argument(
+        '--timeout', type=_positive_float, default=10.0,
+        help="Default seconds allowed per request (default: 10)")
+    serve.add_argument(
+        '--metrics-file', metavar='FILE',
+        help="Write throughput, error and latency metrics to this file in "
+             "the Prometheus textfile collector format. Enables per-stage "
+             "timing of the parser.")
+    serve.add_argument(
+        '--metrics-interval', type=_positive_float, default=15.0,
+        help="Seconds between rewrites of --metrics-file, which is also "
+             "written when the server stops (default: 15)")
+    serve.set_defaults(run=_run_serve)
+    return parser
+
+
+def main(argv=None):
+    args = _build_argument_parser().parse_args(argv)
+    return args.run(args)
@@ -0,0 +1,290 @@
+"""
+Aggregated batch validation metrics, exported in the Prometheus text
+format for the node exporter textfile collector.
+"""
+import bisect
+import collections
+import os
+import tempfile
+import threading
+import time
+
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0,
+)
+
+# (upper bound in bytes, label) of the file size buckets, the last one
+# takes everything larger
+FILE_SIZE_BUCKETS = (
+    (16 * 2**10, '0-16KiB'),
+    (256 * 2**10, '16KiB-256KiB'),
+    (4 * 2**20, '256KiB-4MiB'),
+    (None, '4MiB+'),
+)
+
+
+def file_size_bucket(size):
+    """
+    Return the :data:`FILE_SIZE_BUCKETS` label for a file size.
+    """
+    for bound, label in FILE_SIZE_BUCKETS:
+        if bound is None or size < bound:
+            return label
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class BatchMetrics:
+    """
+    Aggregates :class:`batch.FileCheckResult` instances into counters,
+    rates and latency histograms.
+
+    Stage latencies are only available for results checked with
+    :attr:`batch.CheckOptions.instrument` set.
+    """
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._started = clock()
+        self._last_rate_time = self._started
+        self._last_rate_files = 0
+        self._last_rate_bytes = 0
+        self.files = 0
+        self.bytes = 0
+        self.cached_files = 0
+        self.errors = collections.Counter()
+        self.file_latency = collections.defaultdict(_Histogram)
+        self.stage_latency = collections.defaultdict(_Histogram)
+        self.files_per_second = 0.0
+        self.bytes_per_second = 0.0
+
+    def observe(self, result):
+        """
+        Add a :class:`batch.FileCheckResult` to the metrics.
+        """
+        self.files += 1
+        self.bytes += result.bytes_read
+        if not result.ok:
+            self.errors[result.error_type] += 1
+        if result.cached:
+            # Its timings are from when it was validated
+            self.cached_files += 1
+            return
+        self.file_latency[file_size_bucket(result.bytes_read)].observe(
+            result.elapsed)
+        for stage, seconds in (result.stage_timings or {}).items():
+            self.stage_latency[stage].observe(seconds)
+
+    def observe_error(self, error_type):
+        """
+        Count a file that failed without a result to add, such as one
+        that ran out of time.
+        """
+        self.files += 1
+        self.errors[error_type] += 1
+
+    def update_rates(self):
+        """
+        Set the files and bytes per second since the last call.
+        """
+        now = self._clock()
+        elapsed = now - self._last_rate_time
+        if elapsed > 0:
+            self.files_per_second = (
+                (self.files - self._last_rate_files) / elapsed)
+            self.bytes_per_second = (
+                (self.bytes - self._last_rate_bytes) / elapsed)
+        self._last_rate_time = now
+        self._last_rate_files = self.files
+        self._last_rate_bytes = self.bytes
+
+    def format_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{0}{1}{2} {3}'.format(
+                    name, suffix, _format_labels(labels), _format_value(value)
+                ))
+
+        metric('pngdoctor_files_total', 'counter',
+               "Files validated", [('', {}, self.files)])
+        metric('pngdoctor_files_cached_total', 'counter',
+               "Files answered from the result cache",
+               [('', {}, self.cached_files)])
+        metric('pngdoctor_bytes_total', 'counter',
+               "Bytes read from validated files", [('', {}, self.bytes)])
+        metric('pngdoctor_file_errors_total', 'counter',
+               "Files that failed validation, by error type",
+               [('', {'type': error_type}, count)
+                for error_type, count in sorted(self.errors.items())])
+        metric('pngdoctor_files_per_second', 'gauge',
+               "Files validated per second over the last interval",
+               [('', {}, self.files_per_second)])
+        metric('pngdoctor_bytes_per_second', 'gauge',
+               "Bytes read per second over the last interval",
+               [('', {}, self.bytes_per_second)])
+        metric('pngdoctor_file_duration_seconds', 'histogram',
+               "Time to validate a file, by file size",
+               _histogram_samples('size', self.file_latency))
+        metric('pngdoctor_stage_duration_seconds', 'histogram',
+               "Time spent per file in each parsing stage",
+               _histogram_samples('stage', self.stage_latency))
+        metric('pngdoctor_uptime_seconds', 'gauge',
+               "Seconds since the metrics started",
+               [('', {}, self._clock() - self._started)])
+        return '\n'.join(lines) + '\n'
+
+
+def _histogram_samples(label, histograms):
+    samples = []
+    for value, histogram in sorted(histograms.items()):
+        for bound, count in zip(
+                LATENCY_BUCKETS, histogram.cumulative_counts()):
+            samples.append(
+                ('_bucket', {label: value, 'le': _format_value(bound)}, count))
+        samples.append(
+            ('_bucket', {label: value, 'le': '+Inf'}, histogram.count))
+        samples.append(('_sum', {label: value}, histogram.sum))
+        samples.append(('_count', {label: value}, histogram.count))
+    return samples
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, _escape_label_value(value))
+        for name, value in sorted(labels.items())
+    ) + '}'
+
+
+def _escape_label_value(value):
+    return str(value).replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def write_textfile(path, text):
+    """
+    Replace the file at ``path`` with ``text`` atomically, so the
+    collector never reads a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    # The collector only reads *.prom files, so the temporary file
+    # is ignored until it's renamed
+    fd, temporary_path = tempfile.mkstemp(
+        dir=directory, prefix='.pngdoctor-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as textfile:
+            textfile.write(text)
+            textfile.flush()
+            os.fsync(textfile.fileno())
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+class TextfileExporter:
+    """
+    Writes :class:`BatchMetrics` to a textfile collector file every
+    ``interval`` seconds, and on :meth:`close`.
+
+    Writes are due once ``interval`` seconds have passed since the last
+    one. They are made as results arrive, and on :meth:`tick`, which is
+    called regularly by a timer thread after :meth:`start`, or by the
+    caller, for example after waiting for :meth:`time_until_write`.
+    """
+    def __init__(self, path, metrics, interval=15.0, clock=time.monotonic):
+        self._path = path
+        self._metrics = metrics
+        self._interval = interval
+        self._clock = clock
+        self._last_write = clock()
+        # Serializes the timer thread and the callers
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def observe(self, result):
+        with self._lock:
+            self._metrics.observe(result)
+        self.tick()
+
+    def observe_error(self, error_type):
+        """
+        See :meth:`BatchMetrics.observe_error`.
+        """
+        with self._lock:
+            self._metrics.observe_error(error_type)
+        self.tick()
+
+    def time_until_write(self):
+        """
+        Return the seconds until the next write is due, 0 if it is.
+        """
+        return max(0.0, self._last_write + self._interval - self._clock())
+
+    def tick(self):
+        """
+        Write the file if a write is due.
+        """
+        if not self.time_until_write():
+            self.write()
+
+    def start(self):
+        """
+        Start a daemon thread that writes the file when it is due, so
+        that it is refreshed even while no results arrive.
+        """
+        self._thread = threading.Thread(target=self._run_timer, daemon=True)
+        self._thread.start()
+
+    def _run_timer(self):
+        while not self._stopped.wait(self.time_until_write()):
+            self.tick()
+
+    def write(self):
+        with self._lock:
+            self._metrics.update_rates()
+            write_textfile(self._path, self._metrics.format_prometheus())
+            self._last_write = self._clock()
+
+    def close(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.write()
@@ -1,14 +1,22 @@
+import enum
 import itertools
 import typing
+import zlib
 
 import attr
 
+from pngdoctor import exceptions
+
 
 PNG_CHUNK_TYPE_PROPERTY_BITMASK = 0b00100000
 PNG_CHUNK_TYPE_CODE_ALLOWED_BYTES = frozenset(
     itertools.chain(range(65, 91), range(97, 123)))
 
 
+# Inflated zTXt text and iCCP profiles may be no larger than this
+PNG_MAX_INFLATED_SIZE = 20 * 2**20  # type: int # 20 MiB
+
+
 _valid_bytes = attr.validators.instance_of(bytes)
 
 
@@ -20,7 +28,7 @@ def _valid_chunk_type_code(instance, attribute, value):
         raise ValueError("{!r} contains invalid bytes".format(attribute))
 
 
-@attr.attributes
+@attr.attributes(frozen=True)
 class ChunkType:
     code = attr.attr(validator=_valid_chunk_type_code)  # type: bytes
 
@@ -87,8 +95,10 @@ class ChunkEndToken:
 
     :ivar head: The head token from this chunk
     :type head: :class:`ChunkHeadToken`
-    :ivar crc32ok: If the CRC32 checksum validated properly
-    :type crc32ok: bool
+    :ivar crc32ok:
+        If the CRC32 checksum validated properly, or ``None`` if the
+        chunk data was skipped and the checksum was not calculated
+    :type crc32ok: bool or None
     """
     head = attr.attr()  # type: ChunkHeadToken
     crc32ok = attr.attr()  # type: bool
@@ -98,6 +108,58 @@ class ChunkEndToken:
 ChunkToken = typing.Union[ChunkHeadToken, ChunkDataPartToken, ChunkEndToken]
 
 
+@enum.unique
+class DiagnosticCode(enum.Enum):
+    """
+    The kinds of recoverable problems recorded as :class:`Diagnostic`.
+    """
+    crc_mismatch = 0
+    invalid_chunk_header = 1
+    misplaced_chunk = 2
+    duplicate_chunk = 3
+    unknown_critical_chunk = 4
+    invalid_ancillary_chunk = 5
+    missing_trailer = 6
+
+
+@attr.attributes(frozen=True)
+class Diagnostic:
+    """
+    A recoverable problem found while parsing.
+
+    :ivar code: The :class:`DiagnosticCode`
+    :ivar position:
+        Where the chunk with the problem started in the stream, or
+        where an invalid chunk header was found
+    :ivar chunk_code:
+        The type code of the chunk with the problem, or ``None`` if
+        the problem isn't with one chunk
+    :ivar error_type:
+        The name of the :exc:`exceptions.DecodeError` subclass the
+        problem raises when diagnostics are not collected
+    :ivar message: The description of the problem
+    """
+    code = attr.attr()  # type: DiagnosticCode
+    position = attr.attr()  # type: typing.Optional[int]
+    chunk_code = attr.attr()  # type: typing.Optional[bytes]
+    error_type = attr.attr()  # type: str
+    message = attr.attr()  # type: str
+
+    @classmethod
+    def from_error(cls, code, head, error):
+        """
+        Create a diagnostic for the exception ``error`` raised for the
+        chunk starting with the :class:`ChunkHeadToken` ``head``.
+        """
+        return cls(
+            code=code,
+            position=None if head is None else head.position,
+            chunk_code=None if head is None else head.code,
+            error_type=type(error).__name__,
+            message=str(error),
+        )
+
+
 @attr.attributes
 class ImageHeader:
     width = attr.attr()
@@ -112,3 +174,445 @@ class ImageHeader:
 @attr.attributes
 class Palette:
     entries = attr.attr()
+
+
+@attr.attributes
+class ImageTrailer:
+    pass
+
+
+@attr.attributes
+class Transparency:
+    """
+    The tRNS chunk contents.
+
+    :ivar alphas:
+        For indexed color, the alpha values (bytes) for the first
+        palette entries. ``None`` otherwise.
+    :ivar color:
+        For grayscale and truecolor, the sample tuple of the single
+        transparent color. ``None`` otherwise.
+    """
+    alphas = attr.attr(default=None)
+    color = attr.attr(default=None)
+
+
+@attr.attributes
+class ImageGamma:
+    gamma = attr.attr()  # type: int # times 100000
+
+
+@attr.attributes
+class PrimaryChromaticities:
+    # All values are times 100000
+    white_point_x = attr.attr()
+    white_point_y = attr.attr()
+    red_x = attr.attr()
+    red_y = attr.attr()
+    green_x = attr.attr()
+    green_y = attr.attr()
+    blue_x = attr.attr()
+    blue_y = attr.attr()
+
+
+@attr.attributes
+class StandardRGBColorSpace:
+    rendering_intent = attr.attr()
+
+
+@attr.attributes
+class TextualData:
+    """
+    The tEXt chunk contents.
+
+    :ivar keyword: The keyword
+    :ivar text:
+        The text, or ``None`` if it was too large to store
+    :ivar text_length: The length of the text in bytes
+    :ivar text_sha256:
+        The hex SHA-256 digest of the text bytes if the text was too
+        large to store, otherwise ``None``
+    """
+    keyword = attr.attr()  # type: str
+    text = attr.attr()  # type: typing.Optional[str]
+    text_length = attr.attr(default=None)  # type: int
+    text_sha256 = attr.attr(default=None)  # type: typing.Optional[str]
+
+
+def _inflate(compressed, max_length):
+    """
+    Decompress a complete zlib datastream, and return the bytes.
+
+    Raise :exc:`exceptions.PNGTooLarge` if the result would be larger
+    than ``max_length`` bytes.
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(compressed, max_length)
+    except zlib.error as exc:
+        raise exceptions.PNGSyntaxError(
+            "Invalid compressed data: {0}".format(exc)
+        )
+    if decompressor.unconsumed_tail:
+        raise exceptions.PNGTooLarge(
+            "Compressed data inflates to more than {0} bytes".format(
+                max_length)
+        )
+    if not decompressor.eof:
+        raise exceptions.DecompressionNotFinished()
+    if decompressor.unused_data:
+        raise exceptions.DecompressionFinishedEarly()
+    return data
+
+
+class _LazilyInflated:
+    """
+    Mixin for models holding compressed data that is only inflated
+    when first needed.
+
+    Implementers must have a ``compressed`` attribute with the zlib
+    datastream, and an ``_inflated_cache`` attribute initially
+    ``None``.
+    """
+    # Inflated data no larger than this is kept after the first access,
+    # larger data is inflated again on every access.
+    INFLATED_CACHE_MAX_SIZE = 2**20  # type: int # 1 MiB
+
+    def _inflated(self):
+        if self._inflated_cache is not None:
+            return self._inflated_cache
+        data = _inflate(self.compressed, PNG_MAX_INFLATED_SIZE)
+        if len(data) <= self.INFLATED_CACHE_MAX_SIZE:
+            self._inflated_cache = data
+        return data
+
+
+@attr.attributes
+class EmbeddedICCProfile(_LazilyInflated):
+    """
+    The iCCP chunk contents.
+
+    The profile is inflated on first access of :attr:`profile`, and
+    kept if it is no larger than :attr:`INFLATED_CACHE_MAX_SIZE`
+    bytes. A larger profile is inflated again in full on every access,
+    so hold on to the bytes returned rather than reading
+    :attr:`profile` twice.
+
+    :ivar name: The profile name
+    :ivar compression_method: The compression method for the profile
+    :ivar compressed: The compressed profile bytes
+    """
+    name = attr.attr()  # type: str
+    compression_method = attr.attr()
+    compressed = attr.attr(repr=False)  # type: bytes
+    _inflated_cache = attr.attr(
+        default=None, init=False, repr=False, cmp=False)
+
+    @property
+    def profile(self):
+        """
+        The decompressed ICC profile bytes, inflated on each access if
+        they are too large to keep.
+        """
+        return self._inflated()
+
+
+@attr.attributes
+class CompressedTextualData(_LazilyInflated):
+    """
+    The zTXt chunk contents.
+
+    The text is inflated on first access of :attr:`text`, and kept if
+    it is no larger than :attr:`INFLATED_CACHE_MAX_SIZE` bytes. A
+    larger text is inflated again in full on every access, so hold on
+    to the string returned rather than reading :attr:`text` twice.
+
+    :ivar keyword: The keyword
+    :ivar compression_method: The compression method for the text
+    :ivar compressed: The compressed text bytes
+    """
+    keyword = attr.attr()  # type: str
+    compression_method = attr.attr()
+    compressed = attr.attr(repr=False)  # type: bytes
+    _inflated_cache = attr.attr(
+        default=None, init=False, repr=False, cmp=False)
+
+    @property
+    def text(self):
+        """
+        The decompressed text, inflated on each access if it is too
+        large to keep.
+        """
+        return self._inflated().decode('latin-1')
+
+
+@attr.attributes
+class InternationalTextualData(_LazilyInflated):
+    """
+    The iTXt chunk contents.
+
+    If the text is compressed, it is inflated on first access of
+    :attr:`text`, and inflated again on every access if it is larger
+    than :attr:`INFLATED_CACHE_MAX_SIZE` bytes, as for
+    :class:`CompressedTextualData`.
+
+    :ivar keyword: The keyword
+    :ivar compression_method:
+        The compression method for the text, or ``None`` if the text
+        is not compressed
+    :ivar language_tag: The language tag, possibly empty
+    :ivar translated_keyword: The keyword translated into the language
+    :ivar data:
+        The text field bytes (compressed or not), or ``None`` if they
+        were too large to store
+    :ivar data_length: The length of the text field in bytes
+    :ivar data_sha256:
+        The hex SHA-256 digest of the text field bytes if they were too
+        large to store, otherwise ``None``
+    """
+    keyword = attr.attr()  # type: str
+    compression_method = attr.attr()
+    language_tag = attr.attr()  # type: str
+    translated_keyword = attr.attr()  # type: str
+    data = attr.attr(repr=False)  # type: typing.Optional[bytes]
+    data_length = attr.attr()  # type: int
+    data_sha256 = attr.attr(default=None)  # type: typing.Optional[str]
+    _inflated_cache = attr.attr(
+        default=None, init=False, repr=False, cmp=False)
+
+    @property
+    def compressed(self):
+        if self.compression_method is None:
+            return None
+        return self.data
+
+    @property
+    def text(self):
+        """
+        The text, or ``None`` if it was too large to store.
+        """
+        if self.data is None:
+            return None
+        if self.compression_method is None:
+            data = self.data
+        else:
+            data = self._inflated()
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError as exc:
+            raise exceptions.PNGSyntaxError(
+                "Invalid iTXt text encoding: {0}".format(exc))
+
+
+@attr.attributes
+class BackgroundColor:
+    """
+    The bKGD chunk contents.
+
+    :ivar palette_index: The palette index for indexed color, or ``None``
+    :ivar color: The sample tuple for other color types, or ``None``
+    """
+    palette_index = attr.attr(default=None)
+    color = attr.attr(default=None)
+
+
+@attr.attributes
+class PhysicalPixelDimensions:
+    pixels_per_unit_x = attr.attr()
+    pixels_per_unit_y = attr.attr()
+    unit = attr.attr()
+
+
+@attr.attributes
+class SignificantBits:
+    bits = attr.attr()  # type: tuple
+
+
+@attr.attributes
+class SuggestedPalette:
+    """
+    The sPLT chunk contents.
+
+    Entries are stored as columns, each an ``array.array`` of equal
+    length: entry ``i`` is made of ``red[i]``, ``green[i]``,
+    ``blue[i]``, ``alpha[i]``, and ``frequency[i]``.
+
+    :ivar name: The palette name
+    :ivar sample_depth: The sample depth, 8 or 16
+    """
+    name = attr.attr()  # type: str
+    sample_depth = attr.attr()  # type: int
+    red = attr.attr(repr=False)
+    green = attr.attr(repr=False)
+    blue = attr.attr(repr=False)
+    alpha = attr.attr(repr=False)
+    frequency = attr.attr(repr=False)
+
+    def __len__(self):
+        return len(self.frequency)
+
+
+@attr.attributes
+class PaletteHistogram:
+    """
+    The hIST chunk contents.
+
+    :ivar frequencies:
+        An ``array('H')`` with the approximate usage frequency of each
+        palette entry
+    """
+    frequencies = attr.attr()
+
+
+@attr.attributes
+class ImageLastModificationTime:
+    year = attr.attr()
+    month = attr.attr()
+    day = attr.attr()
+    hour = attr.attr()
+    minute = attr.attr()
+    second = attr.attr()
+
+
+@attr.attributes
+class ParseResult:
+    """
+    The results of parsing a PNG stream, updated as each chunk is
+    parsed.
+
+    Chunks that may appear at most once are stored as a single model
+    (or ``None`` if absent), chunks that may appear multiple times are
+    stored in lists in stream order.
+
+    :ivar chunks: The head tokens of every chunk, in stream order
+    :ivar diagnostics:
+        The :class:`Diagnostic` instances of the recoverable problems
+        found, in stream order, if the parser collected them
+    """
+    image_header = attr.attr(default=None)
+    palette = attr.attr(default=None)
+    image_trailer = attr.attr(default=None)
+    transparency = attr.attr(default=None)
+    image_gamma = attr.attr(default=None)
+    primary_chromaticities = attr.attr(default=None)
+    standard_rgb_color_space = attr.attr(default=None)
+    embedded_icc_profile = attr.attr(default=None)
+    textual_data = attr.attr(default=attr.Factory(list))
+    compressed_textual_data = attr.attr(default=attr.Factory(list))
+    international_textual_data = attr.attr(default=attr.Factory(list))
+    background_color = attr.attr(default=None)
+    physical_pixel_dimensions = attr.attr(default=None)
+    significant_bits = attr.attr(default=None)
+    suggested_palettes = attr.attr(default=attr.Factory(list))
+    palette_histogram = attr.attr(default=None)
+    image_last_modification_time = attr.attr(default=None)
+    chunks = attr.attr(default=attr.Factory(list))
+    diagnostics = attr.attr(default=attr.Factory(list))
+
+    def record(self, attribute, model):
+        """
+        Store the chunk model in the named attribute, appending it if
+        the attribute holds a list.
+        """
+        current = getattr(self, attribute)
+        if isinstance(current, list):
+            current.append(model)
+        else:
+            setattr(self, attribute, model)
+
+
+@attr.attributes
+class DecodedImage:
+    """
+    Decoded pixels held in a single buffer, rows ``stride`` bytes apart.
+
+    Each pixel has ``channels`` samples in stream order. Samples take
+    one byte at bit depths up to 8 and two big-endian bytes at bit
+    depth 16, and are neither scaled nor looked up in the palette.
+
+    The pixels are exported without copying as a flat byte
+    :meth:`memoryview`, and to NumPy through :attr:`__array_interface__`
+    as an array of shape (height, width, channels).
+
+    :ivar pixels: The buffer holding the pixels, such as a bytearray
+    :ivar width: The number of pixels in a row
+    :ivar height: The number of rows
+    :ivar channels: The number of samples in a pixel
+    :ivar bit_depth: The bit depth of the image the samples came from
+    :ivar stride: The distance in bytes between the starts of two rows
+    """
+    pixels = attr.attr(repr=False, cmp=False)
+    width = attr.attr()  # type: int
+    height = attr.attr()  # type: int
+    channels = attr.attr()  # type: int
+    bit_depth = attr.attr()  # type: int
+    stride = attr.attr()  # type: int
+
+    @property
+    def sample_size(self):
+        """
+        The number of bytes of a sample.
+        """
+        return 2 if self.bit_depth == 16 else 1
+
+    @property
+    def row_size(self):
+        """
+        The number of bytes of the pixels of a row.
+        """
+        return self.width * self.channels * self.sample_size
+
+    def memoryview(self):
+        """
+        Return a flat byte memoryview of the pixel buffer.
+        """
+        return memoryview(self.pixels).cast('B')
+
+    def row(self, index):
+        """
+        Return a byte memoryview of the pixels of the row ``index``.
+        """
+        if not 0 <= index < self.height:
+            raise IndexError("Row {0} is not in the {1} rows".format(
+                index, self.height))
+        start = index * self.stride
+        return self.memoryview()[start:start + self.row_size]
+
+    @property
+    def __array_interface__(self):
+        sample_size = self.sample_size
+        return {
+            'version': 3,
+            'shape': (self.height, self.width, self.channels),
+            'typestr': '>u2' if sample_size == 2 else '|u1',
+            'strides': (
+                self.stride, self.channels * sample_size, sample_size),
+            'data': self.pixels,
+        }
+
+    def __array__(self, dtype=None, copy=None):
+        """
+        Return a NumPy array of the pixels. As in NumPy 2, ``copy``
+        ``None`` only copies them if ``dtype`` needs it, and ``False``
+        raises :exc:`ValueError` if it does.
+        """
+        # Imported here as NumPy is only needed by its users
+        import numpy  # pylint: disable=import-error
+        array = numpy.asarray(_ArrayInterface(self.__array_interface__))
+        if dtype is not None and numpy.dtype(dtype) != array.dtype:
+            if copy is False:
+                raise ValueError(
+                    "Pixels can't be converted to {0} without a copy".format(
+                        numpy.dtype(dtype)))
+            return array.astype(dtype)
+        return array.copy() if copy else array
+
+
+class _ArrayInterface:
+    """
+    Holds an array interface dict, so that NumPy can build an array
+    from it without calling :meth:`DecodedImage.__array__` again.
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, interface):
+        self.__array_interface__ = interface
@@ -1,25 +1,424 @@
+import enum
 import typing
 
-from pngdoctor.lexer import ChunkTokenStream
+from pngdoctor import chunktypes
+from pngdoctor import models
 from pngdoctor.chunk_order_parser import ChunkOrderParser
+from pngdoctor.chunk_parsers import (
+    chunk_parsers, _AbstractLimitedLengthChunkParser
+)
+from pngdoctor.exceptions import (
+    DecodeError, DuplicateChunk, MisplacedChunk, PNGSyntaxError
+)
+from pngdoctor.lexer import ChunkTokenStream
+
+
+class ParseMode(enum.Enum):
+    """
+    How much of the PNG stream :class:`PNGParser` processes.
+
+    -   ``full``: Every chunk is parsed, and the image data is
+        decompressed and unfiltered.
+    -   ``metadata``: Every chunk except IDAT is parsed. The IDAT
+        chunks are only lexed, the image data is never decompressed.
+    -   ``image_data``: Like ``metadata``, but the IDAT chunk data is
+        produced by :meth:`PNGParser.iter_image_data` for the caller
+        to decode.
+    """
+    full = 0
+    metadata = 1
+    image_data = 2
 
 
 class PNGParser:
     """
     A parser for PNG images
+
+    :ivar result:
+        The :class:`models.ParseResult` of the current or last call to
+        :meth:`parse`, or ``None`` before the first call. If parsing
+        failed, this holds the results up to the failure.
     """
+    result = None  # type: typing.Optional[models.ParseResult]
     _tokens = None  # type: ChunkTokenStream
     _order = None  # type: ChunkOrderParser
+    _mode = None  # type: ParseMode
+    _options = None  # type: typing.Dict[str, typing.Any]
 
-    def __init__(self, stream: typing.io.BinaryIO):
+    def __init__(self, stream: typing.io.BinaryIO,
+                 mode: ParseMode = ParseMode.full,
+                 verify_image_data_crc: bool = True,
+                 max_stored_text_size: typing.Optional[int] = None,
+                 content_hash=None,
+                 instrumentation=None,
+                 collect_diagnostics: bool = False):
         """
         :param stream: The binary data stream containing the PNG data
+        :param mode: How much of the stream to process
+        :param verify_image_data_crc:
+            In metadata mode, if this is false the IDAT chunk data is
+            skipped over without being read, so its CRC32 checksums are
+            not verified. Ignored in full mode.
+        :param max_stored_text_size:
+            The text of tEXt and iTXt chunks larger than this many
+            bytes is validated but not stored, only its length and
+            SHA-256 digest are kept. ``None`` stores all text.
+        :param content_hash:
+            A :mod:`hashlib` hash object to update with every byte
+            read from the stream, see :class:`lexer.ChunkTokenStream`
+        :param instrumentation:
+            An :class:`instrumentation.Instrumentation` to measure the
+            parsing stages in. Besides the stages of the components,
+            it gets an ``order`` stage for the chunk order validation,
+            a ``chunk.<type code>`` stage for each chunk type, and the
+            counts of each token type.
+        :param collect_diagnostics:
+            If true, recoverable problems don't stop parsing. They are
+            recorded in the ``diagnostics`` of the result instead, and
+            parsing goes on:
+
+            -   Chunks with a CRC32 mismatch are parsed anyway if they
+                are critical, and ignored if they are ancillary.
+            -   Invalid chunk headers are skipped up to the next
+                plausible header.
+            -   Misplaced and duplicate chunks, unknown critical chunks
+                and invalid ancillary chunks are ignored.
+            -   A missing IEND chunk is recorded at the end.
+
+            Other problems, such as invalid critical chunks or image
+            data, are still raised.
         """
-        self._tokens = ChunkTokenStream(stream)
+        # Only chunks with parsers need their data, and the image data
+        # is only needed if it is inflated.
+        data_token_codes = set(chunk_parsers.dispatch_table)
+        skip_data_codes = set()
+        if mode is ParseMode.metadata:
+            data_token_codes.discard(chunktypes.IMAGE_DATA.code)
+            if not verify_image_data_crc:
+                skip_data_codes.add(chunktypes.IMAGE_DATA.code)
+        self._diagnostics = [] if collect_diagnostics else None
+        self._tokens = ChunkTokenStream(
+            stream,
+            skip_data_codes=skip_data_codes,
+            data_token_codes=data_token_codes,
+            content_hash=content_hash,
+            instrumentation=instrumentation,
+            diagnostics=self._diagnostics,
+        )
         self._order = ChunkOrderParser()
+        self._mode = mode
+        self._options = {
+            'inflate': mode is ParseMode.full,
+            'max_stored_text_size': max_stored_text_size,
+            'instrumentation': instrumentation,
+        }
+        self._instrumentation = instrumentation
+        if instrumentation is not None:
+            instrumentation.wrap_method(self._order, 'validate', 'order')
 
-    def parse(self):
+    def parse(self) -> models.ParseResult:
         """
         Run the actual parsing routine.
+
+        Return the :class:`models.ParseResult` with the parsed models
+        of every chunk, or raise a subclass of
+        :exc:`exceptions.DecodeError` if the stream is invalid.
+        """
+        for _ in self._dispatch_tokens(yield_image_data=False):
+            pass
+        return self.result
+
+    def iter_image_data(self):
+        """
+        Parse the stream like :meth:`parse`, but yield the data of the
+        IDAT chunks as it is read instead of inflating it. The parser
+        must be in :attr:`ParseMode.image_data` mode.
+
+        The chunks before the image data, including the image header,
+        are in :attr:`result` by the time the first data is yielded.
+        Diagnostics and instrumentation work as in :meth:`parse`, and
+        the data of IDAT chunks ignored because of a diagnostic is not
+        yielded. If the generator is closed early, the rest of the
+        stream is neither read nor validated.
+        """
+        if self._mode is not ParseMode.image_data:
+            raise ValueError(
+                "Image data is only produced in image_data mode, not "
+                "{0}".format(self._mode))
+        return self._dispatch_tokens(yield_image_data=True)
+
+    def _dispatch_tokens(self, yield_image_data):
+        """
+        Parse the stream into a new :attr:`result`, yielding the IDAT
+        chunk data instead of parsing it if ``yield_image_data`` is
+        true.
+        """
+        self.result = result = models.ParseResult()
+        tokens = self._tokens
+        if self._instrumentation is not None:
+            tokens = self._instrumentation.count_items(tokens)
+        collecting = self._diagnostics is not None
+        if collecting:
+            result.diagnostics = self._diagnostics
+            if self._instrumentation is None:
+                state_class = _RecoveringChunkDispatchState
+            else:
+                state_class = _InstrumentedRecoveringChunkDispatchState
+            # The recovering state validates the chunk order itself
+            state = state_class(result, self._options, self._order)
+        elif self._instrumentation is None:
+            state = _ChunkDispatchState(result, self._options)
+        else:
+            state = _InstrumentedChunkDispatchState(result, self._options)
+        image_data_code = (
+            chunktypes.IMAGE_DATA.code if yield_image_data else None)
+        for token in tokens:
+            if isinstance(token, models.ChunkHeadToken):
+                if not collecting:
+                    self._order.validate(token.code)
+                result.chunks.append(token)
+                state.start_chunk(token)
+            elif isinstance(token, models.ChunkDataPartToken):
+                if token.head.code != image_data_code:
+                    state.chunk_data(token.data)
+                elif not state.ignoring:
+                    yield token.data
+            else:
+                state.end_chunk(token)
+        if not collecting:
+            self._order.validate_end()
+            return
+        state.finish()
+        try:
+            self._order.validate_end()
+        except PNGSyntaxError as exc:
+            result.diagnostics.append(models.Diagnostic.from_error(
+                models.DiagnosticCode.missing_trailer, None, exc))
+
+    @property
+    def bytes_read(self):
+        """
+        The number of bytes consumed from the stream so far.
+        """
+        return self._tokens.total_bytes_read
+
+
+class _ChunkDispatchState:
+    """
+    Routes the chunk tokens to the chunk parsers, and records the
+    chunk models in the parse result.
+    """
+    def __init__(self, result, options):
+        self._result = result
+        self._options = options
+        self._dispatch_table = chunk_parsers.dispatch_table
+        self._head = None
+        self._limited_length_parser_class = None
+        self._limited_length_data = None
+        self._iterative_parser = None
+        self._image_data_parser = None
+
+    def start_chunk(self, head):
+        self._head = head
+        self._finish_image_data(head.code)
+
+        parser_class = self._dispatch_table.get(head.code)
+        if parser_class is None:
+            # Same test as ChunkType.ancillary, without the model overhead
+            if not head.code[0] & models.PNG_CHUNK_TYPE_PROPERTY_BITMASK:
+                raise PNGSyntaxError(
+                    "Unknown critical chunk {code} at byte {position}".format(
+                        code=head.code, position=head.position)
+                )
+        elif head.code == chunktypes.IMAGE_DATA.code:
+            if self._image_data_parser is None:
+                self._image_data_parser = self._create_iterative_parser(
+                    parser_class)
+            self._iterative_parser = self._image_data_parser
+        elif issubclass(parser_class, _AbstractLimitedLengthChunkParser):
+            if head.length > parser_class.max_data_size:
+                fmt = (
+                    "Chunk {code} claims to be {actual} bytes long, must be "
+                    "no longer than {max}."
+                )
+                raise PNGSyntaxError(fmt.format(
+                    code=head.code,
+                    actual=head.length,
+                    max=parser_class.max_data_size,
+                ))
+            self._limited_length_parser_class = parser_class
+            self._limited_length_data = b''
+        else:
+            self._iterative_parser = self._create_iterative_parser(
+                parser_class)
+
+    @property
+    def ignoring(self):
         """
-        raise NotImplementedError('not done yet')
+        Whether the data of the current chunk is ignored.
+        """
+        return False
+
+    def chunk_data(self, data):
+        if self._iterative_parser is not None:
+            self._iterative_parser.parse_partial(data)
+        elif self._limited_length_parser_class is not None:
+            self._limited_length_data += data
+
+    def end_chunk(self, end):
+        # pylint: disable=unused-argument
+        if self._iterative_parser is not None:
+            parser = self._iterative_parser
+            model = parser.verify_end()
+        elif self._limited_length_parser_class is not None:
+            parser = self._limited_length_parser_class(
+                self._limited_length_data, self._result)
+            model = self._parse_limited_length(parser)
+        else:
+            parser = model = None
+        if model is not None:
+            self._result.record(parser.result_attribute, model)
+        self._reset()
+
+    def _reset(self):
+        self._head = None
+        self._limited_length_parser_class = None
+        self._limited_length_data = None
+        self._iterative_parser = None
+
+    def _finish_image_data(self, code):
+        """
+        Verify the end of the image data stream if ``code`` ends it.
+        """
+        if (
+                self._image_data_parser is not None and
+                code != chunktypes.IMAGE_DATA.code
+            ):
+            self._image_data_parser.verify_stream_end()
+            self._image_data_parser = None
+
+    def _create_iterative_parser(self, parser_class):
+        options = {
+            name: self._options[name] for name in parser_class.option_names
+        }
+        return parser_class(self._result, **options)
+
+    def _parse_limited_length(self, parser):
+        # pylint: disable=no-self-use
+        return parser.parse()
+
+
+class _InstrumentedChunkDispatchState(_ChunkDispatchState):
+    """
+    A :class:`_ChunkDispatchState` that measures each chunk parser in a
+    ``chunk.<type code>`` stage of the ``instrumentation`` option.
+    """
+    def _stage(self):
+        return 'chunk.' + self._head.code.decode('ascii')
+
+    def _create_iterative_parser(self, parser_class):
+        parser = super()._create_iterative_parser(parser_class)
+        stage = self._stage()
+        instrumentation = self._options['instrumentation']
+        instrumentation.wrap_method(
+            parser, 'parse_partial', stage, count_bytes='argument')
+        instrumentation.wrap_method(parser, 'verify_end', stage)
+        return parser
+
+    def _parse_limited_length(self, parser):
+        return self._options['instrumentation'].wrap(
+            self._stage(), parser.parse)()
+
+
+class _RecoveringChunkDispatchState(_ChunkDispatchState):
+    """
+    A :class:`_ChunkDispatchState` that also validates the chunk order,
+    and records recoverable problems as diagnostics in the parse
+    result, ignoring the chunks they were found in.
+    """
+    def __init__(self, result, options, order):
+        super().__init__(result, options)
+        self._order = order
+        self._ignoring = False
+
+    def start_chunk(self, head):
+        code = None
+        try:
+            self._order.validate(head.code)
+        except MisplacedChunk as exc:
+            code, error = models.DiagnosticCode.misplaced_chunk, exc
+        except DuplicateChunk as exc:
+            code, error = models.DiagnosticCode.duplicate_chunk, exc
+        else:
+            if not head.code[0] & models.PNG_CHUNK_TYPE_PROPERTY_BITMASK:
+                if head.code in self._dispatch_table:
+                    super().start_chunk(head)
+                    return
+                code = models.DiagnosticCode.unknown_critical_chunk
+                error = PNGSyntaxError(
+                    "Unknown critical chunk {code} at byte {position}".format(
+                        code=head.code, position=head.position)
+                )
+            else:
+                # Errors in the image data before it aren't the chunk's
+                self._finish_image_data(head.code)
+                try:
+                    super().start_chunk(head)
+                    return
+                except DecodeError as exc:
+                    code = models.DiagnosticCode.invalid_ancillary_chunk
+                    error = exc
+        self._ignore(code, head, error)
+
+    @property
+    def ignoring(self):
+        return self._ignoring
+
+    def chunk_data(self, data):
+        if self._ignoring:
+            return
+        if not self._head.code[0] & models.PNG_CHUNK_TYPE_PROPERTY_BITMASK:
+            super().chunk_data(data)
+            return
+        try:
+            super().chunk_data(data)
+        except DecodeError as exc:
+            self._ignore(
+                models.DiagnosticCode.invalid_ancillary_chunk, self._head, exc)
+
+    def end_chunk(self, end):
+        if self._ignoring:
+            self._ignoring = False
+            self._reset()
+            return
+        if not self._head.code[0] & models.PNG_CHUNK_TYPE_PROPERTY_BITMASK:
+            super().end_chunk(end)
+        elif end.crc32ok is False:
+            # The lexer recorded the mismatch, the data can't be trusted
+            self._reset()
+        else:
+            try:
+                super().end_chunk(end)
+            except DecodeError as exc:
+                self._result.diagnostics.append(models.Diagnostic.from_error(
+                    models.DiagnosticCode.invalid_ancillary_chunk,
+                    self._head, exc))
+                self._reset()
+
+    def finish(self):
+        """
+        Verify the end of the image data stream if the chunks ended
+        without an IEND chunk to do it.
+        """
+        self._finish_image_data(chunktypes.IMAGE_TRAILER.code)
+
+    def _ignore(self, code, head, error):
+        self._result.diagnostics.append(
+            models.Diagnostic.from_error(code, head, error))
+        self._head = head
+        self._ignoring = True
+
+
+class _InstrumentedRecoveringChunkDispatchState(
+        _InstrumentedChunkDispatchState, _RecoveringChunkDispatchState):
+    pass
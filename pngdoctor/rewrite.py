@@ -0,0 +1,741 @@
+"""
+Rewriting PNG files chunk by chunk.
+
+The rewriters build a :class:`_RewritePlan` of byte ranges to copy from
+the input file and new bytes to write in between, then execute it. The
+copied ranges are copied by the kernel with :func:`os.copy_file_range`
+or :func:`os.sendfile` where available, so unchanged chunk data never
+passes through Python buffers on the way out.
+
+:func:`rechunk` instead streams the file through, as it changes the
+framing of the image data rather than moving chunks around.
+"""
+import contextlib
+import enum
+import errno
+import io
+import itertools
+import os
+import struct
+import tempfile
+import typing
+import zlib
+
+import attr
+
+from pngdoctor import chunktypes
+from pngdoctor import exceptions
+from pngdoctor import models
+from pngdoctor.chunk_order_parser import (
+    ChunkOrderParser, _AFTER_PALETTE_BEFORE_DATA, _BEFORE_DATA,
+    _BEFORE_PALETTE
+)
+from pngdoctor.lexer import (
+    ALL_CHUNK_CODES, PNG_MAX_CHUNK_LENGTH, PNG_MAX_FILE_SIZE, PNG_SIGNATURE,
+    ChunkTokenStream, is_plausible_chunk_header, iter_plausible_chunk_headers
+)
+
+
+_READ_SIZE = 2**16
+
+# Data length of the IDAT chunks written by :func:`rechunk` by default
+DEFAULT_IDAT_SIZE = 2**16
+
+# Errors of a kernel copy function meaning it can't be used with these
+# files, so the next one should be tried
+_UNSUPPORTED_COPY_ERRNOS = frozenset(
+    getattr(errno, name) for name in (
+        'EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTSOCK',
+        'EBADF',
+    )
+    if hasattr(errno, name)
+)
+
+
+def _copy_file_range(source_fd, destination_fd, offset, count):
+    return os.copy_file_range(source_fd, destination_fd, count, offset)
+
+
+def _sendfile(source_fd, destination_fd, offset, count):
+    return os.sendfile(destination_fd, source_fd, offset, count)
+
+
+def _read_and_write(source_fd, destination_fd, offset, count):
+    data = os.pread(source_fd, min(count, _READ_SIZE), offset)
+    written = 0
+    while written < len(data):
+        written += os.write(destination_fd, data[written:])
+    return written
+
+
+# Range copy functions, from fastest to most widely supported. Each one
+# copies up to ``count`` bytes at ``offset`` in the source file to the
+# current position of the destination file, and returns the number
+# copied. copy_file_range is new in Python 3.8.
+_COPY_FUNCTIONS = [
+    function for name, function in [
+        ('copy_file_range', _copy_file_range),
+        ('sendfile', _sendfile),
+        ('pread', _read_and_write),
+    ]
+    if hasattr(os, name)
+]
+
+
+class _RewritePlan:
+    """
+    The output file as a sequence of ranges of the input file and of
+    new bytes.
+
+    Adjacent input ranges are merged, so that runs of unchanged chunks
+    are copied in one call.
+    """
+    def __init__(self):
+        self.pieces = []
+
+    def copy(self, offset, count):
+        """
+        Add ``count`` bytes of the input file at ``offset``.
+        """
+        if not count:
+            return
+        if self.pieces and isinstance(self.pieces[-1], tuple):
+            last_offset, last_count = self.pieces[-1]
+            if last_offset + last_count == offset:
+                self.pieces[-1] = (last_offset, last_count + count)
+                return
+        self.pieces.append((offset, count))
+
+    def write(self, data):
+        """
+        Add new bytes.
+        """
+        if data:
+            self.pieces.append(bytes(data))
+
+    def execute(self, source, destination):
+        """
+        Write the output to the unbuffered binary file ``destination``,
+        copying the ranges from the binary file ``source``.
+        """
+        source_fd = source.fileno()
+        destination_fd = destination.fileno()
+        copy_functions = list(_COPY_FUNCTIONS)
+        for piece in self.pieces:
+            if isinstance(piece, bytes):
+                written = 0
+                while written < len(piece):
+                    written += os.write(destination_fd, piece[written:])
+                continue
+            offset, count = piece
+            while count:
+                try:
+                    copied = copy_functions[0](
+                        source_fd, destination_fd, offset, count)
+                except OSError as exc:
+                    if (exc.errno not in _UNSUPPORTED_COPY_ERRNOS
+                            or len(copy_functions) == 1):
+                        raise
+                    del copy_functions[0]
+                    continue
+                if not copied:
+                    raise exceptions.UnexpectedEOF(
+                        "Input ended at byte {0} while copying".format(offset))
+                offset += copied
+                count -= copied
+
+
+@contextlib.contextmanager
+def _replacing_output(path):
+    """
+    Yield an unbuffered binary file that replaces the file at ``path``
+    when the block succeeds, and is removed if it fails.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary_path = tempfile.mkstemp(
+        dir=directory, prefix='.pngdoctor-', suffix='.tmp')
+    try:
+        with open(fd, 'wb', buffering=0) as destination:
+            yield destination
+            os.fsync(destination.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def _chunk_bytes(code, data):
+    crc = zlib.crc32(data, zlib.crc32(code))
+    return struct.pack('>I4s', len(data), code) + data + struct.pack(
+        '>I', crc)
+
+
+@enum.unique
+class RepairAction(enum.Enum):
+    """
+    The kinds of changes made by :func:`repair`.
+    """
+    signature_replaced = 0
+    garbage_dropped = 1
+    crc_fixed = 2
+    length_fixed = 3
+    chunk_moved = 4
+    duplicate_dropped = 5
+    truncated_chunk_dropped = 6
+    trailing_data_dropped = 7
+    trailer_added = 8
+
+
+@attr.attributes(frozen=True)
+class Repair:
+    """
+    A change made by :func:`repair`.
+
+    :ivar action: The :class:`RepairAction`
+    :ivar position:
+        Where the chunk or the bytes changed started in the input, or
+        ``None`` for an added chunk
+    :ivar chunk_code: The type code of the chunk changed, or ``None``
+    :ivar message: A description of the change
+    """
+    action = attr.attr()  # type: RepairAction
+    position = attr.attr()  # type: typing.Optional[int]
+    chunk_code = attr.attr()  # type: typing.Optional[bytes]
+    message = attr.attr()  # type: str
+
+
+@attr.attributes
+class _RepairChunk:
+    """
+    A chunk found by :class:`_RepairScanner`.
+
+    :ivar head:
+        The head of the chunk, with the inferred length if the declared
+        one was wrong
+    :ivar length_fixed: Whether the declared length was wrong
+    :ivar crc: The correct CRC32 bytes if the stored ones are wrong
+    """
+    head = attr.attr()  # type: models.ChunkHeadToken
+    length_fixed = attr.attr(default=False)  # type: bool
+    crc = attr.attr(default=None)  # type: typing.Optional[bytes]
+
+    @property
+    def code(self):
+        return self.head.code
+
+
+class _RepairScanner:
+    """
+    Finds the chunks of a damaged PNG file, with random access to it.
+    """
+    def __init__(self, source, size, repairs):
+        self._source = source
+        self._size = size
+        self._repairs = repairs
+
+    def _read_at(self, position, length):
+        self._source.seek(position)
+        return self._source.read(length)
+
+    def _crc_at(self, code, position, length):
+        return self._update_crc(zlib.crc32(code), position, length)
+
+    def _update_crc(self, crc, position, length):
+        """
+        Return ``crc`` updated with the ``length`` bytes at
+        ``position``, read a block at a time.
+        """
+        self._source.seek(position)
+        while length > 0:
+            block = self._source.read(min(length, _READ_SIZE))
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            length -= len(block)
+        return crc
+
+    def _is_chunk_start(self, position):
+        if position == self._size:
+            return True
+        header = self._read_at(position, 8)
+        return len(header) == 8 and is_plausible_chunk_header(
+            header, position)
+
+    def _record(self, action, position, code, message):
+        self._repairs.append(Repair(action, position, code, message))
+
+    def scan(self):
+        """
+        Return the :class:`_RepairChunk` list of the file, up to and
+        including IEND.
+        """
+        signature = self._read_at(0, len(PNG_SIGNATURE))
+        if signature != PNG_SIGNATURE:
+            self._record(
+                RepairAction.signature_replaced, 0, None,
+                "Replaced invalid signature {0!r}".format(signature))
+        chunks = []
+        position = len(PNG_SIGNATURE)
+        while position < self._size:
+            header = self._read_at(position, 8)
+            if (len(header) < 8
+                    or not is_plausible_chunk_header(header, position)):
+                next_position = self._find_chunk_start(position + 1)
+                self._record(
+                    RepairAction.garbage_dropped, position, None,
+                    "Dropped {0} bytes that are not a chunk".format(
+                        next_position - position))
+                position = next_position
+                continue
+            length, code = struct.unpack('>I4s', header)
+            chunk = self._check_chunk(
+                models.ChunkHeadToken(length, code, position))
+            if chunk is None:
+                self._record(
+                    RepairAction.truncated_chunk_dropped, position, code,
+                    "Dropped chunk truncated by the end of the file")
+                return chunks
+            chunks.append(chunk)
+            position = chunk.head.position + chunk.head.length + 12
+            if code == chunktypes.IMAGE_TRAILER.code:
+                break
+        if position < self._size:
+            self._record(
+                RepairAction.trailing_data_dropped, position, None,
+                "Dropped {0} bytes after IEND".format(self._size - position))
+        return chunks
+
+    def _find_chunk_start(self, position):
+        """
+        Return the position of the first plausible chunk header from
+        ``position`` on, or the file size if there is none.
+        """
+        return next(self._iter_chunk_starts(position), self._size)
+
+    def _iter_chunk_starts(self, position):
+        """
+        Yield the position of each plausible chunk header from
+        ``position`` on, in order.
+        """
+        for start, _ in iter_plausible_chunk_headers(
+                self._iter_blocks(position), position):
+            yield start
+
+    def _iter_blocks(self, position):
+        """
+        Yield the file from ``position`` on a block at a time. Each
+        block is read where it is, so the file may be read elsewhere in
+        between.
+        """
+        while True:
+            block = self._read_at(position, _READ_SIZE)
+            if not block:
+                return
+            yield block
+            position += len(block)
+
+    def _check_chunk(self, head):
+        """
+        Return the :class:`_RepairChunk` for the chunk starting with
+        ``head``, fixing its length or CRC, or ``None`` if it is
+        truncated.
+        """
+        end = head.position + head.length + 12
+        if end <= self._size:
+            crc = self._crc_at(head.code, head.position + 8, head.length)
+            [stored] = struct.unpack('>I', self._read_at(end - 4, 4))
+            if crc == stored:
+                return _RepairChunk(head)
+            if self._is_chunk_start(end):
+                # The length is right, so the data or CRC is damaged
+                return self._crc_fixed(head, crc)
+        length = self._infer_length(head)
+        if length is not None:
+            self._record(
+                RepairAction.length_fixed, head.position, head.code,
+                "Fixed length {0} to {1}".format(head.length, length))
+            return _RepairChunk(
+                models.ChunkHeadToken(length, head.code, head.position),
+                length_fixed=True)
+        if end <= self._size:
+            return self._crc_fixed(head, crc)
+        return None
+
+    def _crc_fixed(self, head, crc):
+        self._record(
+            RepairAction.crc_fixed, head.position, head.code,
+            "Fixed CRC32 to {0:08x}".format(crc))
+        return _RepairChunk(head, crc=struct.pack('>I', crc))
+
+    def _infer_length(self, head):
+        """
+        Return the data length that makes the chunk's CRC32 match and
+        is followed by another chunk or the end of the file, or
+        ``None`` if there is none.
+
+        The CRC32 is updated from one candidate length to the next, so
+        the data is read only once.
+        """
+        data_start = head.position + 8
+        # The CRC32 takes 4 bytes before the next chunk
+        ends = itertools.chain(
+            self._iter_chunk_starts(data_start + 4), [self._size])
+        crc = zlib.crc32(head.code)
+        checked = data_start
+        for end in ends:
+            length = end - 4 - data_start
+            if length < 0 or length == head.length:
+                continue
+            crc = self._update_crc(crc, checked, end - 4 - checked)
+            checked = end - 4
+            [stored] = struct.unpack('>I', self._read_at(checked, 4))
+            if crc == stored:
+                return length
+        return None
+
+
+def _is_ancillary(code):
+    return bool(code[0] & models.PNG_CHUNK_TYPE_PROPERTY_BITMASK)
+
+
+def _fix_order(chunks, repairs):
+    """
+    Return the chunks with misplaced ancillary chunks moved where they
+    are allowed, ancillary chunks that may appear once dropped after
+    the first, and ancillary chunks between IDAT chunks moved after
+    them.
+    """
+    idat = chunktypes.IMAGE_DATA.code
+    idat_indexes = [
+        index for index, chunk in enumerate(chunks) if chunk.code == idat
+    ]
+    if idat_indexes:
+        first, last = idat_indexes[0], idat_indexes[-1]
+        between = [
+            chunk for chunk in chunks[first:last]
+            if chunk.code != idat and _is_ancillary(chunk.code)
+        ]
+        for chunk in between:
+            repairs.append(Repair(
+                RepairAction.chunk_moved, chunk.head.position, chunk.code,
+                "Moved from between IDAT chunks to after them"))
+        chunks = (
+            chunks[:first] +
+            [chunk for chunk in chunks[first:last + 1]
+             if chunk.code == idat or not _is_ancillary(chunk.code)] +
+            between + chunks[last + 1:]
+        )
+
+    order = ChunkOrderParser()
+    kept = []
+    misplaced = []
+    for chunk in chunks:
+        try:
+            order.validate(chunk.code)
+        except exceptions.MisplacedChunk:
+            if _is_ancillary(chunk.code):
+                misplaced.append(chunk)
+                continue
+        except exceptions.DuplicateChunk:
+            pass
+        kept.append(chunk)
+    for chunk in misplaced:
+        index = _allowed_index(kept, chunk.code)
+        kept.insert(index, chunk)
+        repairs.append(Repair(
+            RepairAction.chunk_moved, chunk.head.position, chunk.code,
+            "Moved before the {0} chunk".format(
+                kept[index + 1].code.decode('ascii')
+                if index + 1 < len(kept) else 'end'
+            )))
+
+    order = ChunkOrderParser()
+    result = []
+    for chunk in kept:
+        try:
+            order.validate(chunk.code)
+        except exceptions.DuplicateChunk:
+            if _is_ancillary(chunk.code):
+                repairs.append(Repair(
+                    RepairAction.duplicate_dropped, chunk.head.position,
+                    chunk.code, "Dropped duplicate chunk"))
+                continue
+        except exceptions.MisplacedChunk:
+            pass
+        result.append(chunk)
+    return result
+
+
+def _allowed_index(chunks, code):
+    """
+    Return the index in ``chunks`` at which an ancillary chunk with the
+    type ``code`` is allowed.
+    """
+    codes = [chunk.code for chunk in chunks]
+
+    def index_of(chunk_type, default):
+        try:
+            return codes.index(chunk_type.code)
+        except ValueError:
+            return default
+
+    end = index_of(chunktypes.IMAGE_TRAILER, len(codes))
+    data = index_of(chunktypes.IMAGE_DATA, end)
+    if code in _BEFORE_PALETTE:
+        return index_of(chunktypes.PALETTE, data)
+    if code in _AFTER_PALETTE_BEFORE_DATA or code in _BEFORE_DATA:
+        return data
+    # Allowed anywhere after IHDR, which is where it must have been
+    # missing, or an unknown chunk misplaced before IHDR
+    return index_of(chunktypes.IMAGE_HEADER, -1) + 1
+
+
+def repair(source_path, destination_path):
+    """
+    Write a repaired copy of the PNG file at ``source_path`` to
+    ``destination_path``, and return the list of :class:`Repair` made.
+
+    -   Wrong CRC32 checksums are replaced.
+    -   Wrong chunk lengths are replaced, where a length can be found
+        that makes the CRC32 checksum match and is followed by another
+        chunk.
+    -   Bytes between chunks that aren't chunks are dropped, as are
+        chunks truncated by the end of the file and data after IEND.
+    -   Misplaced ancillary chunks are moved where they are allowed,
+        and duplicate ancillary chunks are dropped.
+    -   A missing IEND chunk is added.
+
+    Damage to the content of critical chunks isn't repaired. The
+    unchanged parts of the file are copied by the kernel where
+    possible. ``destination_path`` is only replaced once the copy is
+    complete.
+
+    Raise :exc:`exceptions.PNGTooLarge` if the file is larger than
+    :data:`lexer.PNG_MAX_FILE_SIZE`.
+    """
+    repairs = []
+    with open(source_path, 'rb') as source:
+        size = os.fstat(source.fileno()).st_size
+        if size > PNG_MAX_FILE_SIZE:
+            raise exceptions.PNGTooLarge(
+                "File is larger than {0} bytes".format(PNG_MAX_FILE_SIZE))
+        chunks = _RepairScanner(source, size, repairs).scan()
+        chunks = _fix_order(chunks, repairs)
+
+        plan = _RewritePlan()
+        if repairs and repairs[0].action is RepairAction.signature_replaced:
+            plan.write(PNG_SIGNATURE)
+        else:
+            plan.copy(0, len(PNG_SIGNATURE))
+        for chunk in chunks:
+            head = chunk.head
+            if chunk.length_fixed:
+                plan.write(struct.pack('>I4s', head.length, head.code))
+                plan.copy(head.position + 8, head.length + 4)
+            elif chunk.crc is not None:
+                plan.copy(head.position, head.length + 8)
+                plan.write(chunk.crc)
+            else:
+                plan.copy(head.position, head.length + 12)
+        if not chunks or chunks[-1].code != chunktypes.IMAGE_TRAILER.code:
+            repairs.append(Repair(
+                RepairAction.trailer_added, None,
+                chunktypes.IMAGE_TRAILER.code, "Added missing IEND chunk"))
+            plan.write(_chunk_bytes(chunktypes.IMAGE_TRAILER.code, b''))
+
+        with _replacing_output(destination_path) as destination:
+            plan.execute(source, destination)
+    return repairs
+
+
+@enum.unique
+class StripPolicy(enum.Enum):
+    """
+    Which ancillary chunks :func:`strip` removes.
+
+    -   ``ancillary``: Every ancillary chunk.
+    -   ``unsafe_to_copy``: Ancillary chunks that are not safe to copy,
+        which editors must drop after changing critical chunks.
+    -   ``private``: Ancillary chunks with private type codes.
+    """
+    ancillary = 0
+    unsafe_to_copy = 1
+    private = 2
+
+
+def _policy_matches(policy, chunk_type):
+    if policy is StripPolicy.ancillary:
+        return True
+    if policy is StripPolicy.unsafe_to_copy:
+        return not chunk_type.safe_to_copy
+    return chunk_type.private
+
+
+def strip(source_path, destination_path, policies=(StripPolicy.ancillary,),
+          codes=()):
+    """
+    Write a copy of the PNG file at ``source_path`` to
+    ``destination_path`` without some of its ancillary chunks, and
+    return the :class:`models.ChunkHeadToken` of each chunk removed.
+
+    :param policies:
+        :class:`StripPolicy` members, chunks matching any of them are
+        removed
+    :param codes: Type codes of more chunks to remove
+
+    Critical chunks are never removed; :exc:`ValueError` is raised if
+    ``codes`` contains one. The kept chunks are copied unchanged by the
+    kernel where possible, with their original CRC32 checksums, which
+    aren't verified. The chunk structure is, so
+    :exc:`exceptions.DecodeError` is raised for a file that isn't made
+    of complete chunks.
+    """
+    codes = frozenset(codes)
+    for code in codes:
+        if not _is_ancillary(code):
+            raise ValueError(
+                "Critical chunk {0} can't be stripped".format(code))
+    policies = frozenset(policies)
+    decisions = {}
+    removed = []
+    plan = _RewritePlan()
+    plan.copy(0, len(PNG_SIGNATURE))
+    with open(source_path, 'rb') as source:
+        tokens = ChunkTokenStream(source, skip_data_codes=ALL_CHUNK_CODES)
+        for token in tokens:
+            if not isinstance(token, models.ChunkHeadToken):
+                continue
+            remove = decisions.get(token.code)
+            if remove is None:
+                chunk_type = models.ChunkType(token.code)
+                remove = decisions[token.code] = chunk_type.ancillary and (
+                    token.code in codes or any(
+                        _policy_matches(policy, chunk_type)
+                        for policy in policies
+                    )
+                )
+            if remove:
+                removed.append(token)
+            else:
+                plan.copy(token.position, token.length + 12)
+        with _replacing_output(destination_path) as destination:
+            plan.execute(source, destination)
+    return removed
+
+
+class _ImageDataRechunker:
+    """
+    Writes the data of a run of IDAT chunks as new IDAT chunks of
+    ``target_size`` bytes each, except for the last.
+
+    At most ``target_size`` bytes are held at once, and the CRC32 of
+    each new chunk is calculated as its data is added.
+
+    :ivar chunks_written: The number of IDAT chunks written so far
+    """
+    def __init__(self, destination, target_size):
+        self._destination = destination
+        self._target_size = target_size
+        self._data = bytearray()
+        self._crc = 0
+        self.chunks_written = 0
+
+    def add(self, data):
+        """
+        Add data of the input chunks, writing each new chunk it fills.
+        """
+        data = memoryview(data)
+        while data:
+            if not self._data:
+                self._crc = zlib.crc32(chunktypes.IMAGE_DATA.code)
+            part = data[:self._target_size - len(self._data)]
+            self._data += part
+            self._crc = zlib.crc32(part, self._crc)
+            data = data[len(part):]
+            if len(self._data) == self._target_size:
+                self._write_chunk()
+
+    def finish(self):
+        """
+        Write the rest of the data, or an empty IDAT chunk if there was
+        no data at all.
+        """
+        if self._data or not self.chunks_written:
+            if not self._data:
+                self._crc = zlib.crc32(chunktypes.IMAGE_DATA.code)
+            self._write_chunk()
+
+    def _write_chunk(self):
+        self._destination.write(struct.pack(
+            '>I4s', len(self._data), chunktypes.IMAGE_DATA.code))
+        self._destination.write(self._data)
+        self._destination.write(struct.pack('>I', self._crc))
+        self._data = bytearray()
+        self.chunks_written += 1
+
+
+def rechunk(source_path, destination_path, target_size=DEFAULT_IDAT_SIZE):
+    """
+    Write a copy of the PNG file at ``source_path`` to
+    ``destination_path`` with the image data split into IDAT chunks of
+    ``target_size`` bytes, except for the last one, which holds the
+    rest. Return the number of IDAT chunks read and written as a tuple.
+
+    Small IDAT chunks are merged and large ones split; the compressed
+    data itself is copied as it is, never inflated. The file is read
+    in one pass with :class:`lexer.ChunkTokenStream`, which verifies
+    every CRC32 checksum, and written as it is read, so at most about
+    ``target_size`` bytes are held in memory whatever the size of the
+    file. The CRC32 checksums of the new chunks are calculated as
+    their data is added. ``destination_path`` is only replaced once
+    the copy is complete.
+
+    Raise :exc:`ValueError` if ``target_size`` isn't a valid chunk
+    length greater than zero, and :exc:`exceptions.DecodeError` for a
+    file that isn't made of complete chunks with correct checksums.
+    """
+    if not 0 < target_size <= PNG_MAX_CHUNK_LENGTH:
+        raise ValueError(
+            "IDAT size must be between 1 and {0} bytes, not {1}".format(
+                PNG_MAX_CHUNK_LENGTH, target_size))
+    with open(source_path, 'rb') as source, \
+            _replacing_output(destination_path) as raw_destination:
+        destination = io.BufferedWriter(raw_destination, _READ_SIZE)
+        try:
+            return _rechunk_stream(source, destination, target_size)
+        finally:
+            # Flushes, and keeps the buffer from closing the file
+            destination.detach()
+
+
+def _rechunk_stream(source, destination, target_size):
+    idat = chunktypes.IMAGE_DATA.code
+    chunks_read = chunks_written = 0
+    rechunker = None
+    crc = 0
+    destination.write(PNG_SIGNATURE)
+    for token in ChunkTokenStream(source):
+        if isinstance(token, models.ChunkHeadToken):
+            if token.code == idat:
+                chunks_read += 1
+                if rechunker is None:
+                    rechunker = _ImageDataRechunker(destination, target_size)
+                continue
+            if rechunker is not None:
+                rechunker.finish()
+                chunks_written += rechunker.chunks_written
+                rechunker = None
+            destination.write(struct.pack('>I4s', token.length, token.code))
+            crc = zlib.crc32(token.code)
+        elif isinstance(token, models.ChunkDataPartToken):
+            if token.head.code == idat:
+                rechunker.add(token.data)
+            else:
+                destination.write(token.data)
+                crc = zlib.crc32(token.data, crc)
+        elif token.head.code != idat:
+            destination.write(struct.pack('>I', crc))
+    if rechunker is not None:
+        rechunker.finish()
+        chunks_written += rechunker.chunks_written
+    return chunks_read, chunks_written
@@ -0,0 +1,520 @@
+"""
+A validation server, so callers that check many files don't pay the
+process startup and import time for each one.
+
+The protocol runs over a stream socket. Each request is a JSON object
+on one line, and is optionally followed by raw bytes:
+
+-   ``{"path": "/some/file.png"}`` validates a file the server can
+    read.
+-   ``{"length": 1234}`` followed by exactly that many bytes validates
+    those bytes as a PNG file.
+
+Requests may also have an ``"id"``, echoed in the response, a
+``"metadata"`` boolean to validate everything but the image data, and
+a finite positive ``"timeout"`` in seconds that overrides the server
+default.
+
+Each response is the :meth:`batch.FileCheckResult.to_record` JSON
+object with the request ``"id"`` added, on one line. Requests may be
+pipelined: a client can send any number of requests without waiting,
+and gets the responses in request order. A request that runs out of
+time gets an error response of type ``Timeout``, and one the server
+can't make sense of gets type ``BadRequest``.
+"""
+import collections
+import json
+import math
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import time
+
+from pngdoctor.batch import (
+    CheckOptions, FileCheckResult, check_bytes, check_file
+)
+from pngdoctor.lexer import PNG_MAX_FILE_SIZE
+from pngdoctor.parser import ParseMode
+
+
+# Longest accepted request line, not counting any body
+MAX_REQUEST_LINE_SIZE = 2**16
+
+_RECV_SIZE = 2**16
+
+# Longest wait for events, shorter than the longest timeout the
+# selectors accept, so that a longer request timeout or metrics
+# interval is waited for in several steps
+_MAX_SELECT_WAIT = 3600.0
+
+
+def serve(listener, workers=1, timeout=10.0, max_pipelined=64,
+          exporter=None):
+    """
+    Answer validation requests on the listening socket ``listener``
+    until interrupted.
+
+    :param workers:
+        The number of worker processes, started once and reused for
+        every request. A worker that runs out of time is killed and
+        replaced.
+    :param timeout:
+        The default per-request timeout, in seconds, measured from when
+        a worker starts on the request. Like the timeouts in requests,
+        it must be finite and positive.
+    :param max_pipelined:
+        Stop reading from a connection while it has this many requests
+        without a sent response
+    :param exporter:
+        A :class:`metrics.TextfileExporter` to observe the result of
+        every file request, written when due and when the server stops.
+        Parsing stages are then timed.
+    """
+    server = _Server(listener, workers, timeout, max_pipelined, exporter)
+    try:
+        server.run()
+    finally:
+        server.close()
+
+
+def create_listener(unix_path=None, port=None, host='127.0.0.1'):
+    """
+    Create a listening socket on the Unix domain socket path
+    ``unix_path``, or else on TCP ``host`` and ``port``.
+    """
+    if unix_path is not None:
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(unix_path)
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+    listener.listen(socket.SOMAXCONN)
+    return listener
+
+
+def _error_record(error_type, message, path=None):
+    return {
+        'path': path,
+        'status': 'error',
+        'error': {'type': error_type, 'message': message, 'offset': None},
+    }
+
+
+def _check_timeout(timeout):
+    """
+    Return ``timeout``, or raise :exc:`ValueError` if it isn't a finite
+    positive number of seconds.
+    """
+    if not 0 < timeout < math.inf:
+        raise ValueError(
+            "Timeout must be a finite positive number of seconds, not "
+            "{0}".format(timeout))
+    return timeout
+
+
+def _worker_main(connection, inherited_fds):
+    # The server process handles interrupts and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Holding on to the server's sockets would keep client connections
+    # open after the server closes them
+    for fd in inherited_fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        path, body, options = task
+        try:
+            if body is None:
+                result = check_file(path, options)
+            else:
+                result = check_bytes(body, options, path=path)
+            record = result.to_record()
+        except Exception as exc:  # pylint: disable=broad-except
+            # A bug, not invalid input, but the server must answer
+            record = _error_record(type(exc).__name__, str(exc), path)
+        connection.send(record)
+
+
+class _Worker:
+    """
+    A worker process, and the request it is working on.
+    """
+    def __init__(self, inherited_fds):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker_main,
+            args=(child_connection, inherited_fds),
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+        self.request = None
+        self.deadline = None
+
+    def start(self, request, now):
+        self.request = request
+        self.deadline = now + request.timeout
+        self.connection.send((request.path, request.body, request.options))
+        # Don't keep large bodies around while the worker runs
+        request.body = None
+
+    def finish(self):
+        request = self.request
+        self.request = self.deadline = None
+        return request
+
+    def stop(self):
+        self.connection.close()
+        self.process.terminate()
+        self.process.join()
+
+
+class _Request:
+    """
+    One request of a connection, in request order.
+
+    :ivar response: The encoded response line once answered
+    """
+    def __init__(self, client, request_id, path=None, body=None,
+                 options=None, timeout=None):
+        self.client = client
+        self.request_id = request_id
+        self.path = path
+        self.body = body
+        self.options = options
+        self.timeout = timeout
+        self.response = None
+
+    def answer(self, record):
+        record['id'] = self.request_id
+        self.response = json.dumps(
+            record, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class _Client:
+    """
+    A connection, with its partially received request and its requests
+    waiting for a response.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.input = bytearray()
+        self.input_closed = False
+        # The request whose body is being received
+        self.body_request = None
+        self.body_length = 0
+        self.requests = collections.deque()
+        self.output = bytearray()
+        self.closed = False
+        # The selector events registered for the socket
+        self.events = 0
+
+
+class _Server:
+    def __init__(self, listener, worker_count, timeout, max_pipelined,
+                 exporter=None):
+        self._listener = listener
+        self._exporter = exporter
+        self._timeout = _check_timeout(timeout)
+        self._max_pipelined = max_pipelined
+        self._selector = selectors.DefaultSelector()
+        self._queue = collections.deque()
+        self._idle_workers = []
+        self._busy_workers = set()
+        self._clients = set()
+        self._running = True
+        listener.setblocking(False)
+        self._selector.register(
+            listener, selectors.EVENT_READ, self._accept)
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._selector.register(
+            self._wakeup_receiver, selectors.EVENT_READ, self._wake_up)
+        for _ in range(worker_count):
+            self._idle_workers.append(self._start_worker())
+
+    def _start_worker(self):
+        inherited_fds = [
+            self._listener.fileno(),
+            self._wakeup_receiver.fileno(),
+            self._wakeup_sender.fileno(),
+        ]
+        inherited_fds.extend(client.sock.fileno() for client in self._clients)
+        inherited_fds.extend(
+            worker.connection.fileno()
+            for worker in self._idle_workers + list(self._busy_workers)
+        )
+        worker = _Worker(inherited_fds)
+        self._selector.register(
+            worker.connection, selectors.EVENT_READ,
+            lambda mask: self._worker_done(worker))
+        return worker
+
+    def run(self):
+        while self._running:
+            self._dispatch()
+            now = time.monotonic()
+            waits = [
+                max(0, worker.deadline - now)
+                for worker in self._busy_workers
+            ]
+            if self._exporter is not None:
+                # Refreshes the metrics while no results arrive too
+                waits.append(self._exporter.time_until_write())
+            wait = min(min(waits), _MAX_SELECT_WAIT) if waits else None
+            for key, mask in self._selector.select(wait):
+                key.data(mask)
+            self._expire_workers()
+            if self._exporter is not None:
+                self._exporter.tick()
+
+    def shutdown(self):
+        """
+        Make :meth:`run` return. May be called from another thread.
+        """
+        self._running = False
+        self._wakeup_sender.send(b'\0')
+
+    def close(self):
+        for worker in self._idle_workers + list(self._busy_workers):
+            worker.stop()
+        for client in list(self._clients):
+            self._close_client(client)
+        self._selector.close()
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
+        if self._exporter is not None:
+            self._exporter.close()
+
+    def _wake_up(self, mask):
+        try:
+            self._wakeup_receiver.recv(_RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _accept(self, mask):
+        try:
+            sock, _ = self._listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        client = _Client(sock)
+        self._clients.add(client)
+        self._set_client_events(client, selectors.EVENT_READ)
+
+    def _client_ready(self, client, mask):
+        if mask & selectors.EVENT_READ:
+            self._receive(client)
+        if mask & selectors.EVENT_WRITE and not client.closed:
+            self._send(client)
+
+    def _receive(self, client):
+        try:
+            data = client.sock.recv(_RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close_client(client)
+            return
+        if not data:
+            client.input_closed = True
+            if client.body_request is not None:
+                # The body never came, so nothing to answer
+                client.requests.remove(client.body_request)
+                client.body_request = None
+        client.input += data
+        self._parse_requests(client)
+        self._send(client)
+
+    def _parse_requests(self, client):
+        while not client.closed:
+            if client.body_request is not None:
+                if len(client.input) < client.body_length:
+                    return
+                request = client.body_request
+                request.body = bytes(client.input[:client.body_length])
+                del client.input[:client.body_length]
+                client.body_request = None
+                self._queue.append(request)
+                continue
+            end = client.input.find(b'\n')
+            if end == -1:
+                if len(client.input) > MAX_REQUEST_LINE_SIZE:
+                    # Can't find where the next request starts
+                    request = _Request(client, None)
+                    request.answer(_error_record(
+                        'BadRequest', "Request line too long"))
+                    client.requests.append(request)
+                    client.input_closed = True
+                    client.input = bytearray()
+                return
+            line = bytes(client.input[:end])
+            del client.input[:end + 1]
+            if line.strip():
+                self._parse_request_line(client, line)
+
+    def _parse_request_line(self, client, line):
+        try:
+            fields = json.loads(line.decode('utf-8'))
+            if not isinstance(fields, dict):
+                raise ValueError("Request must be a JSON object")
+        except ValueError as exc:
+            request = _Request(client, None)
+            request.answer(_error_record('BadRequest', str(exc)))
+            client.requests.append(request)
+            return
+        request = _Request(client, fields.get('id'))
+        client.requests.append(request)
+        try:
+            request.options = CheckOptions(
+                mode=(
+                    ParseMode.metadata if fields.get('metadata')
+                    else ParseMode.full
+                ),
+                instrument=self._exporter is not None,
+            )
+            request.timeout = _check_timeout(
+                float(fields.get('timeout', self._timeout)))
+            if 'path' in fields:
+                request.path = str(fields['path'])
+                self._queue.append(request)
+            elif 'length' in fields:
+                length = int(fields['length'])
+                if not 0 <= length <= PNG_MAX_FILE_SIZE:
+                    raise ValueError(
+                        "Body length must be between 0 and {0}".format(
+                            PNG_MAX_FILE_SIZE))
+                client.body_request = request
+                client.body_length = length
+            else:
+                raise ValueError("Request needs a path or a length")
+        except (TypeError, ValueError) as exc:
+            request.answer(_error_record('BadRequest', str(exc)))
+            if client.body_request is None and 'length' in fields:
+                # The body can't be told apart from the next request
+                client.input_closed = True
+                client.input = bytearray()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self._queue and self._idle_workers:
+            request = self._queue.popleft()
+            if request.client.closed:
+                continue
+            worker = self._idle_workers.pop()
+            try:
+                worker.start(request, now)
+            except OSError:
+                # The worker died before its death was noticed
+                self._queue.appendleft(request)
+                worker.finish()
+                self._replace_worker(worker)
+                continue
+            self._busy_workers.add(worker)
+
+    def _worker_done(self, worker):
+        try:
+            record = worker.connection.recv()
+        except EOFError:
+            # The worker died, replace it
+            self._replace_worker(worker)
+            request = worker.finish()
+            if request is not None:
+                self._answer(request, _error_record(
+                    'WorkerDied', "Worker process exited", request.path))
+            return
+        request = worker.finish()
+        self._busy_workers.discard(worker)
+        self._idle_workers.append(worker)
+        self._answer(request, record)
+
+    def _expire_workers(self):
+        now = time.monotonic()
+        for worker in list(self._busy_workers):
+            if worker.deadline <= now:
+                self._replace_worker(worker)
+                request = worker.finish()
+                self._answer(request, _error_record(
+                    'Timeout',
+                    "No result after {0} seconds".format(request.timeout),
+                    request.path,
+                ))
+
+    def _replace_worker(self, worker):
+        self._selector.unregister(worker.connection)
+        # An idle worker can die too, and must not be handed requests
+        if worker in self._idle_workers:
+            self._idle_workers.remove(worker)
+        self._busy_workers.discard(worker)
+        worker.stop()
+        self._idle_workers.append(self._start_worker())
+
+    def _answer(self, request, record):
+        if self._exporter is not None:
+            if 'timings' in record:
+                self._exporter.observe(FileCheckResult.from_record(record))
+            else:
+                # Timed out, or the worker died
+                self._exporter.observe_error(record['error']['type'])
+        client = request.client
+        if client.closed:
+            return
+        request.answer(record)
+        self._send(client)
+
+    def _send(self, client):
+        requests = client.requests
+        while requests and requests[0].response is not None:
+            client.output += requests.popleft().response
+        if client.output:
+            try:
+                sent = client.sock.send(client.output)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self._close_client(client)
+                return
+            del client.output[:sent]
+        if client.input_closed and not requests and not client.output:
+            self._close_client(client)
+            return
+        events = 0
+        if (
+                not client.input_closed and
+                len(requests) < self._max_pipelined
+            ):
+            events |= selectors.EVENT_READ
+        if client.output:
+            events |= selectors.EVENT_WRITE
+        # With no events, the client waits for the workers, and they
+        # call _send again
+        self._set_client_events(client, events)
+
+    def _set_client_events(self, client, events):
+        if events == client.events:
+            return
+        if not client.events:
+            self._selector.register(
+                client.sock, events,
+                lambda mask: self._client_ready(client, mask))
+        elif not events:
+            self._selector.unregister(client.sock)
+        else:
+            self._selector.modify(
+                client.sock, events,
+                self._selector.get_key(client.sock).data)
+        client.events = events
+
+    def _close_client(self, client):
+        client.closed = True
+        self._clients.discard(client)
+        self._set_client_events(client, 0)
+        client.sock.close()
@@ -0,0 +1,177 @@
+"""
+Helpers for building fake PNG chunks and streams in tests
+"""
+import itertools
+import struct
+import zlib
+
+
+class RawChunkData:
+    def __init__(self, type_, data):
+        self.type = type_
+        self.data = data
+
+    @property
+    def length(self):
+        return len(self.data)
+
+    @property
+    def crc32_bytes(self):
+        crc = zlib.crc32(self.type)
+        crc = zlib.crc32(self.data, crc)
+        return struct.pack('>I', crc)
+
+    @property
+    def bytes(self):
+        length_type = struct.pack('>I4s', self.length, self.type)
+        return length_type + self.data
+
+    @property
+    def bytes_with_crc32(self):
+        return self.bytes + self.crc32_bytes
+
+
+ihdr_one_by_one_rgb24 = RawChunkData(
+    b'IHDR',
+    struct.pack(
+        '>IIBBBBB',
+        1,  # Image width
+        1,  # Image height
+        8,  # Bit depth
+        2,  # Color type is RGB
+        0,  # Compression method is DEFLATE with 32K sliding window
+        0,  # Filter method is "adaptive filtering with five basic filter
+            # types"
+        0,  # Interlace method is no interlace
+    )
+)
+# Single pixel example IDAT created with GIMP (hexdump with relevant data)
+#                                            00 00  |              ..|
+# 00 0c 49 44 41 54 08 d7  63 70 e9 38 03 00 02 ac  |..IDAT..cp.8....|
+# 01 99 cb 83 c0 90                                 |......          |
+#
+# Chunk bytes:
+# 00 00 00 0c 49 44 41 54 08 d7 63 70 e9 38 03 00 02 ac 01 99 cb 83 c0 90
+# --len 12---| I  D  A  T|------------zlib-data--------------|---crc32---|
+#
+# Decompressed zlib data: 00 44 88 CC
+# Filter type 0 (no filtering)
+# Pastel blue #4488cc
+idat_onepix_4488cc = RawChunkData(
+    b'IDAT',
+    b'\x08\xd7\x63\x70\xe9\x38\x03\x00\x02\xac\x01\x99'
+)
+
+iend = RawChunkData(b'IEND', b'')
+
+
+def png_bytes(chunk_fakes):
+    """
+    Return the bytes of a PNG stream with the signature followed by
+    the chunks.
+    """
+    from pngdoctor.lexer import PNG_SIGNATURE
+    return PNG_SIGNATURE + b''.join(
+        fake.bytes_with_crc32 for fake in chunk_fakes)
+
+
+# (first column, column step, first row, row step) of each Adam7 pass
+ADAM7_PASSES = (
+    (0, 8, 0, 8),
+    (4, 8, 0, 8),
+    (0, 4, 4, 8),
+    (2, 4, 0, 4),
+    (0, 2, 2, 4),
+    (1, 2, 0, 2),
+    (0, 1, 1, 2),
+)
+
+
+def _pack_row(pixels, bit_depth):
+    """
+    Return the bytes of a row of sample tuples packed at ``bit_depth``.
+    """
+    samples = [sample for pixel in pixels for sample in pixel]
+    if bit_depth == 16:
+        return struct.pack('>{0}H'.format(len(samples)), *samples)
+    if bit_depth == 8:
+        return bytes(samples)
+    per_byte = 8 // bit_depth
+    packed = bytearray()
+    for start in range(0, len(samples), per_byte):
+        value = 0
+        group = samples[start:start + per_byte]
+        for sample in group:
+            value = value << bit_depth | sample
+        packed.append(value << bit_depth * (per_byte - len(group)))
+    return bytes(packed)
+
+
+def _filter_row(filter_type, raw, previous, bytes_per_pixel):
+    """
+    Return the bytes of a packed row filtered with the filter type 0
+    (none), 1 (sub) or 2 (up).
+    """
+    if filter_type == 0:
+        return raw
+    if filter_type == 1:
+        previous = bytes(bytes_per_pixel) + raw[:-bytes_per_pixel]
+    return bytes(
+        (value - prior) % 256 for value, prior in zip(raw, previous))
+
+
+def image_png(pixels, color_type=2, bit_depth=8, interlace=False,
+              idat_size=None, palette=b'', filter_types=(0,)):
+    """
+    Return the bytes of a PNG stream with the image ``pixels``, a list
+    of rows of sample tuples.
+
+    :param filter_types:
+        The filter types to use for the rows in turn, among 0 (none),
+        1 (sub) and 2 (up)
+    :param idat_size:
+        The data length of each IDAT chunk but the last, or ``None``
+        for a single IDAT chunk
+    :param palette: The PLTE chunk data, if any
+    """
+    height, width = len(pixels), len(pixels[0])
+    ihdr = RawChunkData(b'IHDR', struct.pack(
+        '>IIBBBBB', width, height, bit_depth, color_type, 0, 0,
+        int(interlace)))
+    passes = ADAM7_PASSES if interlace else [(0, 1, 0, 1)]
+    channels = len(pixels[0][0])
+    bytes_per_pixel = max(1, channels * bit_depth // 8)
+    filter_cycle = itertools.cycle(filter_types)
+    data = bytearray()
+    for first_column, column_step, first_row, row_step in passes:
+        previous = None
+        for row in pixels[first_row::row_step]:
+            subimage_row = row[first_column::column_step]
+            if not subimage_row:
+                continue
+            raw = _pack_row(subimage_row, bit_depth)
+            if previous is None:
+                previous = bytes(len(raw))
+            filter_type = next(filter_cycle)
+            data.append(filter_type)
+            data += _filter_row(filter_type, raw, previous, bytes_per_pixel)
+            previous = raw
+    compressed = zlib.compress(bytes(data))
+    size = idat_size or len(compressed)
+    chunks = [ihdr]
+    if palette:
+        chunks.append(RawChunkData(b'PLTE', palette))
+    chunks.extend(
+        RawChunkData(b'IDAT', compressed[start:start + size])
+        for start in range(0, len(compressed), size)
+    )
+    chunks.append(iend)
+    return png_bytes(chunks)
+
+
+def decoded_rows(pixels, bit_depth=8):
+    """
+    Return the decoded bytes of each row of sample tuples, as the
+    decoder produces them.
+    """
+    return [_pack_row(row, max(8, bit_depth)) for row in pixels]
@@ -208,7 +208,7 @@ def scanline_filter_average(bytes_per_pixel, scanline,
     def prior(pos):
         return prior_unfiltered_scanline[pos]
     def average(pos):
-        return (raw(pos) - ((raw(pos - bpp) - prior(pos)) // 2)) % 256
+        return (raw(pos) - ((raw(pos - bpp) + prior(pos)) // 2)) % 256
     return bytes(average(pos) for pos in range(len(scanline)))
 
 
@@ -229,7 +229,7 @@ def scanline_filter_paeth(bytes_per_pixel, scanline,
         pred_left = abs(pred - left)
         pred_above = abs(pred - above)
         pred_upperleft = abs(pred - upperleft)
-        if pred_left <= pred_above <= pred_upperleft:
+        if pred_left <= pred_above and pred_left <= pred_upperleft:
             return left
         elif pred_above <= pred_upperleft:
             return above
@@ -0,0 +1,217 @@
+# pylint: disable=redefined-outer-name,no-self-use
+import os
+import shutil
+
+import pytest
+
+from pngdoctor.tests.chunk_fakes import (
+    ihdr_one_by_one_rgb24, idat_onepix_4488cc, png_bytes
+)
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+@pytest.fixture
+def png_tree(tmpdir):
+    """
+    A directory tree with two valid PNGs, one invalid PNG, and a file
+    without a PNG extension.
+    """
+    root = tmpdir.mkdir('tree')
+    nested = root.mkdir('nested')
+    shutil.copy(os.path.join(DATA_DIR, 'PNG-Gradient.png'), str(root))
+    shutil.copy(
+        os.path.join(DATA_DIR, 'one_by_one_rgb24_4488cc.png'), str(nested))
+    # Missing IEND
+    nested.join('truncated.PNG').write_binary(
+        png_bytes([ihdr_one_by_one_rgb24, idat_onepix_4488cc]))
+    nested.join('notes.txt').write('not a png')
+    return root
+
+
+class TestIterPNGPaths:
+    def test_walks_directories(self, png_tree):
+        from pngdoctor.batch import iter_png_paths
+        names = sorted(
+            os.path.basename(path) for path in iter_png_paths([str(png_tree)])
+        )
+        assert names == [
+            'PNG-Gradient.png', 'one_by_one_rgb24_4488cc.png', 'truncated.PNG'
+        ]
+
+    def test_files_yielded_as_given(self, png_tree):
+        from pngdoctor.batch import iter_png_paths
+        path = str(png_tree.join('nested', 'notes.txt'))
+        assert list(iter_png_paths([path])) == [path]
+
+    def test_onerror(self, tmpdir):
+        from pngdoctor.batch import _walk_png_paths
+        errors = []
+        missing = str(tmpdir.join('missing'))
+        assert list(_walk_png_paths(missing, errors.append)) == []
+        assert len(errors) == 1
+
+
+class TestCheckFiles:
+    @pytest.mark.parametrize('jobs', [1, 2])
+    def test_results(self, png_tree, jobs):
+        from pngdoctor.batch import CheckOptions, check_files, iter_png_paths
+        results = list(check_files(
+            iter_png_paths([str(png_tree)]), CheckOptions(), jobs=jobs))
+        by_name = {
+            os.path.basename(result.path): result for result in results
+        }
+        assert by_name['PNG-Gradient.png'].ok
+        assert by_name['one_by_one_rgb24_4488cc.png'].ok
+        assert by_name['truncated.PNG'].error_type == 'PNGSyntaxError'
+
+    def test_bounded_submission(self, png_tree):
+        from pngdoctor.batch import CheckOptions, check_files
+        path = str(png_tree.join('PNG-Gradient.png'))
+        results = check_files(
+            [path] * 20, CheckOptions(), jobs=2, max_pending_per_job=1)
+        assert sum(result.ok for result in results) == 20
+
+    def test_unreadable_file(self, tmpdir):
+        from pngdoctor.batch import CheckOptions, check_file
+        result = check_file(str(tmpdir.join('missing.png')), CheckOptions())
+        assert result.error_type == 'FileNotFoundError'
+
+
+class TestCheckFilesDeduplicated:
+    @pytest.fixture
+    def duplicate_tree(self, png_tree):
+        """
+        The PNG tree with two more copies of the gradient, a copy of the
+        truncated file, and a file with the gradient's size and partial
+        hash but different content.
+        """
+        gradient = png_tree.join('PNG-Gradient.png')
+        data = gradient.read_binary()
+        png_tree.join('copy1.png').write_binary(data)
+        png_tree.join('nested', 'copy2.png').write_binary(data)
+        png_tree.join('truncated_copy.png').write_binary(
+            png_tree.join('nested', 'truncated.PNG').read_binary())
+        middle = len(data) // 2
+        png_tree.join('altered.png').write_binary(
+            data[:middle] + bytes([data[middle] ^ 1]) + data[middle + 1:])
+        return png_tree
+
+    @pytest.mark.parametrize('jobs', [1, 2])
+    def test_results(self, duplicate_tree, jobs):
+        from pngdoctor.batch import (
+            CheckOptions, check_files, check_files_deduplicated,
+            iter_png_paths
+        )
+        paths = list(iter_png_paths([str(duplicate_tree)]))
+        results = list(check_files_deduplicated(
+            paths, CheckOptions(), jobs=jobs, partial_hash_size=16))
+        assert sorted(result.path for result in results) == sorted(paths)
+
+        expected = {
+            result.path: result for result in check_files(
+                paths, CheckOptions())
+        }
+        validated = set()
+        for result in results:
+            if result.duplicate_of is None:
+                validated.add(result.path)
+            else:
+                assert result.duplicate_of in validated
+            assert result.ok == expected[result.path].ok
+            assert result.error_type == expected[result.path].error_type
+            assert result.chunks == expected[result.path].chunks
+        # One gradient, the altered gradient, one truncated file, and
+        # the single one by one image
+        assert len(validated) == 4
+
+    def test_content_hash_from_validation(self, png_tree):
+        import hashlib
+        from pngdoctor.batch import CheckOptions, check_file
+        from pngdoctor.parser import ParseMode
+        for name in ['PNG-Gradient.png', 'nested/truncated.PNG']:
+            path = str(png_tree.join(name))
+            with open(path, 'rb') as pngfile:
+                expected = hashlib.sha256(pngfile.read()).hexdigest()
+            options = CheckOptions(
+                mode=ParseMode.metadata, verify_image_data_crc=False)
+            result = check_file(path, options, hash_content=True)
+            assert result.content_sha256 == expected
+
+
+class TestCheckCommand:
+    def test_output_and_exit_status(self, png_tree, capsys):
+        from pngdoctor.main import main
+        status = main(['check', '--jobs', '1', str(png_tree)])
+        lines = capsys.readouterr()[0].splitlines()
+        assert status == 1
+        assert len(lines) == 3
+        assert sum(line.startswith('OK ') for line in lines) == 2
+        [failure] = [line for line in lines if line.startswith('FAIL ')]
+        assert 'truncated.PNG: PNGSyntaxError' in failure
+
+    def test_all_valid(self, capsys):
+        from pngdoctor.main import main
+        path = os.path.join(DATA_DIR, 'PNG-Gradient.png')
+        assert main(['check', '-j', '1', '--metadata', path]) == 0
+        assert capsys.readouterr()[0] == 'OK {0}\n'.format(path)
+
+    def test_jsonl_output(self, png_tree, capsys):
+        import json
+        from pngdoctor.main import main
+        status = main(['check', '-j', '1', '--format', 'jsonl',
+                       str(png_tree)])
+        records = [
+            json.loads(line) for line in capsys.readouterr()[0].splitlines()
+        ]
+        assert status == 1
+        by_name = {
+            os.path.basename(record['path']): record for record in records
+        }
+        gradient = by_name['PNG-Gradient.png']
+        assert gradient['status'] == 'ok'
+        assert gradient['error'] is None
+        assert gradient['image_header']['width'] == 128
+        assert gradient['image_header']['color_type'] == 'rgb'
+        assert [code for code, _, _ in gradient['chunks']] == [
+            'IHDR', 'IDAT', 'IEND'
+        ]
+        # The first chunk starts right after the signature
+        assert gradient['chunks'][0][1:] == [8, 13]
+        assert gradient['timings']['total'] >= 0
+        truncated = by_name['truncated.PNG']
+        assert truncated['status'] == 'error'
+        assert truncated['error']['type'] == 'PNGSyntaxError'
+        # The IDAT chunk after the 8 byte signature and 25 byte IHDR
+        assert truncated['error']['offset'] == 33
+
+    def test_diagnostics(self, tmpdir, capsys):
+        import json
+        from pngdoctor.main import main
+        from pngdoctor.tests.chunk_fakes import RawChunkData
+        gama = bytearray(
+            RawChunkData(b'gAMA', b'\0\0\xb1\x8f').bytes_with_crc32)
+        gama[-1] ^= 0xff
+        path = tmpdir.join('bad.png')
+        path.write_binary(
+            png_bytes([ihdr_one_by_one_rgb24]) + bytes(gama) +
+            png_bytes([idat_onepix_4488cc])[8:])
+        status = main(['check', '-j', '1', '--diagnostics', '--format',
+                       'jsonl', str(path)])
+        [record] = [
+            json.loads(line) for line in capsys.readouterr()[0].splitlines()
+        ]
+        assert status == 1
+        assert record['error']['type'] == 'BadCRC'
+        assert record['error']['offset'] == 33
+        assert [
+            (diagnostic['code'], diagnostic['offset'], diagnostic['chunk'])
+            for diagnostic in record['diagnostics']
+        ] == [('crc_mismatch', 33, 'gAMA'), ('missing_trailer', None, None)]
+        main(['check', '-j', '1', '--diagnostics', str(path)])
+        assert capsys.readouterr()[0].splitlines()[1:] == [
+            '  byte 33: crc_mismatch: CRC32 check failed for '
+            "b'gAMA' after 49 bytes read",
+            '  missing_trailer: Missing IEND',
+        ]
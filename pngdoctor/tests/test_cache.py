@@ -0,0 +1,106 @@
+# pylint: disable=redefined-outer-name,no-self-use
+import os
+import shutil
+
+import pytest
+
+from pngdoctor.batch import CheckOptions, FileCheckResult, check_files
+from pngdoctor.cache import CacheKeyMode, ResultCache
+from pngdoctor.parser import ParseMode
+from pngdoctor.tests.chunk_fakes import (
+    ihdr_one_by_one_rgb24, idat_onepix_4488cc, png_bytes
+)
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+@pytest.fixture
+def png_paths(tmpdir):
+    shutil.copy(os.path.join(DATA_DIR, 'PNG-Gradient.png'), str(tmpdir))
+    truncated = tmpdir.join('truncated.png')
+    truncated.write_binary(
+        png_bytes([ihdr_one_by_one_rgb24, idat_onepix_4488cc]))
+    return [str(tmpdir.join('PNG-Gradient.png')), str(truncated)]
+
+
+@pytest.fixture
+def cache_path(tmpdir):
+    return str(tmpdir.join('cache.sqlite'))
+
+
+def run(paths, cache_path, options=CheckOptions(), jobs=1, **kwargs):
+    with ResultCache(cache_path, **kwargs) as cache:
+        return sorted(
+            check_files(paths, options, jobs=jobs, cache=cache),
+            key=lambda result: result.path,
+        )
+
+
+class TestResultCache:
+    @pytest.mark.parametrize('jobs', [1, 2])
+    @pytest.mark.parametrize('key_mode', list(CacheKeyMode))
+    def test_second_run_is_cached(self, png_paths, cache_path, jobs,
+                                  key_mode):
+        first = run(png_paths, cache_path, jobs=jobs, key_mode=key_mode)
+        second = run(png_paths, cache_path, jobs=jobs, key_mode=key_mode)
+        assert [result.cached for result in first] == [False, False]
+        assert [result.cached for result in second] == [True, True]
+        for uncached, cached in zip(first, second):
+            cached.cached = False
+            assert cached == uncached
+
+    def test_changed_file_is_validated_again(self, png_paths, cache_path):
+        run(png_paths, cache_path)
+        with open(png_paths[1], 'ab') as pngfile:
+            pngfile.write(b'\0')
+        results = run(png_paths, cache_path)
+        assert [result.cached for result in results] == [True, False]
+
+    def test_content_key_matches_copies(self, png_paths, cache_path, tmpdir):
+        run(png_paths[:1], cache_path, key_mode=CacheKeyMode.content)
+        copy = str(tmpdir.join('copy.png'))
+        shutil.copy(png_paths[0], copy)
+        result, = run([copy], cache_path, key_mode=CacheKeyMode.content)
+        assert result.cached
+        assert result.path == copy
+
+    @pytest.mark.parametrize('options', [
+        CheckOptions(ParseMode.metadata),
+        CheckOptions(instrument=True),
+        CheckOptions(trace_memory=True),
+    ])
+    def test_options_are_part_of_the_key(self, png_paths, cache_path,
+                                         options):
+        run(png_paths, cache_path)
+        results = run(png_paths, cache_path, options=options)
+        assert not any(result.cached for result in results)
+        if options.instrument:
+            assert all(result.stage_timings for result in results)
+
+    def test_version_change_drops_cache(self, png_paths, cache_path,
+                                        monkeypatch):
+        run(png_paths, cache_path)
+        monkeypatch.setattr('pngdoctor.cache.__version__', '99.0.0')
+        with ResultCache(cache_path) as cache:
+            assert len(cache) == 0
+
+    def test_evicts_least_recently_used(self, png_paths, cache_path):
+        run(png_paths[:1], cache_path)
+        run(png_paths[1:], cache_path)
+        # Touch the first file so the second is the oldest
+        run(png_paths[:1], cache_path, max_entries=1)
+        results = run(png_paths, cache_path)
+        assert [result.cached for result in results] == [True, False]
+
+    def test_missing_file_not_cached(self, cache_path, tmpdir):
+        missing = str(tmpdir.join('missing.png'))
+        result, = run([missing], cache_path)
+        assert result.error_type == 'FileNotFoundError'
+        with ResultCache(cache_path) as cache:
+            assert len(cache) == 0
+
+
+def test_record_round_trip(png_paths):
+    for result in check_files(png_paths, CheckOptions()):
+        assert FileCheckResult.from_record(result.to_record()) == result
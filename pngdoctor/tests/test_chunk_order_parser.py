@@ -1,4 +1,4 @@
-# pylint: disable=redefined-outer-name,no-self-use
+# pylint: disable=redefined-outer-name,no-self-use,protected-access
 import pytest
 
 
@@ -95,3 +95,19 @@ class TestChunkCountValidator:
             chunk_count_validator.check(chunk_code)
 
 # TODO: Add tests for _ChunkOrderStateTransitionMap
+
+
+def test_chunk_code_sets_partition_known_chunks():
+    from pngdoctor import chunk_order_parser, chunktypes
+    code_sets = [
+        chunk_order_parser._CRITICAL_CHUNK_CODES,
+        chunk_order_parser._BEFORE_PALETTE,
+        chunk_order_parser._AFTER_PALETTE_BEFORE_DATA,
+        chunk_order_parser._BEFORE_DATA,
+        chunk_order_parser._ALLOWED_ANYWHERE,
+    ]
+    known = chunk_order_parser._KNOWN_CHUNKS
+    # No repeats
+    assert len(known) == sum(map(len, code_sets))
+    # Everything is covered
+    assert known == chunktypes.CODE_TO_CHUNK_TYPE.keys()
@@ -1,2 +1,363 @@
 # pylint: disable=redefined-outer-name,no-self-use
-# TODO: Add tests for chunk parsers
+import struct
+
+import pytest
+
+
+def image_header(color_type_name='rgb', bit_depth=8, width=1, height=1):
+    from pngdoctor import fieldvalues
+    from pngdoctor.models import ImageHeader
+    return ImageHeader(
+        width,
+        height,
+        bit_depth,
+        fieldvalues.ColorType[color_type_name],
+        fieldvalues.CompressionMethod.deflate32k,
+        fieldvalues.FilterMethod.adaptive_five_basic,
+        fieldvalues.InterlaceMethod.none,
+    )
+
+
+def antecedent(color_type_name='rgb', bit_depth=8, palette_size=None):
+    from pngdoctor.models import ParseResult, Palette
+    result = ParseResult()
+    result.image_header = image_header(color_type_name, bit_depth)
+    if palette_size is not None:
+        result.palette = Palette([(0, 0, 0)] * palette_size)
+    return result
+
+
+def parse_limited_length(code, data, parse_antecedent):
+    from pngdoctor.chunk_parsers import chunk_parsers
+    parser_class = chunk_parsers.lookup(code)
+    return parser_class(data, parse_antecedent).parse()
+
+
+def parse_iterative(code, parts, parse_antecedent):
+    from pngdoctor.chunk_parsers import chunk_parsers
+    parser = chunk_parsers.lookup(code)(parse_antecedent)
+    for part in parts:
+        parser.parse_partial(part)
+    return parser.verify_end()
+
+
+class TestTransparencyChunkParser:
+    def test_indexed(self):
+        result = parse_limited_length(
+            b'tRNS', b'\x00\x80', antecedent('indexed', palette_size=4))
+        assert result.alphas == b'\x00\x80'
+
+    def test_indexed_more_entries_than_palette(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_limited_length(
+                b'tRNS', b'\x00' * 5, antecedent('indexed', palette_size=4))
+
+    def test_rgb(self):
+        data = struct.pack('>3H', 1, 2, 3)
+        result = parse_limited_length(b'tRNS', data, antecedent('rgb'))
+        assert result.color == (1, 2, 3)
+
+    @pytest.mark.parametrize('color_type_name', [
+        'grayscale_alpha', 'rgb_alpha',
+    ])
+    def test_prohibited_with_alpha(self, color_type_name):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_limited_length(
+                b'tRNS', b'\x00\x00', antecedent(color_type_name))
+
+
+class TestSignificantBitsChunkParser:
+    def test_valid(self):
+        result = parse_limited_length(b'sBIT', b'\x05\x06\x05', antecedent())
+        assert result.bits == (5, 6, 5)
+
+    @pytest.mark.parametrize('data', [b'\x00\x06\x05', b'\x09\x08\x08'])
+    def test_out_of_range(self, data):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_limited_length(b'sBIT', data, antecedent())
+
+    def test_wrong_length(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_limited_length(b'sBIT', b'\x08', antecedent())
+
+
+class TestImageLastModificationTimeChunkParser:
+    def test_valid(self):
+        data = struct.pack('>HBBBBB', 2016, 7, 25, 23, 59, 60)
+        result = parse_limited_length(b'tIME', data, antecedent())
+        assert (result.year, result.month, result.second) == (2016, 7, 60)
+
+    @pytest.mark.parametrize('fields', [
+        (2016, 0, 1, 0, 0, 0),
+        (2016, 13, 1, 0, 0, 0),
+        (2016, 1, 32, 0, 0, 0),
+        (2016, 1, 1, 24, 0, 0),
+        (2016, 1, 1, 0, 60, 0),
+        (2016, 1, 1, 0, 0, 61),
+    ])
+    def test_invalid(self, fields):
+        from pngdoctor.exceptions import PNGSyntaxError
+        data = struct.pack('>HBBBBB', *fields)
+        with pytest.raises(PNGSyntaxError):
+            parse_limited_length(b'tIME', data, antecedent())
+
+
+class TestBackgroundColorChunkParser:
+    def test_indexed_out_of_range(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_limited_length(
+                b'bKGD', b'\x04', antecedent('indexed', palette_size=4))
+
+    def test_grayscale(self):
+        result = parse_limited_length(
+            b'bKGD', b'\x00\x07', antecedent('grayscale'))
+        assert result.color == (7,)
+
+
+class TestTextualDataParser:
+    def test_split_across_parts(self):
+        result = parse_iterative(
+            b'tEXt', [b'Comm', b'ent\x00Hello ', b'world'], antecedent())
+        assert result.keyword == 'Comment'
+        assert result.text == 'Hello world'
+
+    @pytest.mark.parametrize('data', [
+        b'no null byte',
+        b'\x00empty keyword',
+        b' leading\x00space',
+        b'two  spaces\x00',
+        b'non\x0aprintable\x00',
+        b'k' * 80 + b'\x00too long',
+        b'too\x00many\x00nulls',
+    ])
+    def test_invalid(self, data):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_iterative(b'tEXt', [data], antecedent())
+
+
+class TestCompressedPayloadChunkParsers:
+    @pytest.mark.parametrize('code,attribute', [
+        (b'zTXt', 'text'),
+        (b'iCCP', 'profile'),
+    ])
+    def test_inflated_on_access(self, code, attribute):
+        import zlib
+        data = b'Title\x00\x00' + zlib.compress(b'payload')
+        # Split inside the keyword and between the header and the data
+        result = parse_iterative(code, [data[:3], data[3:7], data[7:]],
+                                 antecedent())
+        assert result._inflated_cache is None
+        value = getattr(result, attribute)
+        assert value in (b'payload', 'payload')
+        assert result._inflated_cache == b'payload'
+
+    def test_corrupt_data_only_fails_on_access(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        result = parse_iterative(
+            b'zTXt', [b'Title\x00\x00not zlib'], antecedent())
+        assert result.keyword == 'Title'
+        with pytest.raises(PNGSyntaxError):
+            _ = result.text
+
+    def test_large_inflated_data_not_cached(self, monkeypatch):
+        import zlib
+        from pngdoctor import models
+        monkeypatch.setattr(
+            models.CompressedTextualData, 'INFLATED_CACHE_MAX_SIZE', 4)
+        result = parse_iterative(
+            b'zTXt', [b'Title\x00\x00' + zlib.compress(b'payload')],
+            antecedent())
+        assert result.text == 'payload'
+        assert result._inflated_cache is None
+
+    def test_inflated_size_limit(self, monkeypatch):
+        import zlib
+        from pngdoctor import models
+        from pngdoctor.exceptions import PNGTooLarge
+        monkeypatch.setattr(models, 'PNG_MAX_INFLATED_SIZE', 4)
+        result = parse_iterative(
+            b'iCCP', [b'sRGB\x00\x00' + zlib.compress(b'payload')],
+            antecedent())
+        with pytest.raises(PNGTooLarge):
+            _ = result.profile
+
+    @pytest.mark.parametrize('parts', [
+        [b'Title\x00\x01' + b'x'],
+        [b'Title\x00'],
+        [b'k' * 80],
+        [b' Title\x00\x00'],
+    ])
+    def test_invalid_header(self, parts):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_iterative(b'zTXt', parts, antecedent())
+
+
+def split_bytes(data):
+    """
+    Split the data into parts of one byte each.
+    """
+    return [data[pos:pos + 1] for pos in range(len(data))]
+
+
+class TestTextualChunkParserStateMachines:
+    def test_text_split_byte_by_byte(self):
+        result = parse_iterative(
+            b'tEXt', split_bytes(b'Comment\x00Hello'), antecedent())
+        assert (result.keyword, result.text) == ('Comment', 'Hello')
+        assert result.text_length == 5
+
+    def test_text_stored_up_to_limit(self):
+        from pngdoctor.chunk_parsers import chunk_parsers
+        parser = chunk_parsers.lookup(b'tEXt')(
+            antecedent(), max_stored_text_size=5)
+        parser.parse_partial(b'Comment\x00Hello')
+        result = parser.verify_end()
+        assert result.text == 'Hello'
+        assert result.text_sha256 is None
+
+    def test_large_text_only_hashed(self):
+        import hashlib
+        from pngdoctor.chunk_parsers import chunk_parsers
+        text = b'x' * 10000
+        parser = chunk_parsers.lookup(b'tEXt')(
+            antecedent(), max_stored_text_size=100)
+        for part in [b'Comment\x00' + text[:50], text[50:]]:
+            parser.parse_partial(part)
+        result = parser.verify_end()
+        assert result.text is None
+        assert result.text_length == len(text)
+        assert result.text_sha256 == hashlib.sha256(text).hexdigest()
+
+    def test_null_in_later_text_part(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_iterative(
+                b'tEXt', [b'Comment\x00Hello', b' \x00world'], antecedent())
+
+    def test_international_split_byte_by_byte(self):
+        data = (
+            'Title'.encode('latin-1') + b'\x00\x00\x00' + b'de-DE\x00' +
+            'Überschrift'.encode('utf-8') + b'\x00' +
+            'Grüße'.encode('utf-8')
+        )
+        result = parse_iterative(b'iTXt', split_bytes(data), antecedent())
+        assert result.keyword == 'Title'
+        assert result.compression_method is None
+        assert result.language_tag == 'de-DE'
+        assert result.translated_keyword == 'Überschrift'
+        assert result.text == 'Grüße'
+
+    def test_international_compressed(self):
+        import zlib
+        from pngdoctor.fieldvalues import CompressionMethod
+        data = b'XML:com.adobe.xmp\x00\x01\x00\x00\x00' + zlib.compress(
+            '<x:xmpmeta/>'.encode('utf-8'))
+        result = parse_iterative(b'iTXt', [data], antecedent())
+        assert result.compression_method is CompressionMethod.deflate32k
+        assert result.language_tag == ''
+        assert result.text == '<x:xmpmeta/>'
+
+    def test_international_large_text_validated_while_hashed(self):
+        from pngdoctor.chunk_parsers import chunk_parsers
+        from pngdoctor.exceptions import PNGSyntaxError
+        parser = chunk_parsers.lookup(b'iTXt')(
+            antecedent(), max_stored_text_size=10)
+        parser.parse_partial(b'Title\x00\x00\x00\x00\x00' + b'x' * 100)
+        with pytest.raises(PNGSyntaxError):
+            # Invalid UTF-8 after the text stopped being stored
+            parser.parse_partial(b'\xff')
+
+    @pytest.mark.parametrize('data', [
+        b'Title\x00\x02\x00\x00\x00text',
+        b'Title\x00\x01\x01\x00\x00text',
+        b'Title\x00\x00\x00de_DE\x00\x00text',
+        b'Title\x00\x00\x00\x00\xff\x00text',
+        b'Title\x00\x00\x00\x00\x00\xc3',
+        b'Title\x00\x00\x00de\x00',
+    ])
+    def test_international_invalid(self, data):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_iterative(b'iTXt', split_bytes(data), antecedent())
+
+
+class TestSuggestedPaletteChunkParser:
+    @pytest.mark.parametrize('sample_depth,entry_format', [
+        (8, '>BBBBH'),
+        (16, '>HHHHH'),
+    ])
+    def test_columns(self, sample_depth, entry_format):
+        import array
+        entries = [(i % 256, 2, 3, 255, 1000 + i) for i in range(1000)]
+        data = b'Custom\x00' + bytes([sample_depth]) + b''.join(
+            struct.pack(entry_format, *entry) for entry in entries)
+        # Uneven parts split entries across boundaries
+        parts = [data[pos:pos + 97] for pos in range(0, len(data), 97)]
+        result = parse_iterative(b'sPLT', parts, antecedent())
+        assert result.name == 'Custom'
+        assert result.sample_depth == sample_depth
+        assert len(result) == 1000
+        assert isinstance(result.red, array.array)
+        assert isinstance(result.frequency, array.array)
+        assert list(zip(result.red, result.green, result.blue,
+                        result.alpha, result.frequency)) == entries
+
+    def test_partial_entry(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_iterative(
+                b'sPLT', [b'Custom\x00\x08' + b'\x00' * 7], antecedent())
+
+    def test_invalid_sample_depth(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_iterative(b'sPLT', [b'Custom\x00\x04'], antecedent())
+
+    def test_duplicate_name(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        parse_antecedent = antecedent()
+        parse_antecedent.suggested_palettes.append(
+            parse_iterative(b'sPLT', [b'Custom\x00\x08'], parse_antecedent))
+        with pytest.raises(PNGSyntaxError):
+            parse_iterative(b'sPLT', [b'Custom\x00\x10'], parse_antecedent)
+
+
+class TestPaletteHistogramChunkParser:
+    def test_valid(self):
+        import array
+        result = parse_limited_length(
+            b'hIST', struct.pack('>3H', 1, 256, 65535),
+            antecedent('indexed', palette_size=3))
+        assert result.frequencies == array.array('H', [1, 256, 65535])
+
+    @pytest.mark.parametrize('palette_size', [None, 2])
+    def test_invalid(self, palette_size):
+        from pngdoctor.exceptions import PNGSyntaxError
+        with pytest.raises(PNGSyntaxError):
+            parse_limited_length(
+                b'hIST', struct.pack('>3H', 1, 2, 3),
+                antecedent('indexed', palette_size=palette_size))
+
+
+class TestChunkParserRegistry:
+    def test_dispatch_table_covers_standard_chunks(self):
+        from pngdoctor.chunk_parsers import chunk_parsers
+        from pngdoctor.chunktypes import CODE_TO_CHUNK_TYPE
+        assert chunk_parsers.dispatch_table.keys() == \
+            CODE_TO_CHUNK_TYPE.keys()
+
+    def test_dispatch_table_frozen(self):
+        from pngdoctor.chunk_parsers import _ChunkParserRegistry
+        registry = _ChunkParserRegistry()
+        table = registry.dispatch_table
+        with pytest.raises(TypeError):
+            table[b'ukwn'] = None
+        with pytest.raises(RuntimeError):
+            registry.register(object)
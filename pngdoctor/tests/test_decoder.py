@@ -0,0 +1,429 @@
+# pylint: disable=no-self-use
+import array
+import io
+import mmap
+import random
+import struct
+import zlib
+
+import pytest
+
+from pngdoctor.tests.chunk_fakes import decoded_rows, image_png
+
+
+SAMPLES_PER_PIXEL = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+FORMATS = [
+    (0, 1), (0, 2), (0, 4), (0, 8), (0, 16), (2, 8), (2, 16), (3, 4),
+    (4, 8), (6, 16),
+]
+
+
+def random_pixels(width, height, color_type=2, bit_depth=8, seed=0):
+    rng = random.Random(seed)
+    channels = SAMPLES_PER_PIXEL[color_type]
+    return [
+        [
+            tuple(rng.randrange(2**bit_depth) for _ in range(channels))
+            for _ in range(width)
+        ]
+        for _ in range(height)
+    ]
+
+
+def encode(pixels, color_type=2, bit_depth=8, **kwargs):
+    if color_type == 3:
+        kwargs['palette'] = bytes(range(3 * 2**bit_depth))
+    return image_png(pixels, color_type, bit_depth, **kwargs)
+
+
+class CountingStream(io.BytesIO):
+    """
+    A stream that counts the bytes read from it.
+    """
+    bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def crop(rows, box, pixel_size):
+    left, top, right, bottom = box
+    return [
+        row[left * pixel_size:right * pixel_size] for row in rows[top:bottom]
+    ]
+
+
+class TestDecodeRegion:
+    @pytest.mark.parametrize('color_type,bit_depth', FORMATS)
+    @pytest.mark.parametrize('interlace', [False, True])
+    def test_whole_image(self, color_type, bit_depth, interlace):
+        from pngdoctor.decoder import decode_region
+        pixels = random_pixels(11, 9, color_type, bit_depth)
+        contents = encode(pixels, color_type, bit_depth, interlace=interlace)
+        assert decode_region(io.BytesIO(contents)) == decoded_rows(
+            pixels, bit_depth)
+
+    @pytest.mark.parametrize('color_type,bit_depth', FORMATS)
+    @pytest.mark.parametrize('interlace', [False, True])
+    @pytest.mark.parametrize('box', [
+        (3, 2, 8, 7), (0, 0, 1, 1), (5, 0, 13, 3), (1, 9, 2, 10),
+    ])
+    def test_box(self, color_type, bit_depth, interlace, box):
+        from pngdoctor.decoder import decode_region
+        pixels = random_pixels(13, 10, color_type, bit_depth)
+        contents = encode(pixels, color_type, bit_depth, interlace=interlace)
+        pixel_size = SAMPLES_PER_PIXEL[color_type] * (
+            2 if bit_depth == 16 else 1)
+        expected = crop(decoded_rows(pixels, bit_depth), box, pixel_size)
+        assert decode_region(io.BytesIO(contents), box) == expected
+
+    @pytest.mark.parametrize('box', [
+        (0, 0, 0, 1), (0, 0, 5, 4), (-1, 0, 1, 1), (2, 2, 1, 3),
+    ])
+    def test_box_outside_image(self, box):
+        from pngdoctor.decoder import decode_region
+        contents = encode(random_pixels(4, 4))
+        with pytest.raises(ValueError):
+            decode_region(io.BytesIO(contents), box)
+
+    def test_stops_after_last_row(self):
+        from pngdoctor.decoder import decode_region, decode_rows
+        pixels = random_pixels(64, 256)
+        contents = encode(pixels, idat_size=1024)
+        stream = CountingStream(contents)
+        rows = decode_rows(stream, 10, 12)
+        assert rows == decoded_rows(pixels)[10:12]
+        assert stream.bytes_read < len(contents) // 8
+
+        # Damage after the rows needed goes unnoticed
+        damaged = contents[:len(contents) // 2]
+        assert decode_region(io.BytesIO(damaged), (8, 3, 9, 4)) == [
+            decoded_rows(pixels)[3][24:27]]
+
+    def test_whole_image_validated(self):
+        from pngdoctor.decoder import decode_rows
+        from pngdoctor.exceptions import UnexpectedEOF
+        pixels = random_pixels(4, 4)
+        with pytest.raises(UnexpectedEOF):
+            decode_rows(io.BytesIO(encode(pixels)[:-5]), 2)
+
+    def test_rows_to_end(self):
+        from pngdoctor.decoder import decode_rows
+        pixels = random_pixels(5, 6, 0, 16)
+        contents = encode(pixels, 0, 16, interlace=True)
+        assert decode_rows(io.BytesIO(contents), 4) == decoded_rows(
+            pixels, 16)[4:]
+
+
+class TestDecodeImage:
+    @pytest.mark.parametrize('color_type,bit_depth', FORMATS)
+    def test_image(self, color_type, bit_depth):
+        from pngdoctor.decoder import decode_image
+        pixels = random_pixels(13, 10, color_type, bit_depth)
+        contents = encode(pixels, color_type, bit_depth)
+        box = (2, 5, 6, 8)
+        image = decode_image(io.BytesIO(contents), box)
+        pixel_size = SAMPLES_PER_PIXEL[color_type] * (
+            2 if bit_depth == 16 else 1)
+        assert (image.width, image.height, image.bit_depth) == (
+            4, 3, bit_depth)
+        assert image.channels == SAMPLES_PER_PIXEL[color_type]
+        assert image.stride == 4 * pixel_size
+        assert bytes(image.memoryview()) == b''.join(
+            crop(decoded_rows(pixels, bit_depth), box, pixel_size))
+
+
+class TestDecodeInto:
+    def test_stride(self):
+        from pngdoctor.decoder import decode_into
+        pixels = random_pixels(5, 4)
+        buffer = bytearray(b'\xff' * 75)
+        header = decode_into(io.BytesIO(encode(pixels)), buffer, 20)
+        assert (header.width, header.height) == (5, 4)
+        for row, start in zip(decoded_rows(pixels), range(0, 75, 20)):
+            assert buffer[start:start + 15] == row
+        for start in range(15, 75, 20):
+            assert buffer[start:start + 5] == b'\xff' * 5
+
+    @pytest.mark.parametrize('interlace', [False, True])
+    def test_box(self, interlace):
+        from pngdoctor.decoder import decode_into
+        pixels = random_pixels(13, 10, 0, 16)
+        contents = encode(pixels, 0, 16, interlace=interlace)
+        # Any writable buffer, whatever its item size
+        buffer = array.array('H', bytes(8 * 3))
+        box = (2, 5, 6, 8)
+        decode_into(io.BytesIO(contents), buffer, None, box)
+        assert buffer.tobytes() == b''.join(
+            crop(decoded_rows(pixels, 16), box, 2))
+
+    def test_mmap(self):
+        from pngdoctor.decoder import decode_into
+        pixels = random_pixels(6, 7, 6, 16)
+        with mmap.mmap(-1, 6 * 7 * 8) as buffer:
+            decode_into(io.BytesIO(encode(pixels, 6, 16)), buffer)
+            assert buffer[:] == b''.join(decoded_rows(pixels, 16))
+
+    @pytest.mark.parametrize('size,stride', [(47, None), (53, 14), (100, 11)])
+    def test_buffer_too_small(self, size, stride):
+        from pngdoctor.decoder import decode_into
+        contents = encode(random_pixels(4, 4, 2, 8))
+        with pytest.raises(ValueError):
+            decode_into(io.BytesIO(contents), bytearray(size), stride)
+
+    def test_read_only(self):
+        from pngdoctor.decoder import decode_into
+        contents = encode(random_pixels(4, 4))
+        with pytest.raises(TypeError):
+            decode_into(io.BytesIO(contents), bytes(48))
+
+
+def preview_rows(pixels, column_step, row_step, bit_depth=8):
+    rows = decoded_rows(pixels, bit_depth)
+    pixel_size = len(rows[0]) // len(pixels[0])
+    return [
+        b''.join(
+            rows[y // row_step * row_step][
+                x // column_step * column_step * pixel_size:][:pixel_size]
+            for x in range(len(pixels[0]))
+        )
+        for y in range(len(pixels))
+    ]
+
+
+class TestDecodePreview:
+    @pytest.mark.parametrize('color_type,bit_depth', [
+        (0, 1), (0, 4), (2, 8), (6, 16),
+    ])
+    @pytest.mark.parametrize('passes,column_step,row_step', [
+        (1, 8, 8), (2, 4, 8), (3, 4, 4), (4, 2, 4), (5, 2, 2), (6, 1, 2),
+        (7, 1, 1),
+    ])
+    @pytest.mark.parametrize('width,height', [(19, 13), (3, 2), (1, 1)])
+    def test_preview(self, color_type, bit_depth, passes, column_step,
+                     row_step, width, height):
+        from pngdoctor.decoder import decode_preview
+        pixels = random_pixels(width, height, color_type, bit_depth)
+        contents = encode(pixels, color_type, bit_depth, interlace=True)
+        assert decode_preview(io.BytesIO(contents), passes) == preview_rows(
+            pixels, column_step, row_step, bit_depth)
+
+    def test_stops_after_last_pass(self):
+        from pngdoctor.decoder import decode_preview
+        pixels = random_pixels(64, 256)
+        contents = encode(pixels, interlace=True, idat_size=1024)
+        stream = CountingStream(contents)
+        assert decode_preview(stream) == preview_rows(pixels, 8, 8)
+        assert stream.bytes_read < len(contents) // 16
+
+    @pytest.mark.parametrize('passes', [0, 8])
+    def test_invalid_passes(self, passes):
+        from pngdoctor.decoder import decode_preview
+        contents = encode(random_pixels(4, 4), interlace=True)
+        with pytest.raises(ValueError):
+            decode_preview(io.BytesIO(contents), passes)
+
+    def test_not_interlaced(self):
+        from pngdoctor.decoder import decode_preview
+        with pytest.raises(ValueError):
+            decode_preview(io.BytesIO(encode(random_pixels(4, 4))))
+
+
+def nearest_thumbnail(pixels, factor, bit_depth=8):
+    rows = decoded_rows(pixels, bit_depth)[::factor]
+    pixel_size = len(rows[0]) // len(pixels[0])
+    return [
+        b''.join(
+            row[start:start + pixel_size]
+            for start in range(0, len(row), factor * pixel_size)
+        )
+        for row in rows
+    ]
+
+
+def average_thumbnail(pixels, factor, bit_depth=8):
+    fmt = '>{0}H' if bit_depth == 16 else '{0}B'
+    rows = []
+    for top in range(0, len(pixels), factor):
+        row = []
+        for left in range(0, len(pixels[0]), factor):
+            box = [
+                pixel for line in pixels[top:top + factor]
+                for pixel in line[left:left + factor]
+            ]
+            row.extend(
+                (sum(samples) + len(box) // 2) // len(box)
+                for samples in zip(*box)
+            )
+        rows.append(struct.pack(fmt.format(len(row)), *row))
+    return rows
+
+
+class TestDecodeThumbnail:
+    @pytest.mark.parametrize('color_type,bit_depth', FORMATS)
+    @pytest.mark.parametrize('width,height,max_side,factor', [
+        (19, 13, 5, 4), (13, 19, 7, 3), (8, 8, 8, 1), (3, 2, 1, 3),
+    ])
+    def test_nearest(self, color_type, bit_depth, width, height, max_side,
+                     factor):
+        from pngdoctor.decoder import decode_thumbnail
+        pixels = random_pixels(width, height, color_type, bit_depth)
+        contents = encode(pixels, color_type, bit_depth)
+        assert decode_thumbnail(io.BytesIO(contents), max_side) == (
+            nearest_thumbnail(pixels, factor, bit_depth))
+
+    @pytest.mark.parametrize('color_type,bit_depth', [
+        (0, 1), (0, 4), (0, 16), (2, 8), (4, 8), (6, 16),
+    ])
+    @pytest.mark.parametrize('width,height,max_side,factor', [
+        (19, 13, 5, 4), (8, 8, 8, 1), (3, 2, 1, 3),
+    ])
+    def test_average(self, color_type, bit_depth, width, height, max_side,
+                     factor):
+        from pngdoctor.decoder import decode_thumbnail
+        pixels = random_pixels(width, height, color_type, bit_depth)
+        contents = encode(pixels, color_type, bit_depth)
+        assert decode_thumbnail(io.BytesIO(contents), max_side, True) == (
+            average_thumbnail(pixels, factor, bit_depth))
+
+    def test_last_row_validated(self):
+        from pngdoctor.decoder import decode_thumbnail
+        from pngdoctor.exceptions import UnexpectedEOF
+        contents = encode(random_pixels(10, 10))
+        with pytest.raises(UnexpectedEOF):
+            decode_thumbnail(io.BytesIO(contents[:-5]), 4)
+
+    @pytest.mark.parametrize('max_side,interlace', [(0, False), (4, True)])
+    def test_invalid(self, max_side, interlace):
+        from pngdoctor.decoder import decode_thumbnail
+        contents = encode(random_pixels(8, 8), interlace=interlace)
+        with pytest.raises(ValueError):
+            decode_thumbnail(io.BytesIO(contents), max_side)
+
+    def test_palette_not_averaged(self):
+        from pngdoctor.decoder import decode_thumbnail
+        contents = encode(random_pixels(8, 8, 3, 4), 3, 4)
+        with pytest.raises(ValueError):
+            decode_thumbnail(io.BytesIO(contents), 4, True)
+
+
+@pytest.fixture(scope='module')
+def image():
+    # Samples compressible enough for several deflate blocks
+    rng = random.Random(0)
+    pixels = [
+        [tuple(rng.randrange(24) for _ in range(3)) for _ in range(60)]
+        for _ in range(1200)
+    ]
+    contents = image_png(pixels, idat_size=4096, filter_types=(0, 1, 2))
+    return decoded_rows(pixels), contents
+
+
+@pytest.fixture(scope='module')
+def index(image):
+    from pngdoctor.decoder import RowIndex
+    return RowIndex.build(io.BytesIO(image[1]), 32)
+
+
+class TestRowIndex:
+    def test_checkpoints(self, index):
+        assert len(index.checkpoints) > 2
+        assert any(
+            checkpoint.bit_position % 8 for checkpoint in index.checkpoints)
+
+    @pytest.mark.parametrize('start,stop', [
+        (0, 3), (5, None), (400, 401), (700, 900), (1199, None),
+    ])
+    def test_rows(self, image, index, start, stop):
+        rows, contents = image
+        assert index.decode_rows(io.BytesIO(contents), start, stop) == (
+            rows[start:stop])
+
+    def test_resumes_at_checkpoint(self, image, index):
+        rows, contents = image
+        stream = CountingStream(contents)
+        assert index.decode_rows(stream, 1100, 1102) == rows[1100:1102]
+        assert stream.bytes_read < len(contents) // 4
+
+    def test_round_trip(self, tmpdir, image, index):
+        from pngdoctor.decoder import RowIndex
+        path = str(tmpdir.join('image.png.rowindex'))
+        index.save(path)
+        loaded = RowIndex.load(path)
+        assert loaded.to_bytes() == index.to_bytes()
+        rows, contents = image
+        assert loaded.decode_rows(io.BytesIO(contents), 1000, 1010) == (
+            rows[1000:1010])
+
+    @pytest.mark.parametrize('length', [0, 10, 40, -1])
+    def test_truncated(self, index, length):
+        from pngdoctor.decoder import RowIndex
+        with pytest.raises(ValueError):
+            RowIndex.from_bytes(index.to_bytes()[:length])
+
+    @pytest.mark.parametrize('width,height,idat_size', [
+        (60, 1201, 4096), (60, 1200, 4000),
+    ])
+    def test_other_image(self, index, width, height, idat_size):
+        contents = image_png(
+            random_pixels(width, height), idat_size=idat_size)
+        with pytest.raises(ValueError):
+            index.decode_rows(io.BytesIO(contents), 1100, 1101)
+
+    def test_interlaced(self):
+        from pngdoctor.decoder import RowIndex
+        contents = encode(random_pixels(4, 4), interlace=True)
+        with pytest.raises(ValueError):
+            RowIndex.build(io.BytesIO(contents))
+
+    def test_noisy_image(self):
+        from pngdoctor.decoder import RowIndex
+        # Bands of noise, stored in stored blocks, between compressible
+        # ones, so that the checkpoints of Huffman blocks that don't
+        # start on a byte boundary are followed by stored blocks
+        rng = random.Random(0)
+        pixels = []
+        for band in range(16):
+            high = 256 if band % 2 else 4
+            pixels.extend(
+                [tuple(rng.randrange(high) for _ in range(3))
+                 for _ in range(60)]
+                for _ in range(50))
+        rows = decoded_rows(pixels)
+        contents = image_png(pixels, idat_size=4096, filter_types=(0, 1, 2))
+        index = RowIndex.build(io.BytesIO(contents), 16)
+        assert any(
+            checkpoint.bit_position % 2 for checkpoint in index.checkpoints)
+        for start in range(len(rows)):
+            assert index.decode_rows(
+                io.BytesIO(contents), start, start + 1) == [rows[start]]
+
+    @pytest.mark.parametrize('shift', range(8))
+    def test_empty_blocks(self, shift):
+        from pngdoctor.decoder import _prefix_empty_blocks
+        # A final stored block starting at bit ``shift``, whose header
+        # bits are padded to the next byte boundary
+        pieces = [
+            bytes([1 << shift]) + b'\x00' * (shift > 5),
+            b'\x03\x00\xfc\xff', b'abc',
+        ]
+        decompressor = zlib.decompressobj(wbits=-15)
+        output = decompressor.decompress(
+            b''.join(_prefix_empty_blocks(pieces, shift)))
+        assert output == b'abc'
+        assert decompressor.eof
+
+    def test_command(self, tmpdir, capsys, image, index):
+        from pngdoctor.decoder import RowIndex
+        from pngdoctor.main import main
+        source = tmpdir.join('in.png')
+        source.write_binary(image[1])
+        assert main(['index', '--rows', '32', str(source)]) == 0
+        path = str(source) + '.rowindex'
+        assert capsys.readouterr()[0] == (
+            '{0} checkpoints written to {1}\n'.format(
+                len(index.checkpoints), path))
+        assert RowIndex.load(path).to_bytes() == index.to_bytes()
@@ -0,0 +1,80 @@
+# pylint: disable=no-self-use
+import random
+import zlib
+
+import pytest
+
+from pngdoctor.deflate import iter_block_starts
+
+
+def shifted(data, bit_position):
+    byte, shift = divmod(bit_position, 8)
+    return (int.from_bytes(data[byte:], 'little') >> shift).to_bytes(
+        len(data) - byte, 'little')
+
+
+def compress(data, level=6, strategy=zlib.Z_DEFAULT_STRATEGY, mem_level=8):
+    compressor = zlib.compressobj(
+        level, zlib.DEFLATED, -15, mem_level, strategy)
+    return compressor.compress(data) + compressor.flush()
+
+
+def split(data, size):
+    """
+    Return ``data`` in pieces of ``size`` bytes, with empty ones in
+    between.
+    """
+    pieces = []
+    for start in range(0, len(data), size):
+        pieces.extend([data[start:start + size], b''])
+    return pieces
+
+
+def sample_data(length, seed=0):
+    rng = random.Random(seed)
+    return bytes(rng.randrange(40) for _ in range(length))
+
+
+@pytest.mark.parametrize('level,strategy', [
+    (0, zlib.Z_DEFAULT_STRATEGY),
+    (1, zlib.Z_DEFAULT_STRATEGY),
+    (6, zlib.Z_DEFAULT_STRATEGY),
+    (6, zlib.Z_FIXED),
+    (9, zlib.Z_HUFFMAN_ONLY),
+    (6, zlib.Z_RLE),
+])
+def test_inflation_resumes_at_block_starts(level, strategy):
+    data = sample_data(100000)
+    compressed = compress(data, level, strategy, mem_level=1)
+    starts = list(iter_block_starts([compressed]))
+    assert list(iter_block_starts(split(compressed, 1001))) == starts
+    assert len(starts) > 3
+    assert starts[0] == (0, 0)
+    assert starts[-1][1] == len(data)
+    assert starts[-1][0] <= 8 * len(compressed)
+    for bit_position, output in starts[1:-1]:
+        decompressor = zlib.decompressobj(
+            -15, zdict=data[max(0, output - 2**15):output])
+        assert decompressor.decompress(
+            shifted(compressed, bit_position)) == data[output:]
+
+
+def test_start_position():
+    compressed = zlib.compress(sample_data(1000))
+    assert list(iter_block_starts([compressed], 16))[-1][1] == 1000
+    assert list(iter_block_starts(split(compressed, 1), 16))[-1][1] == 1000
+
+
+def test_empty():
+    assert list(iter_block_starts([compress(b'')])) == [(0, 0), (10, 0)]
+
+
+@pytest.mark.parametrize('compressed', [
+    compress(sample_data(1000))[:-20],
+    b'\x07',
+    compress(b'stored', level=0)[:-2],
+])
+def test_invalid(compressed):
+    from pngdoctor.exceptions import PNGSyntaxError
+    with pytest.raises(PNGSyntaxError):
+        list(iter_block_starts(split(compressed, 7)))
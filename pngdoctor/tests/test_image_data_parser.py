@@ -136,3 +136,76 @@ class TestAdam7DeinterlaceLocator:
         assert actual == expected
 
     #TODO: Add tests for adam7 empty scanlines on smaller images
+
+
+class TestImageDataStreamParser:
+    def stream_parser(self, color_type_name, bit_depth, width, height,
+                      interlace_method_name='none'):
+        from pngdoctor import fieldvalues
+        from pngdoctor.image_data_parser import ImageDataStreamParser
+        from pngdoctor.models import ImageHeader
+        header = ImageHeader(
+            width,
+            height,
+            bit_depth,
+            fieldvalues.ColorType[color_type_name],
+            fieldvalues.CompressionMethod.deflate32k,
+            fieldvalues.FilterMethod.adaptive_five_basic,
+            fieldvalues.InterlaceMethod[interlace_method_name],
+        )
+        return ImageDataStreamParser.from_image_header(header)
+
+    def test_scanlines_across_parts(self):
+        raw = b'\x00\x01\x02\x03' + b'\x02\x01\x01\x01'
+        compressed = zlib.compress(raw)
+        parser = self.stream_parser('rgb', 8, 1, 2)
+        scanlines = []
+        for pos in range(len(compressed)):
+            scanlines.extend(parser.iter_scanlines(compressed[pos:pos + 1]))
+        parser.verify_end()
+        assert scanlines == [(0, 0, b'\x01\x02\x03'), (0, 1, b'\x02\x03\x04')]
+
+    def test_adam7_skips_empty_passes(self):
+        # A 1x1 image only has pixels in the first pass
+        parser = self.stream_parser('grayscale', 8, 1, 1, 'adam7')
+        scanlines = list(parser.iter_scanlines(zlib.compress(b'\x00\x7f')))
+        parser.verify_end()
+        assert scanlines == [(0, 0, b'\x7f')]
+
+    def test_error_on_too_much_data(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        parser = self.stream_parser('grayscale', 8, 1, 1)
+        with pytest.raises(PNGSyntaxError):
+            list(parser.iter_scanlines(zlib.compress(b'\x00\x7f\x00')))
+
+    def test_error_on_missing_scanlines(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        parser = self.stream_parser('grayscale', 8, 1, 2)
+        list(parser.iter_scanlines(zlib.compress(b'\x00\x7f')))
+        with pytest.raises(PNGSyntaxError):
+            parser.verify_end()
+
+    @pytest.mark.parametrize('filter_type', [0, 1, 2, 3, 4])
+    def test_unfilter_matches_reference_filters(self, filter_type):
+        from pngdoctor.tests import filter_methods
+        from pngdoctor.image_data_parser import (
+            _AdaptiveFiveBasicSubimageUnfilterer
+        )
+        from pngdoctor.fieldvalues import ColorType
+        prior = bytes(range(0, 240, 8))
+        line = bytes(range(255, 15, -8))
+        bytes_per_pixel = 3
+        filtered = {
+            0: lambda: list(line),
+            1: lambda: filter_methods.scanline_filter_sub(
+                bytes_per_pixel, line),
+            2: lambda: filter_methods.scanline_filter_up(line, prior),
+            3: lambda: filter_methods.scanline_filter_average(
+                bytes_per_pixel, line, prior),
+            4: lambda: filter_methods.scanline_filter_paeth(
+                bytes_per_pixel, line, prior),
+        }[filter_type]()
+        unfilterer = _AdaptiveFiveBasicSubimageUnfilterer(ColorType.rgb, 8)
+        unfilterer.unfilter_scanline(b'\x00' + prior)
+        assert unfilterer.unfilter_scanline(
+            bytes([filter_type]) + bytes(filtered)) == line
@@ -0,0 +1,68 @@
+"""
+Startup cost regression tests, based on ``python -X importtime``.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+# Generous, so slow machines don't fail spuriously, but still catches a
+# heavy new import on the startup path
+IMPORT_TIME_BUDGET = 0.3  # seconds
+
+
+def import_times(statement):
+    """
+    Run ``statement`` in a fresh interpreter, and return a dict of the
+    cumulative import time in seconds of each module it imported.
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+@pytest.mark.parametrize('module', ['pngdoctor.parser', 'pngdoctor.main'])
+def test_import_time_budget(module):
+    # The best of a few runs, to filter out noise from other processes
+    elapsed = min(import_times('import ' + module)[module] for _ in range(3))
+    assert elapsed < IMPORT_TIME_BUDGET
+
+
+def test_metadata_parse_does_not_load_decoder():
+    path = os.path.join(
+        os.path.dirname(__file__), 'data', 'PNG-Gradient.png')
+    times = import_times(
+        'from pngdoctor.parser import PNGParser, ParseMode\n'
+        'with open({path!r}, "rb") as pngfile:\n'
+        '    PNGParser(pngfile, mode=ParseMode.metadata).parse()'.format(
+            path=path)
+    )
+    assert 'pngdoctor.chunk_parsers' in times
+    assert 'pngdoctor.image_data_parser' not in times
+
+
+def test_cli_startup_is_lazy():
+    times = import_times('import pngdoctor.main')
+    for module in [
+            'pngdoctor.parser',
+            'pngdoctor.batch',
+            'pngdoctor.cache',
+            'pngdoctor.server',
+            'multiprocessing',
+            'sqlite3',
+        ]:
+        assert module not in times
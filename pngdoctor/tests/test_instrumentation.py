@@ -0,0 +1,148 @@
+# pylint: disable=no-self-use
+import io
+import os
+
+from pngdoctor.instrumentation import Instrumentation, tracing_memory
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def read_data_file(name):
+    with open(os.path.join(DATA_DIR, name), 'rb') as pngfile:
+        return pngfile.read()
+
+
+class FakeClock:
+    """
+    A clock that advances one second each time it is read.
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+class TestInstrumentation:
+    def test_wrap_accumulates(self):
+        instrumentation = Instrumentation(
+            clock=FakeClock(), cpu_clock=FakeClock())
+        measured = instrumentation.wrap(
+            'stage', lambda data: data * 2, count_bytes='result')
+        assert measured(b'ab') == b'abab'
+        assert measured(b'c') == b'cc'
+        totals = instrumentation.stages['stage']
+        assert (totals.wall, totals.cpu, totals.calls, totals.bytes) == (
+            2.0, 2.0, 2, 6)
+
+    def test_wrap_counts_calls_that_raise(self):
+        instrumentation = Instrumentation()
+
+        def fail():
+            raise ValueError
+
+        measured = instrumentation.wrap('stage', fail)
+        try:
+            measured()
+        except ValueError:
+            pass
+        assert instrumentation.stages['stage'].calls == 1
+
+    def test_full_parse(self):
+        from pngdoctor.parser import PNGParser
+        data = read_data_file('one_by_one_rgb24_4488cc.png')
+        instrumentation = Instrumentation()
+        PNGParser(io.BytesIO(data), instrumentation=instrumentation).parse()
+        report = instrumentation.report()
+        stages = report['stages']
+        assert stages['read']['bytes'] == len(data)
+        assert stages['order']['calls'] == 6
+        assert stages['crc']['calls'] > 0
+        assert stages['inflate']['bytes'] == 4
+        # One scanline of 3 bytes, without filtering
+        assert stages['unfilter.none']['bytes'] == 3
+        assert stages['unfilter.none']['calls'] == 1
+        for code in ['IHDR', 'pHYs', 'tIME', 'tEXt', 'IDAT', 'IEND']:
+            assert 'chunk.' + code in stages
+        assert report['counts']['ChunkHeadToken'] == 6
+        assert report['counts']['ChunkEndToken'] == 6
+
+    def test_metadata_parse_skips_decoder_stages(self):
+        from pngdoctor.parser import PNGParser, ParseMode
+        data = read_data_file('PNG-Gradient.png')
+        instrumentation = Instrumentation()
+        PNGParser(
+            io.BytesIO(data),
+            mode=ParseMode.metadata,
+            verify_image_data_crc=False,
+            instrumentation=instrumentation,
+        ).parse()
+        assert 'skip' in instrumentation.stages
+        assert 'inflate' not in instrumentation.stages
+
+    def test_iter_image_data(self):
+        from pngdoctor.parser import PNGParser, ParseMode
+        data = read_data_file('one_by_one_rgb24_4488cc.png')
+        instrumentation = Instrumentation()
+        parser = PNGParser(
+            io.BytesIO(data),
+            mode=ParseMode.image_data,
+            instrumentation=instrumentation,
+        )
+        assert len(b''.join(parser.iter_image_data())) > 0
+        stages = instrumentation.stages
+        assert stages['read'].bytes == len(data)
+        assert stages['order'].calls == 6
+        assert 'chunk.tEXt' in stages
+        assert 'inflate' not in stages
+
+    def test_not_attached_leaves_methods_alone(self):
+        from pngdoctor.lexer import ChunkTokenStream
+        tokens = ChunkTokenStream(io.BytesIO(b''))
+        assert '_read' not in vars(tokens)
+
+
+class TestMemoryTracing:
+    def test_peak_attributed_to_innermost_stage(self):
+        instrumentation = Instrumentation(trace_memory=True)
+        inner = instrumentation.wrap('inner', lambda: bytearray(2**20))
+        outer = instrumentation.wrap('outer', lambda: len(inner()))
+        with tracing_memory():
+            assert outer() == 2**20
+        assert instrumentation.peak_memory >= 2**20
+        assert instrumentation.peak_memory_stage == 'inner'
+        assert instrumentation.report()['memory'] == {
+            'peak': instrumentation.peak_memory,
+            'stage': 'inner',
+        }
+
+    def test_tracing_restored(self):
+        import tracemalloc
+        with tracing_memory():
+            assert tracemalloc.is_tracing()
+        assert not tracemalloc.is_tracing()
+
+    def test_check_file(self):
+        from pngdoctor.batch import CheckOptions, check_file
+        result = check_file(
+            os.path.join(DATA_DIR, 'PNG-Gradient.png'),
+            CheckOptions(trace_memory=True),
+        )
+        assert result.ok
+        assert result.peak_memory > 0
+        assert result.peak_memory_stage is not None
+        assert result.stage_timings is None
+        assert result.to_record()['memory'] == {
+            'peak': result.peak_memory,
+            'stage': result.peak_memory_stage,
+        }
+
+    def test_check_command_text_output(self, capsys):
+        from pngdoctor.main import main
+        path = os.path.join(DATA_DIR, 'PNG-Gradient.png')
+        assert main(['check', '-j', '1', '--trace-memory', path]) == 0
+        output = capsys.readouterr()[0]
+        assert output.startswith('OK {0} (peak memory '.format(path))
+        assert ' bytes in ' in output
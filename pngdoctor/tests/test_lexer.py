@@ -1,35 +1,12 @@
 # pylint: disable=protected-access,no-self-use
 import io
 import re
-import struct
-import zlib
 
 import pytest
 
-
-class RawChunkData:
-    def __init__(self, type_, data):
-        self.type = type_
-        self.data = data
-
-    @property
-    def length(self):
-        return len(self.data)
-
-    @property
-    def crc32_bytes(self):
-        crc = zlib.crc32(self.type)
-        crc = zlib.crc32(self.data, crc)
-        return struct.pack('>I', crc)
-
-    @property
-    def bytes(self):
-        length_type = struct.pack('>I4s', self.length, self.type)
-        return length_type + self.data
-
-    @property
-    def bytes_with_crc32(self):
-        return self.bytes + self.crc32_bytes
+from pngdoctor.tests.chunk_fakes import (
+    RawChunkData, ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend, png_bytes
+)
 
 
 def test_pngchunkfake_crc32():
@@ -38,40 +15,6 @@ def test_pngchunkfake_crc32():
     assert actual == expected
 
 
-ihdr_one_by_one_rgb24 = RawChunkData(
-    b'IHDR',
-    struct.pack(
-        '>IIBBBBB',
-        1,  # Image width
-        1,  # Image height
-        8,  # Bit depth
-        2,  # Color type is RGB
-        0,  # Compression method is DEFLATE with 32K sliding window
-        0,  # Filter method is "adaptive filtering with five basic filter
-            # types"
-        0,  # Interlace method is no interlace
-    )
-)
-# Single pixel example IDAT created with GIMP (hexdump with relevant data)
-#                                            00 00  |              ..|
-# 00 0c 49 44 41 54 08 d7  63 70 e9 38 03 00 02 ac  |..IDAT..cp.8....|
-# 01 99 cb 83 c0 90                                 |......          |
-#
-# Chunk bytes:
-# 00 00 00 0c 49 44 41 54 08 d7 63 70 e9 38 03 00 02 ac 01 99 cb 83 c0 90
-# --len 12---| I  D  A  T|------------zlib-data--------------|---crc32---|
-#
-# Decompressed zlib data: 00 44 88 CC
-# Filter type 0 (no filtering)
-# Pastel blue #4488cc
-idat_onepix_4488cc = RawChunkData(
-    b'IDAT',
-    b'\x08\xd7\x63\x70\xe9\x38\x03\x00\x02\xac\x01\x99'
-)
-
-iend = RawChunkData(b'IEND', b'')
-
-
 def test_signature_correct():
     from pngdoctor.lexer import PNG_SIGNATURE
 
@@ -91,7 +34,7 @@ def chunk_tokens_from_fakes(chunk_fakes):
         ChunkHeadToken, ChunkDataPartToken, ChunkEndToken
     )
     tokens = []
-    position = 1 + len(PNG_SIGNATURE)
+    position = len(PNG_SIGNATURE)
     for fake in chunk_fakes:
         head_token = ChunkHeadToken(fake.length, fake.type, position)
         tokens.append(head_token)
@@ -139,6 +82,86 @@ class TestChunkTokenStream:
         with pytest.raises(BadCRC):
             list(chunk_token_stream)
 
+    def test_iter_skip_data_codes(self):
+        from pngdoctor.lexer import PNG_SIGNATURE
+        from pngdoctor.models import ChunkEndToken
+
+        idat_bytes = bytearray(idat_onepix_4488cc.bytes_with_crc32)
+        # The checksum is not calculated for skipped chunks
+        idat_bytes[-1] ^= 0xff
+        contents = b''.join([
+            PNG_SIGNATURE,
+            ihdr_one_by_one_rgb24.bytes_with_crc32,
+            idat_bytes,
+            iend.bytes_with_crc32
+        ])
+        chunk_token_stream = chunk_token_stream_with_bytes(contents)
+        chunk_token_stream._skip_data_codes = frozenset([b'IDAT'])
+
+        expected_tokens = chunk_tokens_from_fakes([
+            ihdr_one_by_one_rgb24,
+            idat_onepix_4488cc,
+            iend
+        ])
+        idat_head = expected_tokens[3]
+        del expected_tokens[4]
+        expected_tokens[4] = ChunkEndToken(idat_head, None)
+
+        assert list(chunk_token_stream) == expected_tokens
+        assert chunk_token_stream.total_bytes_read == len(contents)
+
+    def test_iter_skip_data_codes_eof_in_skipped_data(self):
+        from pngdoctor.lexer import PNG_SIGNATURE
+        from pngdoctor.exceptions import UnexpectedEOF
+
+        contents = b''.join([
+            PNG_SIGNATURE,
+            ihdr_one_by_one_rgb24.bytes_with_crc32,
+            idat_onepix_4488cc.bytes_with_crc32[:-6],
+        ])
+        chunk_token_stream = chunk_token_stream_with_bytes(contents)
+        chunk_token_stream._skip_data_codes = frozenset([b'IDAT'])
+        with pytest.raises(UnexpectedEOF):
+            list(chunk_token_stream)
+
+    def test_iter_data_token_codes(self):
+        from pngdoctor.lexer import PNG_SIGNATURE
+
+        contents = b''.join([
+            PNG_SIGNATURE,
+            ihdr_one_by_one_rgb24.bytes_with_crc32,
+            idat_onepix_4488cc.bytes_with_crc32,
+            iend.bytes_with_crc32
+        ])
+        chunk_token_stream = chunk_token_stream_with_bytes(contents)
+        chunk_token_stream._data_token_codes = frozenset([b'IHDR'])
+
+        expected_tokens = chunk_tokens_from_fakes([
+            ihdr_one_by_one_rgb24,
+            idat_onepix_4488cc,
+            iend
+        ])
+        # Without the IDAT data token
+        del expected_tokens[4]
+
+        assert list(chunk_token_stream) == expected_tokens
+
+    def test_iter_data_token_codes_still_checks_crc(self):
+        from pngdoctor.lexer import PNG_SIGNATURE
+        from pngdoctor.exceptions import BadCRC
+
+        idat_bytes = bytearray(idat_onepix_4488cc.bytes_with_crc32)
+        idat_bytes[-1] ^= 0xff
+        contents = b''.join([
+            PNG_SIGNATURE,
+            ihdr_one_by_one_rgb24.bytes_with_crc32,
+            idat_bytes,
+        ])
+        chunk_token_stream = chunk_token_stream_with_bytes(contents)
+        chunk_token_stream._data_token_codes = frozenset([b'IHDR'])
+        with pytest.raises(BadCRC):
+            list(chunk_token_stream)
+
     def test__read(self):
         from pngdoctor.exceptions import UnexpectedEOF
 
@@ -229,3 +252,88 @@ class TestChunkTokenStream:
             for _ in chunk_token_stream:
                 pass
         assert "Chunk b'IEND' is not allowed here" in str(excinfo.value)
+
+
+def test_content_hash_includes_skipped_data():
+    import hashlib
+    from pngdoctor.lexer import ChunkTokenStream
+    data = png_bytes([ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend])
+    content_hash = hashlib.sha256()
+    tokens = ChunkTokenStream(
+        io.BytesIO(data),
+        skip_data_codes={b'IDAT'},
+        content_hash=content_hash,
+    )
+    list(tokens)
+    assert content_hash.digest() == hashlib.sha256(data).digest()
+
+
+class NonSeekableStream:
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, length):
+        return self._stream.read(length)
+
+
+class TestResynchronize:
+    @pytest.mark.parametrize('garbage_length', [1, 2**16 - 5, 3 * 2**16])
+    @pytest.mark.parametrize('seekable', [True, False])
+    @pytest.mark.parametrize('skip_data_codes', [(), (b'IDAT',)])
+    def test_garbage(self, garbage_length, seekable, skip_data_codes):
+        import hashlib
+        from pngdoctor.lexer import ChunkTokenStream
+        from pngdoctor.models import ChunkHeadToken
+        # Letters that look like type codes, but not after a valid length
+        garbage = (b'\xff\xff\xff\xffIDAT' * garbage_length)[
+            :garbage_length]
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            b'\xff' + garbage,
+            idat_onepix_4488cc.bytes_with_crc32,
+            iend.bytes_with_crc32,
+        ])
+        stream = io.BytesIO(contents)
+        if not seekable:
+            stream = NonSeekableStream(contents)
+        diagnostics = []
+        content_hash = hashlib.sha256() if not seekable else None
+        tokens = ChunkTokenStream(
+            stream, skip_data_codes=skip_data_codes,
+            content_hash=content_hash, diagnostics=diagnostics)
+        heads = [
+            token for token in tokens if isinstance(token, ChunkHeadToken)]
+        [diagnostic] = diagnostics
+        assert diagnostic.code.name == 'invalid_chunk_header'
+        assert diagnostic.position == 33
+        idat_position = 33 + 1 + garbage_length
+        assert [(head.code, head.position) for head in heads] == [
+            (b'IHDR', 8), (b'IDAT', idat_position),
+            (b'IEND',
+             idat_position + len(idat_onepix_4488cc.bytes_with_crc32)),
+        ]
+        assert tokens.total_bytes_read == len(contents)
+        if content_hash is not None:
+            assert content_hash.digest() == hashlib.sha256(contents).digest()
+
+    def test_stream_ends(self):
+        from pngdoctor.lexer import ChunkTokenStream
+        diagnostics = []
+        contents = png_bytes([ihdr_one_by_one_rgb24]) + b'\xff' * 100
+        tokens = ChunkTokenStream(
+            io.BytesIO(contents), diagnostics=diagnostics)
+        assert len(list(tokens)) == 3
+        assert len(diagnostics) == 1
+        assert tokens.total_bytes_read == len(contents)
+
+
+@pytest.mark.parametrize('split', range(12))
+def test_iter_plausible_chunk_headers(split):
+    from pngdoctor.lexer import iter_plausible_chunk_headers
+    data = b'\xff' * 4 + idat_onepix_4488cc.bytes_with_crc32
+    found = [
+        (position, bytes(rest[:8]))
+        for position, rest in iter_plausible_chunk_headers(
+            [data[:split], data[split:]], 100)
+    ]
+    assert found == [(104, data[4:12])]
@@ -0,0 +1,164 @@
+# pylint: disable=no-self-use
+import os
+import time
+
+from pngdoctor.batch import CheckOptions, FileCheckResult, check_file
+from pngdoctor.metrics import (
+    BatchMetrics, TextfileExporter, file_size_bucket, write_textfile
+)
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+class FakeClock:
+    """
+    A clock that is advanced by hand.
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def sample_lines(text):
+    return [line for line in text.splitlines() if not line.startswith('#')]
+
+
+class TestBatchMetrics:
+    def test_counters_and_rates(self):
+        clock = FakeClock()
+        metrics = BatchMetrics(clock=clock)
+        metrics.observe(FileCheckResult('a.png', bytes_read=1000))
+        metrics.observe(FileCheckResult(
+            'b.png', bytes_read=3000, error_type='BadCRC'))
+        metrics.observe(FileCheckResult(
+            'c.png', bytes_read=10, error_type='BadCRC'))
+        clock.now = 2.0
+        metrics.update_rates()
+        samples = sample_lines(metrics.format_prometheus())
+        assert 'pngdoctor_files_total 3' in samples
+        assert 'pngdoctor_bytes_total 4010' in samples
+        assert 'pngdoctor_file_errors_total{type="BadCRC"} 2' in samples
+        assert 'pngdoctor_files_per_second 1.5' in samples
+        assert 'pngdoctor_bytes_per_second 2005.0' in samples
+
+    def test_histograms(self):
+        metrics = BatchMetrics()
+        metrics.observe(FileCheckResult(
+            'a.png', bytes_read=100, elapsed=0.003,
+            stage_timings={'inflate': 0.002}))
+        metrics.observe(FileCheckResult(
+            'b.png', bytes_read=200, elapsed=20.0))
+        samples = sample_lines(metrics.format_prometheus())
+        size = 'size="0-16KiB"'
+        assert ('pngdoctor_file_duration_seconds_bucket'
+                '{{le="0.0025",{0}}} 0'.format(size)) in samples
+        assert ('pngdoctor_file_duration_seconds_bucket'
+                '{{le="0.005",{0}}} 1'.format(size)) in samples
+        assert ('pngdoctor_file_duration_seconds_bucket'
+                '{{le="10.0",{0}}} 1'.format(size)) in samples
+        assert ('pngdoctor_file_duration_seconds_bucket'
+                '{{le="+Inf",{0}}} 2'.format(size)) in samples
+        assert ('pngdoctor_file_duration_seconds_count'
+                '{{{0}}} 2'.format(size)) in samples
+        assert ('pngdoctor_stage_duration_seconds_bucket'
+                '{le="0.0025",stage="inflate"} 1') in samples
+
+    def test_cached_results_not_timed(self):
+        metrics = BatchMetrics()
+        metrics.observe(FileCheckResult('a.png', elapsed=1.0, cached=True))
+        samples = sample_lines(metrics.format_prometheus())
+        assert 'pngdoctor_files_cached_total 1' in samples
+        assert not any(
+            sample.startswith('pngdoctor_file_duration_seconds')
+            for sample in samples
+        )
+
+    def test_file_size_bucket(self):
+        assert file_size_bucket(0) == '0-16KiB'
+        assert file_size_bucket(16 * 1024) == '16KiB-256KiB'
+        assert file_size_bucket(2**30) == '4MiB+'
+
+    def test_stage_timings_from_check(self):
+        path = os.path.join(DATA_DIR, 'PNG-Gradient.png')
+        result = check_file(path, CheckOptions(instrument=True))
+        assert result.ok
+        assert result.stage_timings['inflate'] > 0
+        assert 'chunk.IDAT' in result.stage_timings
+        restored = FileCheckResult.from_record(result.to_record())
+        assert restored.stage_timings == result.stage_timings
+        assert check_file(path, CheckOptions()).stage_timings is None
+
+
+class TestTextfileExporter:
+    def test_write_textfile_replaces(self, tmpdir):
+        path = str(tmpdir.join('pngdoctor.prom'))
+        write_textfile(path, 'old\n')
+        write_textfile(path, 'new\n')
+        with open(path) as textfile:
+            assert textfile.read() == 'new\n'
+        assert tmpdir.listdir() == [tmpdir.join('pngdoctor.prom')]
+
+    def test_interval(self, tmpdir):
+        path = tmpdir.join('pngdoctor.prom')
+        clock = FakeClock()
+        exporter = TextfileExporter(
+            str(path), BatchMetrics(clock=clock), interval=10, clock=clock)
+        exporter.observe(FileCheckResult('a.png'))
+        assert not path.check()
+        clock.now = 10.0
+        exporter.observe(FileCheckResult('b.png'))
+        assert 'pngdoctor_files_total 2' in sample_lines(path.read())
+        exporter.observe(FileCheckResult('c.png'))
+        assert 'pngdoctor_files_total 2' in sample_lines(path.read())
+        exporter.close()
+        assert 'pngdoctor_files_total 3' in sample_lines(path.read())
+
+    def test_tick(self, tmpdir):
+        path = tmpdir.join('pngdoctor.prom')
+        clock = FakeClock()
+        exporter = TextfileExporter(
+            str(path), BatchMetrics(clock=clock), interval=10, clock=clock)
+        exporter.observe_error('Timeout')
+        clock.now = 4.0
+        assert exporter.time_until_write() == 6.0
+        exporter.tick()
+        assert not path.check()
+        clock.now = 10.0
+        assert exporter.time_until_write() == 0.0
+        exporter.tick()
+        samples = sample_lines(path.read())
+        assert 'pngdoctor_files_total 1' in samples
+        assert 'pngdoctor_file_errors_total{type="Timeout"} 1' in samples
+
+    def test_timer_thread(self, tmpdir):
+        path = tmpdir.join('pngdoctor.prom')
+        exporter = TextfileExporter(
+            str(path), BatchMetrics(), interval=0.01)
+        exporter.start()
+        try:
+            deadline = time.monotonic() + 10
+            while not path.check() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert path.check()
+        finally:
+            exporter.close()
+
+    def test_check_command(self, tmpdir, capsys):
+        from pngdoctor.main import main
+        path = tmpdir.join('pngdoctor.prom')
+        status = main([
+            'check', '-j', '1', '--metrics-file', str(path),
+            os.path.join(DATA_DIR, 'PNG-Gradient.png'),
+        ])
+        capsys.readouterr()
+        assert status == 0
+        samples = sample_lines(path.read())
+        assert 'pngdoctor_files_total 1' in samples
+        assert any(
+            sample.startswith(
+                'pngdoctor_stage_duration_seconds_count{stage="inflate"}')
+            for sample in samples
+        )
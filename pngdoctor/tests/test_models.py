@@ -1,4 +1,6 @@
 # pylint: disable=no-self-use
+import pytest
+
 
 def png_chunk_type(type_name):
     from pngdoctor.models import ChunkType
@@ -13,3 +15,62 @@ class TestChunkType:
         assert chunk_type.private is False
         assert chunk_type.reserved is False
         assert chunk_type.safe_to_copy is True
+
+
+def decoded_image(bit_depth=8, stride=8):
+    from pngdoctor.models import DecodedImage
+
+    # 2x3 pixels of 1 or 2 byte gray and alpha samples
+    row_size = 4 if bit_depth <= 8 else 8
+    pixels = bytearray(range(stride * 2 + row_size))
+    return DecodedImage(pixels, 2, 3, 2, bit_depth, stride)
+
+
+class TestDecodedImage:
+    def test_rows(self):
+        image = decoded_image()
+        assert image.row_size == 4
+        assert bytes(image.row(1)) == bytes([8, 9, 10, 11])
+        assert bytes(image.row(2)) == bytes([16, 17, 18, 19])
+        with pytest.raises(IndexError):
+            image.row(3)
+
+    def test_memoryview_shares_pixels(self):
+        image = decoded_image()
+        view = image.memoryview()
+        assert view.format == 'B' and len(view) == 20
+        view[0] = 99
+        assert image.pixels[0] == 99
+
+    @pytest.mark.parametrize('bit_depth,typestr,strides', [
+        (4, '|u1', (8, 2, 1)),
+        (8, '|u1', (8, 2, 1)),
+        (16, '>u2', (8, 4, 2)),
+    ])
+    def test_array_interface(self, bit_depth, typestr, strides):
+        image = decoded_image(bit_depth)
+        interface = image.__array_interface__
+        assert interface['shape'] == (3, 2, 2)
+        assert interface['typestr'] == typestr
+        assert interface['strides'] == strides
+        assert interface['data'] is image.pixels
+
+    def test_array(self):
+        numpy = pytest.importorskip('numpy')
+        image = decoded_image(16, 10)
+        array = numpy.asarray(image)
+        assert array.shape == (3, 2, 2)
+        assert array[1, 0, 1] == 12 * 256 + 13
+        image.pixels[10] = 0
+        assert array[1, 0, 0] == 11
+        assert numpy.array(image, dtype='u4')[2, 1, 1] == 26 * 256 + 27
+
+    def test_array_copies(self):
+        numpy = pytest.importorskip('numpy')
+        image = decoded_image()
+        assert image.__array__(copy=False).base is not None
+        assert image.__array__(copy=True).base is None
+        assert image.__array__('u1', copy=False).shape == (3, 2, 2)
+        assert image.__array__('u2')[0, 1, 0] == 2
+        with pytest.raises(ValueError):
+            image.__array__('u2', copy=False)
@@ -0,0 +1,289 @@
+# pylint: disable=redefined-outer-name,no-self-use
+import io
+import os
+import struct
+import zlib
+
+import pytest
+
+from pngdoctor.tests.chunk_fakes import (
+    RawChunkData, ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend, png_bytes
+)
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def parse_bytes(contents, **kwargs):
+    from pngdoctor.parser import PNGParser
+    return PNGParser(io.BytesIO(contents), **kwargs).parse()
+
+
+def parse_data_file(filename, **kwargs):
+    from pngdoctor.parser import PNGParser
+    with open(os.path.join(DATA_DIR, filename), 'rb') as pngfile:
+        return PNGParser(pngfile, **kwargs).parse()
+
+
+class TestPNGParser:
+    def test_parse_one_pixel(self):
+        from pngdoctor.fieldvalues import ColorType
+        result = parse_bytes(png_bytes([
+            ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend
+        ]))
+        assert result.image_header.width == 1
+        assert result.image_header.color_type is ColorType.rgb
+        assert [head.code for head in result.chunks] == [
+            b'IHDR', b'IDAT', b'IEND'
+        ]
+
+    @pytest.mark.parametrize('mode_name', ['full', 'metadata'])
+    def test_parse_ancillary_chunks_from_file(self, mode_name):
+        from pngdoctor.fieldvalues import PhysicalUnit
+        from pngdoctor.parser import ParseMode
+        result = parse_data_file(
+            'one_by_one_rgb24_4488cc.png', mode=ParseMode[mode_name])
+        assert result.physical_pixel_dimensions.unit is PhysicalUnit.meter
+        assert result.image_last_modification_time.year >= 2016
+        [text] = result.textual_data
+        assert text.keyword == 'Comment'
+
+    def test_parse_gradient_full(self):
+        result = parse_data_file('PNG-Gradient.png')
+        assert result.image_header.width == 128
+        assert result.image_header.height == 68
+
+    def test_full_mode_errors_on_truncated_image_data(self):
+        from pngdoctor.exceptions import DecodeError
+        idat = RawChunkData(b'IDAT', zlib.compress(b'\x00\x44\x88'))
+        with pytest.raises(DecodeError):
+            parse_bytes(png_bytes([ihdr_one_by_one_rgb24, idat, iend]))
+
+    def test_metadata_mode_does_not_inflate(self):
+        from pngdoctor.parser import ParseMode
+        garbage_idat = RawChunkData(b'IDAT', b'not zlib data')
+        result = parse_bytes(
+            png_bytes([ihdr_one_by_one_rgb24, garbage_idat, iend]),
+            mode=ParseMode.metadata,
+        )
+        assert result.image_header.height == 1
+
+    def test_metadata_mode_verifies_image_data_crc_by_default(self):
+        from pngdoctor.exceptions import BadCRC
+        from pngdoctor.parser import ParseMode
+        contents = bytearray(png_bytes([
+            ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend
+        ]))
+        # The last byte of the IDAT checksum, before the 12 IEND bytes
+        contents[-13] ^= 0xff
+        with pytest.raises(BadCRC):
+            parse_bytes(bytes(contents), mode=ParseMode.metadata)
+
+    def test_metadata_mode_can_skip_image_data_crc(self):
+        from pngdoctor.parser import ParseMode
+        contents = bytearray(png_bytes([
+            ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend
+        ]))
+        contents[-13] ^= 0xff
+        result = parse_bytes(
+            bytes(contents),
+            mode=ParseMode.metadata,
+            verify_image_data_crc=False,
+        )
+        assert result.image_header is not None
+
+    def test_metadata_mode_checks_chunk_order(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        from pngdoctor.parser import ParseMode
+        gama = RawChunkData(b'gAMA', struct.pack('>I', 45455))
+        with pytest.raises(PNGSyntaxError):
+            parse_bytes(
+                png_bytes([ihdr_one_by_one_rgb24, idat_onepix_4488cc, gama,
+                           iend]),
+                mode=ParseMode.metadata,
+            )
+
+    def test_invalid_ancillary_chunk(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        srgb = RawChunkData(b'sRGB', b'\x09')
+        with pytest.raises(PNGSyntaxError):
+            parse_bytes(png_bytes([
+                ihdr_one_by_one_rgb24, srgb, idat_onepix_4488cc, iend
+            ]))
+
+    def test_unknown_ancillary_chunk_ignored(self):
+        ukwn = RawChunkData(b'ukwn', b'whatever')
+        result = parse_bytes(png_bytes([
+            ihdr_one_by_one_rgb24, ukwn, idat_onepix_4488cc, iend
+        ]))
+        assert result.chunks[1].code == b'ukwn'
+
+    def test_unknown_critical_chunk(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        ukwn = RawChunkData(b'UKWN', b'whatever')
+        with pytest.raises(PNGSyntaxError):
+            parse_bytes(png_bytes([
+                ihdr_one_by_one_rgb24, ukwn, idat_onepix_4488cc, iend
+            ]))
+
+    def test_max_stored_text_size(self):
+        text = RawChunkData(b'tEXt', b'Comment\x00' + b'x' * 100)
+        result = parse_bytes(
+            png_bytes([ihdr_one_by_one_rgb24, text, idat_onepix_4488cc,
+                       iend]),
+            max_stored_text_size=10,
+        )
+        [text_data] = result.textual_data
+        assert text_data.text is None
+        assert text_data.text_length == 100
+
+    def test_unknown_ancillary_chunk_crc_checked(self):
+        from pngdoctor.exceptions import BadCRC
+        ukwn_bytes = bytearray(
+            RawChunkData(b'ukwn', b'whatever').bytes_with_crc32)
+        ukwn_bytes[-1] ^= 0xff
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            ukwn_bytes,
+            idat_onepix_4488cc.bytes_with_crc32,
+            iend.bytes_with_crc32,
+        ])
+        with pytest.raises(BadCRC):
+            parse_bytes(contents)
+
+    def test_iter_image_data(self):
+        from pngdoctor.parser import PNGParser, ParseMode
+        text = RawChunkData(b'tEXt', b'Comment\x00hello')
+        parser = PNGParser(io.BytesIO(png_bytes([
+            ihdr_one_by_one_rgb24, idat_onepix_4488cc, text, iend,
+        ])), mode=ParseMode.image_data)
+        data = parser.iter_image_data()
+        assert next(data) == idat_onepix_4488cc.data
+        assert parser.result.image_header.width == 1
+        assert parser.result.textual_data == []
+        assert list(data) == []
+        [text_data] = parser.result.textual_data
+        assert text_data.text == 'hello'
+
+    def test_iter_image_data_needs_mode(self):
+        from pngdoctor.parser import PNGParser
+        parser = PNGParser(io.BytesIO(png_bytes([
+            ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend,
+        ])))
+        with pytest.raises(ValueError):
+            next(parser.iter_image_data())
+
+
+def corrupt_crc(chunk):
+    """
+    Return the bytes of the chunk with a wrong CRC32 checksum.
+    """
+    chunk_bytes = bytearray(chunk.bytes_with_crc32)
+    chunk_bytes[-1] ^= 0xff
+    return bytes(chunk_bytes)
+
+
+class TestCollectDiagnostics:
+    def codes(self, result):
+        return [
+            (diagnostic.code.name, diagnostic.chunk_code)
+            for diagnostic in result.diagnostics
+        ]
+
+    def test_valid_file_has_no_diagnostics(self):
+        result = parse_data_file(
+            'PNG-Gradient.png', collect_diagnostics=True)
+        assert result.diagnostics == []
+
+    def test_all_problems_in_one_pass(self):
+        gama = RawChunkData(b'gAMA', struct.pack('>I', 45455))
+        invalid_srgb = RawChunkData(b'sRGB', b'\x09')
+        srgb = RawChunkData(b'sRGB', b'\x00')
+        phys = RawChunkData(b'pHYs', struct.pack('>IIB', 1, 1, 1))
+        ukwn = RawChunkData(b'UKWN', b'whatever')
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            corrupt_crc(gama),
+            invalid_srgb.bytes_with_crc32,
+            srgb.bytes_with_crc32,
+            ukwn.bytes_with_crc32,
+            idat_onepix_4488cc.bytes_with_crc32,
+            phys.bytes_with_crc32,
+            iend.bytes_with_crc32,
+        ])
+        result = parse_bytes(contents, collect_diagnostics=True)
+        assert self.codes(result) == [
+            ('crc_mismatch', b'gAMA'),
+            ('invalid_ancillary_chunk', b'sRGB'),
+            ('duplicate_chunk', b'sRGB'),
+            ('unknown_critical_chunk', b'UKWN'),
+            ('misplaced_chunk', b'pHYs'),
+        ]
+        # Ancillary chunks with problems are ignored
+        assert result.image_gamma is None
+        assert result.standard_rgb_color_space is None
+        assert result.physical_pixel_dimensions is None
+        assert result.chunks[-1].code == b'IEND'
+        positions = [head.position for head in result.chunks]
+        assert result.diagnostics[0].position == positions[1]
+        assert result.diagnostics[-1].position == positions[-2]
+        assert result.diagnostics[2].error_type == 'DuplicateChunk'
+
+    def test_resynchronizes_after_invalid_header(self):
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            b'\xff\x00garbage\x00',
+            idat_onepix_4488cc.bytes_with_crc32,
+            iend.bytes_with_crc32,
+        ])
+        result = parse_bytes(contents, collect_diagnostics=True)
+        [diagnostic] = result.diagnostics
+        assert diagnostic.code.name == 'invalid_chunk_header'
+        assert diagnostic.position == 33
+        assert [head.code for head in result.chunks] == [
+            b'IHDR', b'IDAT', b'IEND'
+        ]
+        assert result.chunks[1].position == 33 + 10
+
+    def test_missing_trailer(self):
+        result = parse_bytes(
+            png_bytes([ihdr_one_by_one_rgb24, idat_onepix_4488cc]),
+            collect_diagnostics=True,
+        )
+        assert self.codes(result) == [('missing_trailer', None)]
+
+    def test_invalid_critical_chunk_still_raises(self):
+        from pngdoctor.exceptions import PNGSyntaxError
+        from pngdoctor.parser import PNGParser
+        ihdr = RawChunkData(b'IHDR', b'\x00' * 13)
+        parser = PNGParser(
+            io.BytesIO(png_bytes([ihdr, idat_onepix_4488cc, iend])),
+            collect_diagnostics=True,
+        )
+        with pytest.raises(PNGSyntaxError):
+            parser.parse()
+        assert parser.result.diagnostics == []
+
+    def test_iter_image_data(self):
+        from pngdoctor.parser import PNGParser, ParseMode
+        gama = RawChunkData(b'gAMA', struct.pack('>I', 45455))
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            corrupt_crc(gama),
+            idat_onepix_4488cc.bytes_with_crc32,
+            iend.bytes_with_crc32,
+            idat_onepix_4488cc.bytes_with_crc32,
+        ])
+        parser = PNGParser(
+            io.BytesIO(contents),
+            mode=ParseMode.image_data,
+            collect_diagnostics=True,
+        )
+        # The IDAT chunk after IEND is ignored
+        assert list(parser.iter_image_data()) == [
+            idat_onepix_4488cc.data
+        ]
+        assert self.codes(parser.result) == [
+            ('crc_mismatch', b'gAMA'),
+            ('misplaced_chunk', b'IDAT'),
+        ]
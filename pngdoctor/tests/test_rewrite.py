@@ -0,0 +1,357 @@
+# pylint: disable=redefined-outer-name,no-self-use,protected-access
+import errno
+import io
+import os
+import struct
+import zlib
+
+import pytest
+
+from pngdoctor.models import ChunkHeadToken
+from pngdoctor.tests.chunk_fakes import (
+    RawChunkData, ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend, png_bytes
+)
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+gama = RawChunkData(b'gAMA', struct.pack('>I', 45455))
+phys = RawChunkData(b'pHYs', struct.pack('>IIB', 2835, 2835, 1))
+text = RawChunkData(b'tEXt', b'Comment\x00hello')
+
+
+def corrupt_crc(chunk):
+    chunk_bytes = bytearray(chunk.bytes_with_crc32)
+    chunk_bytes[-1] ^= 0xff
+    return bytes(chunk_bytes)
+
+
+def split_idat():
+    """
+    Return the one pixel image data split over two IDAT chunks.
+    """
+    data = idat_onepix_4488cc.data
+    return RawChunkData(b'IDAT', data[:5]), RawChunkData(b'IDAT', data[5:])
+
+
+def parse(contents):
+    from pngdoctor.parser import PNGParser
+    return PNGParser(io.BytesIO(contents)).parse()
+
+
+@pytest.fixture
+def run_repair(tmpdir):
+    def run_repair(contents):
+        from pngdoctor.rewrite import repair
+        source = tmpdir.join('in.png')
+        source.write_binary(contents)
+        destination = tmpdir.join('out.png')
+        repairs = repair(str(source), str(destination))
+        return [
+            (change.action.name, change.chunk_code) for change in repairs
+        ], destination.read_binary()
+    return run_repair
+
+
+class TestRepair:
+    def test_valid_file_unchanged(self, run_repair):
+        with open(os.path.join(DATA_DIR, 'PNG-Gradient.png'), 'rb') as png:
+            contents = png.read()
+        assert run_repair(contents) == ([], contents)
+
+    def test_crc_fixed(self, run_repair):
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            corrupt_crc(gama),
+            idat_onepix_4488cc.bytes_with_crc32,
+            iend.bytes_with_crc32,
+        ])
+        repairs, repaired = run_repair(contents)
+        assert repairs == [('crc_fixed', b'gAMA')]
+        assert repaired == png_bytes(
+            [ihdr_one_by_one_rgb24, gama, idat_onepix_4488cc, iend])
+
+    def test_length_fixed(self, run_repair):
+        damaged = bytearray(gama.bytes_with_crc32)
+        damaged[3] = 9
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            bytes(damaged),
+            idat_onepix_4488cc.bytes_with_crc32,
+            iend.bytes_with_crc32,
+        ])
+        repairs, repaired = run_repair(contents)
+        assert repairs == [('length_fixed', b'gAMA')]
+        assert parse(repaired).image_gamma.gamma == 45455
+
+    def test_misplaced_chunks_moved(self, run_repair):
+        first, second = split_idat()
+        contents = png_bytes([
+            ihdr_one_by_one_rgb24, first, text, second, phys, gama, gama,
+            iend,
+        ])
+        repairs, repaired = run_repair(contents)
+        assert repairs == [
+            ('chunk_moved', b'tEXt'),
+            ('chunk_moved', b'pHYs'),
+            ('chunk_moved', b'gAMA'),
+            ('chunk_moved', b'gAMA'),
+            ('duplicate_dropped', b'gAMA'),
+        ]
+        assert repaired == png_bytes([
+            ihdr_one_by_one_rgb24, phys, gama, first, second, text, iend,
+        ])
+
+    def test_garbage_truncation_and_trailer(self, run_repair):
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            b'\xff\xffjunk',
+            idat_onepix_4488cc.bytes_with_crc32,
+            text.bytes_with_crc32[:-3],
+        ])
+        repairs, repaired = run_repair(contents)
+        assert repairs == [
+            ('garbage_dropped', None),
+            ('truncated_chunk_dropped', b'tEXt'),
+            ('trailer_added', b'IEND'),
+        ]
+        assert repaired == png_bytes(
+            [ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend])
+
+    @pytest.mark.parametrize('garbage_length', [2**16 - 5, 3 * 2**16])
+    def test_garbage_across_blocks(self, run_repair, garbage_length):
+        # Letters that look like type codes, but not after a valid length
+        garbage = (b'\xff\xff\xff\xffIDAT' * garbage_length)[
+            :garbage_length]
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            garbage,
+            idat_onepix_4488cc.bytes_with_crc32,
+            iend.bytes_with_crc32,
+        ])
+        repairs, repaired = run_repair(contents)
+        assert repairs == [('garbage_dropped', None)]
+        assert repaired == png_bytes(
+            [ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend])
+
+    def test_length_fixed_across_blocks(self, run_repair):
+        data = b'Comment\0' + b'tEXt' * 2**16
+        chunk = b''.join([
+            struct.pack('>I4s', len(data) + 1, b'tEXt'),
+            data,
+            struct.pack('>I', zlib.crc32(data, zlib.crc32(b'tEXt'))),
+        ])
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            idat_onepix_4488cc.bytes_with_crc32,
+            chunk,
+            iend.bytes_with_crc32,
+        ])
+        repairs, repaired = run_repair(contents)
+        assert repairs == [('length_fixed', b'tEXt')]
+        assert parse(repaired).textual_data[0].text == 'tEXt' * 2**16
+
+    def test_copy_fallback(self, run_repair, monkeypatch):
+        from pngdoctor import rewrite
+
+        def unsupported(*args):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        monkeypatch.setattr(rewrite, '_COPY_FUNCTIONS', [
+            unsupported, rewrite._read_and_write,
+        ])
+        contents = png_bytes(
+            [ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend])
+        assert run_repair(contents) == ([], contents)
+
+
+class TestRewritePlan:
+    def test_adjacent_copies_merged(self):
+        from pngdoctor.rewrite import _RewritePlan
+        plan = _RewritePlan()
+        plan.copy(0, 8)
+        plan.copy(8, 12)
+        plan.write(b'new')
+        plan.copy(20, 4)
+        plan.copy(30, 4)
+        assert plan.pieces == [(0, 20), b'new', (20, 4), (30, 4)]
+
+
+def test_repair_command(tmpdir, capsys):
+    from pngdoctor.main import main
+    source = tmpdir.join('in.png')
+    source.write_binary(png_bytes([ihdr_one_by_one_rgb24]) + corrupt_crc(
+        idat_onepix_4488cc))
+    destination = tmpdir.join('out.png')
+    assert main(['repair', str(source), str(destination)]) == 0
+    assert capsys.readouterr()[0].splitlines() == [
+        'byte 33: crc_fixed: Fixed CRC32 to cb83c090',
+        'trailer_added: Added missing IEND chunk',
+    ]
+    assert parse(destination.read_binary()).image_header.width == 1
+
+
+class TestStrip:
+    @pytest.fixture
+    def run_strip(self, tmpdir):
+        def run_strip(contents, *args, **kwargs):
+            from pngdoctor.rewrite import strip
+            source = tmpdir.join('in.png')
+            source.write_binary(contents)
+            destination = tmpdir.join('out.png')
+            removed = strip(str(source), str(destination), *args, **kwargs)
+            return (
+                [head.code for head in removed], destination.read_binary())
+        return run_strip
+
+    def chunks(self):
+        private = RawChunkData(b'prVt', b'private, safe to copy')
+        unsafe = RawChunkData(b'uNSF', b'public, unsafe to copy')
+        return [
+            ihdr_one_by_one_rgb24, gama, private, idat_onepix_4488cc, unsafe,
+            text, iend,
+        ]
+
+    def test_all_ancillary(self, run_strip):
+        removed, stripped = run_strip(png_bytes(self.chunks()))
+        assert removed == [b'gAMA', b'prVt', b'uNSF', b'tEXt']
+        assert stripped == png_bytes(
+            [ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend])
+
+    def test_policies(self, run_strip):
+        from pngdoctor.rewrite import StripPolicy
+        chunks = self.chunks()
+        removed, stripped = run_strip(
+            png_bytes(chunks), [StripPolicy.unsafe_to_copy])
+        # gAMA is unsafe to copy too
+        assert removed == [b'gAMA', b'uNSF']
+        removed, stripped = run_strip(
+            png_bytes(chunks), [StripPolicy.private], [b'tEXt'])
+        assert removed == [b'prVt', b'tEXt']
+        assert stripped == png_bytes([
+            ihdr_one_by_one_rgb24, gama, idat_onepix_4488cc,
+            RawChunkData(b'uNSF', b'public, unsafe to copy'), iend,
+        ])
+
+    def test_original_crc_kept(self, run_strip):
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24, text]),
+            corrupt_crc(idat_onepix_4488cc),
+            iend.bytes_with_crc32,
+        ])
+        removed, stripped = run_strip(contents)
+        assert removed == [b'tEXt']
+        assert stripped == b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            corrupt_crc(idat_onepix_4488cc),
+            iend.bytes_with_crc32,
+        ])
+
+    def test_critical_chunk_refused(self, run_strip):
+        with pytest.raises(ValueError):
+            run_strip(png_bytes(self.chunks()), [], [b'PLTE'])
+
+    def test_truncated_file(self, run_strip):
+        from pngdoctor.exceptions import UnexpectedEOF
+        with pytest.raises(UnexpectedEOF):
+            run_strip(png_bytes(self.chunks())[:-6])
+
+    def test_command(self, tmpdir, capsys):
+        from pngdoctor.main import main
+        source = tmpdir.join('in.png')
+        source.write_binary(png_bytes(self.chunks()))
+        destination = tmpdir.join('out.png')
+        assert main(['strip', '--chunk', 'tEXt', str(source),
+                     str(destination)]) == 0
+        assert capsys.readouterr()[0] == 'byte 140: removed tEXt\n'
+
+
+class TestRechunk:
+    @pytest.fixture
+    def run_rechunk(self, tmpdir):
+        def run_rechunk(contents, target_size):
+            from pngdoctor.rewrite import rechunk
+            source = tmpdir.join('in.png')
+            source.write_binary(contents)
+            destination = tmpdir.join('out.png')
+            counts = rechunk(str(source), str(destination), target_size)
+            return counts, destination.read_binary()
+        return run_rechunk
+
+    def idat_sizes(self, contents):
+        from pngdoctor.lexer import ALL_CHUNK_CODES, ChunkTokenStream
+        return [
+            token.length
+            for token in ChunkTokenStream(
+                io.BytesIO(contents), skip_data_codes=ALL_CHUNK_CODES)
+            if isinstance(token, ChunkHeadToken) and token.code == b'IDAT'
+        ]
+
+    def test_split_and_merge(self, run_rechunk):
+        data = idat_onepix_4488cc.data
+        contents = png_bytes([ihdr_one_by_one_rgb24, gama] + [
+            RawChunkData(b'IDAT', data[start:start + 3])
+            for start in range(0, len(data), 3)
+        ] + [text, iend])
+        counts, rechunked = run_rechunk(contents, 4)
+        assert counts == ((len(data) + 2) // 3, (len(data) + 3) // 4)
+        sizes = self.idat_sizes(rechunked)
+        assert set(sizes[:-1]) == {4}
+        assert sum(sizes) == len(data)
+        assert rechunked == png_bytes([ihdr_one_by_one_rgb24, gama] + [
+            RawChunkData(b'IDAT', data[start:start + 4])
+            for start in range(0, len(data), 4)
+        ] + [text, iend])
+        assert parse(rechunked).image_header.width == 1
+
+    def test_merge_all(self, run_rechunk):
+        first, second = split_idat()
+        contents = png_bytes([ihdr_one_by_one_rgb24, first, second, iend])
+        counts, rechunked = run_rechunk(contents, 2**16)
+        assert counts == (2, 1)
+        assert rechunked == png_bytes(
+            [ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend])
+
+    def test_split(self, run_rechunk):
+        with open(os.path.join(DATA_DIR, 'PNG-Gradient.png'), 'rb') as png:
+            contents = png.read()
+        size = sum(self.idat_sizes(contents))
+        counts, rechunked = run_rechunk(contents, 50)
+        assert counts == (1, (size + 49) // 50)
+        assert sum(self.idat_sizes(rechunked)) == size
+        result = parse(rechunked)
+        assert result.image_header == parse(contents).image_header
+
+    def test_empty_image_data_kept(self, run_rechunk):
+        empty = RawChunkData(b'IDAT', b'')
+        contents = png_bytes([ihdr_one_by_one_rgb24, empty, empty, iend])
+        counts, rechunked = run_rechunk(contents, 10)
+        assert counts == (2, 1)
+        assert rechunked == png_bytes([ihdr_one_by_one_rgb24, empty, iend])
+
+    def test_bad_crc(self, run_rechunk, tmpdir):
+        from pngdoctor.exceptions import BadCRC
+        contents = b''.join([
+            png_bytes([ihdr_one_by_one_rgb24]),
+            corrupt_crc(idat_onepix_4488cc),
+            iend.bytes_with_crc32,
+        ])
+        with pytest.raises(BadCRC):
+            run_rechunk(contents, 10)
+        assert tmpdir.listdir() == [tmpdir.join('in.png')]
+
+    def test_invalid_size(self, run_rechunk):
+        with pytest.raises(ValueError):
+            run_rechunk(png_bytes([ihdr_one_by_one_rgb24, iend]), 0)
+
+    def test_command(self, tmpdir, capsys):
+        from pngdoctor.main import main
+        source = tmpdir.join('in.png')
+        source.write_binary(png_bytes(
+            [ihdr_one_by_one_rgb24] + list(split_idat()) + [iend]))
+        destination = tmpdir.join('out.png')
+        assert main(['rechunk', '--size', '4', str(source),
+                     str(destination)]) == 0
+        data_length = len(idat_onepix_4488cc.data)
+        assert capsys.readouterr()[0] == 'IDAT chunks: 2 -> {0}\n'.format(
+            (data_length + 3) // 4)
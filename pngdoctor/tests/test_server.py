@@ -0,0 +1,161 @@
+# pylint: disable=redefined-outer-name,no-self-use
+import json
+import os
+import signal
+import socket
+import threading
+import time
+
+import pytest
+
+from pngdoctor.tests.chunk_fakes import (
+    ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend, png_bytes
+)
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+GRADIENT_PATH = os.path.join(DATA_DIR, 'PNG-Gradient.png')
+
+
+@pytest.fixture
+def running_server(tmpdir):
+    """
+    A running server, and the address it listens on.
+    """
+    from pngdoctor.server import _Server, create_listener
+    address = str(tmpdir.join('pngdoctor.sock'))
+    listener = create_listener(unix_path=address)
+    server = _Server(listener, worker_count=2, timeout=10.0, max_pipelined=4)
+    thread = threading.Thread(target=server.run)
+    thread.start()
+    yield server, address
+    server.shutdown()
+    thread.join()
+    server.close()
+    listener.close()
+
+
+@pytest.fixture
+def server_address(running_server):
+    return running_server[1]
+
+
+def exchange(address, payload, count):
+    """
+    Send the payload at once, and return the first ``count`` decoded
+    response lines.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(10)
+        client.connect(address)
+        client.sendall(payload)
+        reader = client.makefile('rb')
+        return [json.loads(reader.readline().decode()) for _ in range(count)]
+
+
+def request(**fields):
+    return json.dumps(fields).encode() + b'\n'
+
+
+class TestServer:
+    def test_pipelined_paths_and_bodies(self, server_address):
+        valid = png_bytes([ihdr_one_by_one_rgb24, idat_onepix_4488cc, iend])
+        truncated = png_bytes([ihdr_one_by_one_rgb24, idat_onepix_4488cc])
+        payload = b''.join([
+            request(id=1, path=GRADIENT_PATH),
+            request(id=2, length=len(truncated)) + truncated,
+            request(id=3, length=len(valid), metadata=True) + valid,
+        ] * 3)
+        responses = exchange(server_address, payload, 9)
+        assert [response['id'] for response in responses] == [1, 2, 3] * 3
+        assert [response['status'] for response in responses] == [
+            'ok', 'error', 'ok'
+        ] * 3
+        assert responses[0]['path'] == GRADIENT_PATH
+        assert responses[0]['image_header']['width'] == 128
+        assert responses[1]['error']['type'] == 'PNGSyntaxError'
+        assert responses[2]['path'] is None
+
+    def test_bad_requests(self, server_address):
+        payload = b'not json\n' + request(id=5) + request(
+            id=6, path=GRADIENT_PATH)
+        responses = exchange(server_address, payload, 3)
+        assert [response['error'] and response['error']['type']
+                for response in responses] == ['BadRequest', 'BadRequest',
+                                               None]
+        assert [response['id'] for response in responses] == [None, 5, 6]
+
+    @pytest.mark.parametrize('timeout', [
+        float('inf'), float('nan'), 0, -1, 'soon',
+    ])
+    def test_bad_timeout(self, server_address, timeout):
+        payload = request(id=1, path=GRADIENT_PATH, timeout=timeout) + (
+            request(id=2, path=GRADIENT_PATH, timeout=1e300))
+        responses = exchange(server_address, payload, 2)
+        assert responses[0]['error']['type'] == 'BadRequest'
+        # The server is still running, and a huge finite timeout is fine
+        assert responses[1]['status'] == 'ok'
+
+    def test_timeout(self, server_address, tmpdir):
+        fifo = str(tmpdir.join('fifo.png'))
+        os.mkfifo(fifo)
+        # Opening the FIFO blocks the worker until it runs out of time
+        payload = request(id=1, path=fifo, timeout=0.2) + request(
+            id=2, path=GRADIENT_PATH)
+        responses = exchange(server_address, payload, 2)
+        assert responses[0]['error']['type'] == 'Timeout'
+        assert responses[1]['status'] == 'ok'
+
+    def test_idle_worker_died(self, running_server):
+        server, address = running_server
+        # pylint: disable=protected-access
+        for worker in list(server._idle_workers):
+            os.kill(worker.process.pid, signal.SIGKILL)
+            worker.process.join()
+        payload = request(id=1, path=GRADIENT_PATH) + request(
+            id=2, path=GRADIENT_PATH)
+        responses = exchange(address, payload, 2)
+        assert [response['status'] for response in responses] == [
+            'ok', 'ok']
+        assert len(server._idle_workers) == 2
+
+
+def test_metrics(tmpdir):
+    from pngdoctor.metrics import BatchMetrics, TextfileExporter
+    from pngdoctor.server import _Server, create_listener
+    address = str(tmpdir.join('pngdoctor.sock'))
+    metrics_path = tmpdir.join('pngdoctor.prom')
+    exporter = TextfileExporter(
+        str(metrics_path), BatchMetrics(), interval=0.05)
+    listener = create_listener(unix_path=address)
+    server = _Server(listener, worker_count=1, timeout=10.0,
+                     max_pipelined=4, exporter=exporter)
+    thread = threading.Thread(target=server.run)
+    thread.start()
+    try:
+        responses = exchange(address, request(id=1, path=GRADIENT_PATH), 1)
+        assert responses[0]['timings']['inflate'] >= 0
+        # Written while idle, without another request
+        deadline = time.monotonic() + 10
+        while (
+                'pngdoctor_files_total 1\n' not in (
+                    metrics_path.read() if metrics_path.check() else '')
+                and time.monotonic() < deadline):
+            time.sleep(0.01)
+        assert 'pngdoctor_files_total 1\n' in metrics_path.read()
+    finally:
+        server.shutdown()
+        thread.join()
+        server.close()
+        listener.close()
+    assert 'stage="inflate"' in metrics_path.read()
+
+
+@pytest.mark.parametrize('timeout', ['inf', 'nan', '0', '-1'])
+def test_command_bad_timeout(tmpdir, capsys, timeout):
+    from pngdoctor.main import main
+    address = str(tmpdir.join('pngdoctor.sock'))
+    with pytest.raises(SystemExit):
+        main(['serve', '--unix', address, '--timeout', timeout])
+    assert '--timeout' in capsys.readouterr()[1]
+    assert not os.path.exists(address)